@@ -0,0 +1,83 @@
+"""Benchmark of the connections to the DALLE API, against a local fake DALLE server.
+Compares the former requests (`requests.post`, opening a new connection each time) with the pooled keep-alive
+session of `Dalle`. The fake server can delay each new connection, simulating the TCP+TLS handshake latency
+to a remote server, and reply 503 to a ratio of the requests, simulating the retry loop while DALLE is busy.
+
+Usage: python -m benchmarks.dalle_connection_pool [--requests 200] [--threads 10] [--handshake-ms 50]
+"""
+
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from dalle_telegram_bot.services.dalle import Dalle, DalleTemporarilyUnavailableException
+from dalle_telegram_bot.settings import Settings
+from .fakes import FakeDalleServer
+
+
+def request_legacy(settings: Settings, prompt: str):
+    """Former request: module-level `requests.post`, with a new connection per request"""
+    response = requests.post(
+        url=settings.dalle_api_url,
+        json=dict(prompt=prompt),
+        timeout=settings.dalle_api_request_timeout_seconds,
+    )
+    if response.status_code == 503:
+        raise DalleTemporarilyUnavailableException()
+    response.raise_for_status()
+
+
+def run_mode(mode: str, args: argparse.Namespace) -> dict:
+    server = FakeDalleServer(handshake_latency=args.handshake_ms / 1000, unavailable_ratio=args.unavailable_ratio)
+    server.start()
+    settings = Settings(
+        telegram_bot_token="benchmark",
+        dalle_api_url=server.url,
+        dalle_api_pool_size=args.threads,
+    )
+    dalle = Dalle(settings=settings)
+    request = dalle._simple_request if mode == "pooled" else lambda prompt: request_legacy(settings, prompt)
+
+    def _request(i: int):
+        start = time.perf_counter()
+        try:
+            request(f"benchmark {i}")
+        except DalleTemporarilyUnavailableException:
+            pass
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        latencies = sorted(pool.map(_request, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    dalle.close()
+    server.stop()
+    return dict(
+        mode=mode,
+        requests=args.requests,
+        connections=server.connections,
+        elapsed_seconds=round(elapsed, 3),
+        requests_per_second=round(args.requests / elapsed, 1),
+        latency_p50_ms=round(latencies[len(latencies) // 2] * 1000, 2),
+        latency_p99_ms=round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=10)
+    parser.add_argument("--handshake-ms", type=float, default=50, help="simulated latency of each new connection")
+    parser.add_argument("--unavailable-ratio", type=float, default=0.5, help="ratio of requests replied with 503")
+    args = parser.parse_args()
+
+    for mode in ("legacy", "pooled"):
+        print(json.dumps(run_mode(mode, args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Benchmark of the memory used while parsing DALLE responses.
+Compares the former parsing (JSON text loaded into base64 strings, decoded on each `images_bytes` access)
+with `DalleResponse.parse_api_response`. Each mode runs on a subprocess, reporting its peak RSS growth
+and the peak of Python allocations, per in-flight generation.
+
+Usage: python -m benchmarks.dalle_response_memory [--generations 10] [--image-size 250000]
+"""
+
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import resource
+import tracemalloc
+from typing import List
+
+from dalle_telegram_bot.services.dalle.models import DalleResponse
+
+
+def build_body(image_size: int) -> bytes:
+    images = [base64.b64encode(os.urandom(image_size)).decode() for _ in range(9)]
+    return json.dumps(dict(images=images, version="mega-bf16:v0")).encode()
+
+
+def parse_legacy(body: bytes) -> List[bytes]:
+    """Former parsing: `response.json()` kept the base64 strings, and the bot decoded them again on delivery."""
+    data = json.loads(body.decode())
+    images_base64: List[str] = data["images"]
+    images_bytes = [base64.b64decode(image) for image in images_base64]
+    # the base64 strings were kept alive by the response model while the decoded images were delivered
+    return [images_base64, images_bytes]
+
+
+def parse_current(body: bytes) -> DalleResponse:
+    return DalleResponse.parse_api_response(body=body, prompt="benchmark")
+
+
+def run_mode(mode: str, generations: int, image_size: int, results: multiprocessing.Queue):
+    parser = parse_legacy if mode == "legacy" else parse_current
+    bodies = [build_body(image_size) for _ in range(generations)]
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    tracemalloc.start()
+    responses = list()
+    for i in range(generations):
+        # the body (as held by the HTTP response) is released after parsing
+        responses.append(parser(bodies[i]))
+        bodies[i] = None
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put(dict(
+        mode=mode,
+        generations=generations,
+        peak_rss_growth_kb_per_generation=round((rss_peak - rss_start) / generations, 1),
+        peak_traced_kb_per_generation=round(traced_peak / 1024 / generations, 1),
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--generations", type=int, default=10)
+    parser.add_argument("--image-size", type=int, default=250_000, help="size (bytes) of each generated image")
+    args = parser.parse_args()
+
+    results = multiprocessing.Queue()
+    for mode in ("legacy", "current"):
+        process = multiprocessing.Process(target=run_mode, args=(mode, args.generations, args.image_size, results))
+        process.start()
+        process.join()
+        print(json.dumps(results.get()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""Local stand-in servers for the Telegram Bot API and the DALLE API, used by the benchmarks.
+Both run on background threads, listening on a random local port, with configurable latency and error rates.
+"""
+
+import base64
+import email.parser
+import email.policy
+import json
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlsplit, parse_qsl
+
+__all__ = ("FakeDalleServer", "FakeTelegramServer")
+
+
+class _FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    block_on_close = False
+
+    def __init__(self, handler_cls):
+        super().__init__(("127.0.0.1", 0), handler_cls)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _reply(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reply_json(self, status: int, data):
+        self._reply(status, json.dumps(data).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+# DALLE
+
+class FakeDalleServer(_FakeServer):
+    """Fake DALLE API. Each generation takes `latency` seconds, and a ratio of them fail with 503.
+    New connections can be delayed by `handshake_latency`, simulating the TCP+TLS handshake to a remote server."""
+
+    def __init__(
+            self, latency: float = 0, unavailable_ratio: float = 0, handshake_latency: float = 0, image_size: int = 1000
+    ):
+        super().__init__(_FakeDalleHandler)
+        self.latency = latency
+        self.unavailable_ratio = unavailable_ratio
+        self.handshake_latency = handshake_latency
+        self.body = json.dumps(dict(
+            images=[base64.b64encode(os.urandom(image_size)).decode() for _ in range(9)],
+            version="mega-bf16:v0",
+        )).encode()
+
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.unavailable_responses = 0
+
+    @property
+    def url(self) -> str:
+        return f"{self.base_url}/generate"
+
+    def count(self, attribute: str):
+        with self._lock:
+            setattr(self, attribute, getattr(self, attribute) + 1)
+
+    @property
+    def stats(self) -> dict:
+        return dict(
+            connections=self.connections,
+            requests=self.requests,
+            unavailable_responses=self.unavailable_responses,
+        )
+
+
+class _FakeDalleHandler(_FakeHandler):
+    server: FakeDalleServer
+
+    def setup(self):
+        super().setup()
+        self.server.count("connections")
+        time.sleep(self.server.handshake_latency)
+
+    def do_POST(self):
+        self._read_body()
+        self.server.count("requests")
+        time.sleep(self.server.latency)
+        if random.random() < self.server.unavailable_ratio:
+            self.server.count("unavailable_responses")
+            self._reply(503, b"")
+        else:
+            self._reply(200, self.server.body)
+
+
+# Telegram Bot API
+
+class FakeTelegramServer(_FakeServer):
+    """Fake Telegram Bot API, serving the updates pushed with `push_message` (getUpdates long polling,
+    or POSTed to the webhook once set with setWebhook, over up to `max_connections` concurrent connections),
+    and recording the requests sent by the bot. Each request takes `latency` seconds, and a ratio of the
+    requests sending messages (send*) fail with 429 Too Many Requests, with the given retry_after.
+    `on_reply` is called with (method, params) for each request replying to a message."""
+
+    def __init__(
+            self,
+            latency: float = 0,
+            toomanyrequests_ratio: float = 0,
+            retry_after: int = 1,
+            on_reply: Optional[Callable[[str, dict], None]] = None,
+    ):
+        super().__init__(_FakeTelegramHandler)
+        self.latency = latency
+        self.toomanyrequests_ratio = toomanyrequests_ratio
+        self.retry_after = retry_after
+        self.on_reply = on_reply
+
+        self._updates: List[dict] = list()
+        self._updates_condition = threading.Condition()
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._lock = threading.Lock()
+        self.methods_count: Dict[str, int] = defaultdict(int)
+        self.toomanyrequests_responses = 0
+        self.polling = threading.Event()
+        self.webhook_set = threading.Event()
+        self.webhook_deliveries_failed = 0
+
+        self._webhook_url: Optional[str] = None
+        self._webhook_secret_token: Optional[str] = None
+        self._webhook_updates: "queue.Queue[dict]" = queue.Queue()
+
+    @property
+    def api_url(self) -> str:
+        return self.base_url
+
+    def next_message_id(self) -> int:
+        with self._lock:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+            return message_id
+
+    def push_message(self, chat_id: int, text: str) -> int:
+        """Enqueue an update with a text message sent by a user to the bot. Return its message_id."""
+        message_id = self.next_message_id()
+        with self._updates_condition:
+            update = dict(
+                update_id=self._next_update_id,
+                message=dict(
+                    message_id=message_id,
+                    date=int(time.time()),
+                    chat=dict(id=chat_id, type="private", first_name="Load"),
+                    **{"from": dict(id=chat_id, is_bot=False, first_name="Load")},
+                    text=text,
+                ),
+            )
+            self._next_update_id += 1
+            if self._webhook_url:
+                self._webhook_updates.put(update)
+            else:
+                self._updates.append(update)
+                self._updates_condition.notify_all()
+        return message_id
+
+    def set_webhook(self, url: str, secret_token: Optional[str], max_connections: int):
+        """Deliver the further updates to the webhook, from `max_connections` threads"""
+        with self._updates_condition:
+            if self._webhook_url:
+                return
+            self._webhook_url = url
+            self._webhook_secret_token = secret_token
+        for i in range(max_connections):
+            threading.Thread(target=self._webhook_worker, name=f"FakeTelegramWebhook-{i}", daemon=True).start()
+        self.webhook_set.set()
+
+    def _webhook_worker(self):
+        while True:
+            update = self._webhook_updates.get()
+            request = urllib.request.Request(
+                url=self._webhook_url,
+                data=json.dumps(update).encode(),
+                headers={"Content-Type": "application/json"},
+                method="POST",
+            )
+            if self._webhook_secret_token:
+                request.add_header("X-Telegram-Bot-Api-Secret-Token", self._webhook_secret_token)
+            try:
+                with urllib.request.urlopen(request, timeout=10):
+                    pass
+            except Exception:
+                # as Telegram, retry the delivery later
+                with self._lock:
+                    self.webhook_deliveries_failed += 1
+                time.sleep(1)
+                self._webhook_updates.put(update)
+
+    def get_updates(self, offset: int, timeout: float) -> List[dict]:
+        self.polling.set()
+        deadline = time.time() + timeout
+        with self._updates_condition:
+            # confirmed updates (below offset) are discarded
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            while not self._updates and time.time() < deadline:
+                self._updates_condition.wait(deadline - time.time())
+            return list(self._updates[:100])
+
+    def count_method(self, method: str, toomanyrequests: bool):
+        with self._lock:
+            self.methods_count[method] += 1
+            if toomanyrequests:
+                self.toomanyrequests_responses += 1
+
+    @property
+    def stats(self) -> dict:
+        return dict(
+            methods=dict(self.methods_count),
+            toomanyrequests_responses=self.toomanyrequests_responses,
+            webhook_deliveries_failed=self.webhook_deliveries_failed,
+        )
+
+
+class _FakeTelegramHandler(_FakeHandler):
+    server: FakeTelegramServer
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        body = self._read_body()
+        url = urlsplit(self.path)
+        method = url.path.rsplit("/", 1)[-1]
+        # pyTelegramBotAPI sends the params on the query string (and files as multipart);
+        # the async pyTelegramBotAPI (aiohttp) sends them on the body, urlencoded or multipart
+        params = dict(parse_qsl(url.query))
+        content_type = self.headers.get("Content-Type", "")
+        if body and content_type.startswith("application/x-www-form-urlencoded"):
+            params.update(parse_qsl(body.decode()))
+        elif body and content_type.startswith("multipart/form-data"):
+            params.update(self._parse_multipart(body, content_type))
+
+        if method == "getUpdates":
+            updates = self.server.get_updates(
+                offset=int(params.get("offset", 0)),
+                timeout=float(params.get("timeout", 0)),
+            )
+            self._reply_json(200, dict(ok=True, result=updates))
+            return
+        if method == "setWebhook":
+            self.server.set_webhook(
+                url=params["url"],
+                secret_token=params.get("secret_token"),
+                max_connections=int(params.get("max_connections", 40)),
+            )
+
+        time.sleep(self.server.latency)
+        toomanyrequests = method.startswith("send") and random.random() < self.server.toomanyrequests_ratio
+        self.server.count_method(method, toomanyrequests)
+        if toomanyrequests:
+            self._reply_json(429, dict(
+                ok=False,
+                error_code=429,
+                description=f"Too Many Requests: retry after {self.server.retry_after}",
+                parameters=dict(retry_after=self.server.retry_after),
+            ))
+            return
+
+        self._reply_json(200, dict(ok=True, result=self._get_result(method, params)))
+        if params.get("reply_to_message_id") and self.server.on_reply:
+            self.server.on_reply(method, params)
+
+    @staticmethod
+    def _parse_multipart(body: bytes, content_type: str) -> Dict[str, str]:
+        """Return the text fields of a multipart/form-data body (files are ignored)"""
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        fields = dict()
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if name and not part.get_filename():
+                fields[name] = part.get_content() if part.get_content_maintype() == "text" else \
+                    part.get_payload(decode=True).decode()
+        return fields
+
+    def _get_result(self, method: str, params: dict):
+        if method == "getMe":
+            return dict(id=1, is_bot=True, first_name="FakeBot", username="fake_bot")
+        if method in ("sendMessage", "sendPhoto"):
+            return self._get_message(params, photo=method == "sendPhoto")
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            return [self._get_message(params, photo=True) for _ in media]
+        return True
+
+    def _get_message(self, params: dict, photo: bool) -> dict:
+        chat_id = int(params.get("chat_id", 0))
+        message = dict(
+            message_id=self.server.next_message_id(),
+            date=int(time.time()),
+            chat=dict(id=chat_id, type="private", first_name="Load"),
+        )
+        if photo:
+            file_id = f"fake-{message['message_id']}"
+            message["photo"] = [dict(file_id=file_id, file_unique_id=file_id, width=256, height=256)]
+        else:
+            message["text"] = params.get("text", "")
+        return message
@@ -0,0 +1,237 @@
+"""End-to-end load test of the bot, against local fake Telegram Bot API and DALLE servers.
+The bot (BotBackend, configured from the environment as usual, pointing to the fakes) runs on a subprocess,
+which samples its threads count and RSS. The main process sends the /generate requests as Telegram updates,
+at the given rate, and measures the latency until each request is replied with the images (or an error).
+The results are printed as a single JSON line (and optionally written to a file) for comparing runs across commits.
+With --webhook, the bot receives the updates on its webhook server, POSTed by the fake Telegram, instead of polling.
+With --check, the exit code is 1 if any request was not replied (e.g. for checking the async mode with --async).
+
+Usage: python -m benchmarks.loadtest [--requests 200] [--rate 20] [--chats 50] [--dalle-latency-ms 2000]
+                                     [--async | --webhook] [--check] [--env KEY=VALUE] [--output results.json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+from dalle_telegram_bot.services.bot import constants
+from .fakes import FakeDalleServer, FakeTelegramServer
+
+# replies sent while the request is still in progress; any other reply completes the request
+PROGRESS_REPLIES = {constants.COMMAND_GENERATE_REPLY_GENERATING, constants.COMMAND_GENERATE_REPLY_QUEUED}
+SUCCESS_METHODS = {"sendMediaGroup", "sendPhoto"}
+
+
+class RequestsTracker:
+    """Track the requests sent to the bot, and their completion time, from the replies received by the fake Telegram"""
+
+    def __init__(self):
+        self._sent: Dict[int, float] = dict()  # message_id: timestamp
+        self._completed: Dict[int, float] = dict()
+        self._failed: Dict[int, float] = dict()
+        self._lock = threading.Lock()
+        self._all_completed = threading.Event()
+        self._expected = 0
+
+    def expect(self, count: int):
+        self._expected = count
+
+    def sent(self, message_id: int):
+        with self._lock:
+            self._sent[message_id] = time.monotonic()
+
+    def on_reply(self, method: str, params: dict):
+        if method not in SUCCESS_METHODS and params.get("text") in PROGRESS_REPLIES:
+            return
+
+        message_id = int(params["reply_to_message_id"])
+        with self._lock:
+            if message_id not in self._sent or message_id in self._completed or message_id in self._failed:
+                return
+            target = self._completed if method in SUCCESS_METHODS else self._failed
+            target[message_id] = time.monotonic()
+            if len(self._completed) + len(self._failed) >= self._expected:
+                self._all_completed.set()
+
+    def wait(self, timeout: float) -> bool:
+        return self._all_completed.wait(timeout)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            latencies = sorted(completed - self._sent[message_id] for message_id, completed in self._completed.items())
+            last_completion = max([*self._completed.values(), *self._failed.values()], default=None)
+            first_sent = min(self._sent.values(), default=None)
+
+        elapsed = (last_completion - first_sent) if last_completion and first_sent else None
+        return dict(
+            requests_sent=len(self._sent),
+            requests_completed=len(latencies),
+            requests_failed=len(self._failed),
+            requests_pending=len(self._sent) - len(latencies) - len(self._failed),
+            throughput_per_second=round(len(latencies) / elapsed, 3) if elapsed else None,
+            latency_p50_seconds=percentile(latencies, 50),
+            latency_p95_seconds=percentile(latencies, 95),
+            latency_p99_seconds=percentile(latencies, 99),
+            latency_max_seconds=round(latencies[-1], 3) if latencies else None,
+        )
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))], 3)
+
+
+def run_bot(env: Dict[str, str], stop_event: multiprocessing.Event, results: multiprocessing.Queue):
+    """Bot subprocess: run the BotBackend until the stop event, sampling its threads and RSS"""
+    os.environ.update(env)
+    # imported after setting the environment
+    from dalle_telegram_bot.entrypoint import BotBackend
+
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_threads = 0
+
+    app = BotBackend()
+    app.setup()
+    app.start()
+    try:
+        while not stop_event.wait(0.1):
+            peak_threads = max(peak_threads, threading.active_count())
+    finally:
+        app.teardown()
+
+    results.put(dict(
+        peak_threads=peak_threads,
+        peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        peak_rss_growth_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start,
+    ))
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL)
+        return output.decode().strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200, help="total /generate requests")
+    parser.add_argument("--rate", type=float, default=20, help="requests sent per second")
+    parser.add_argument("--chats", type=int, default=50, help="distinct chats sending the requests")
+    parser.add_argument("--repeated-prompts-ratio", type=float, default=0, help="ratio of requests with a repeated prompt")
+    parser.add_argument("--dalle-latency-ms", type=float, default=2000)
+    parser.add_argument("--dalle-unavailable-ratio", type=float, default=0.2, help="ratio of DALLE requests failed with 503")
+    parser.add_argument("--telegram-latency-ms", type=float, default=50)
+    parser.add_argument("--telegram-toomanyrequests-ratio", type=float, default=0.01,
+                        help="ratio of Telegram send* requests failed with 429")
+    parser.add_argument("--timeout", type=float, default=300, help="max time waiting for the requests to complete")
+    parser.add_argument("--env", action="append", default=[], help="extra bot setting, as KEY=VALUE (repeatable)")
+    parser.add_argument("--async", dest="run_async", action="store_true", help="run the async bot (TELEGRAM_BOT_ASYNC)")
+    parser.add_argument("--webhook", action="store_true", help="receive the updates via webhook, instead of polling")
+    parser.add_argument("--check", action="store_true", help="exit with code 1 if any request was not replied")
+    parser.add_argument("--output", help="file where to write the JSON results")
+    args = parser.parse_args()
+    if args.run_async and args.webhook:
+        parser.error("the async bot does not support webhook")
+
+    tracker = RequestsTracker()
+    tracker.expect(args.requests)
+    dalle_server = FakeDalleServer(
+        latency=args.dalle_latency_ms / 1000,
+        unavailable_ratio=args.dalle_unavailable_ratio,
+    )
+    telegram_server = FakeTelegramServer(
+        latency=args.telegram_latency_ms / 1000,
+        toomanyrequests_ratio=args.telegram_toomanyrequests_ratio,
+        on_reply=tracker.on_reply,
+    )
+    dalle_server.start()
+    telegram_server.start()
+
+    env = dict(
+        TELEGRAM_BOT_TOKEN="123456:loadtest",
+        TELEGRAM_BOT_API_URL=telegram_server.api_url,
+        DALLE_API_URL=dalle_server.url,
+        DALLE_GENERATION_RETRY_DELAY_SECONDS="0.5",
+        COMMAND_GENERATE_CHAT_CONCURRENT_LIMIT=str(args.requests),
+        LOG_LEVEL="WARNING",
+        REDIS_HOST="",
+    )
+    if args.run_async:
+        env["TELEGRAM_BOT_ASYNC"] = "1"
+    if args.webhook:
+        webhook_port = get_free_port()
+        env.update(
+            TELEGRAM_BOT_WEBHOOK_URL=f"http://127.0.0.1:{webhook_port}/webhook",
+            TELEGRAM_BOT_WEBHOOK_LISTEN_HOST="127.0.0.1",
+            TELEGRAM_BOT_WEBHOOK_LISTEN_PORT=str(webhook_port),
+            TELEGRAM_BOT_WEBHOOK_SECRET_TOKEN="loadtest",
+        )
+    env.update(dict(kv.split("=", 1) for kv in args.env))
+
+    stop_event = multiprocessing.Event()
+    bot_results = multiprocessing.Queue()
+    bot_process = multiprocessing.Process(target=run_bot, args=(env, stop_event, bot_results))
+    bot_process.start()
+
+    try:
+        bot_ready = telegram_server.webhook_set if args.webhook else telegram_server.polling
+        if not bot_ready.wait(60):
+            raise TimeoutError("Bot did not start receiving updates")
+
+        for i in range(args.requests):
+            repeated = i and (i % 100) < args.repeated_prompts_ratio * 100
+            prompt = f"load test prompt {0 if repeated else i}"
+            message_id = telegram_server.push_message(chat_id=1000 + i % args.chats, text=f"/generate {prompt}")
+            tracker.sent(message_id)
+            time.sleep(1 / args.rate)
+
+        tracker.wait(args.timeout)
+    finally:
+        stop_event.set()
+        try:
+            bot_stats = bot_results.get(timeout=120)
+        except queue.Empty:
+            bot_stats = dict()
+        bot_process.join()
+
+    results = dict(
+        commit=get_git_commit(),
+        args=vars(args),
+        **tracker.get_stats(),
+        **bot_stats,
+        dalle=dalle_server.stats,
+        telegram=telegram_server.stats,
+    )
+    dalle_server.stop()
+    telegram_server.stop()
+
+    output = json.dumps(results)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    if args.check and (results["requests_pending"] or results["requests_completed"] + results["requests_failed"] == 0):
+        print("Check failed: not all the requests were replied", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
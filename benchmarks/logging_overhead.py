@@ -0,0 +1,142 @@
+"""Microbenchmark of the logging cost per generate request.
+Each simulated request emits the same log records as a generate request on the bot (request context, DALLE requests
+and retries, chat actions, Telegram API sessions), with no I/O besides logging. Modes:
+- legacy: records always built (bind/contextualize), with a serialized custom sink registered even if disabled
+  (as the Redis logger was, without REDIS_HOST)
+- current: records of disabled levels are not built (`should_log`), and disabled sinks are not registered
+- sampled: current, plus LOG_SAMPLING rates for the high-volume events
+The console sink writes to /dev/null.
+
+Usage: python -m benchmarks.logging_overhead [--requests 2000] [--chat-actions 20] [--dalle-attempts 10]
+                                              [--log-level INFO] [--sampling "chat_action 0.1,session 0.1"]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import threading
+import time
+
+from dalle_telegram_bot.logger import logger, setup_logger, should_log, LoggerFormat
+from dalle_telegram_bot.services.logger_abc import AbstractLogger
+from dalle_telegram_bot.settings import Settings
+
+
+class CountingLogger(AbstractLogger):
+    """Custom sink discarding the records, only counting them"""
+
+    def __init__(self, enabled: bool):
+        self._enabled = enabled
+        self.count = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    def log(self, data: str):
+        self.count += 1
+
+
+def simulate_request_legacy(args: argparse.Namespace):
+    with logger.contextualize(request_id="request"):
+        logger.bind(chat_id=1, thread_name=threading.current_thread().name).info("Request started")
+        logger.bind(cmd="/generate").info("Request is Generate command")
+        with logger.contextualize(prompt_length=20):
+            logger.debug("Generate command prompt is valid")
+
+        for _ in range(args.dalle_attempts):
+            logger.debug("Requesting DALLE...")
+            logger.bind(status_code=503, backend="http://dalle").debug("DALLE response received")
+            logger.bind(retry_delay=round(1.2345, 3)).trace("Waiting before retrying DALLE request")
+
+        for _ in range(args.chat_actions):
+            with logger.contextualize(request_id="request", chat_id=1, chat_action="typing"):
+                logger.trace("Sending chat action...")
+                logger.debug("Chat action sent")
+
+        for _ in range(args.sessions):
+            logger.trace("New requests.Session created")
+            logger.bind(healthy=True).trace("Stopping requests.Session")
+
+        logger.bind(request_duration=1.2345).info("Request completed")
+
+
+def simulate_request(args: argparse.Namespace):
+    with logger.contextualize(request_id="request"):
+        if should_log("INFO", "request"):
+            logger.bind(chat_id=1, thread_name=threading.current_thread().name).info("Request started")
+        logger.bind(cmd="/generate").info("Request is Generate command")
+        with logger.contextualize(prompt_length=20):
+            logger.debug("Generate command prompt is valid")
+
+        for _ in range(args.dalle_attempts):
+            if should_log("DEBUG", "dalle_request"):
+                logger.debug("Requesting DALLE...")
+            if should_log("DEBUG", "dalle_request"):
+                logger.bind(status_code=503, backend="http://dalle").debug("DALLE response received")
+            if should_log("TRACE", "dalle_request"):
+                logger.bind(retry_delay=round(1.2345, 3)).trace("Waiting before retrying DALLE request")
+
+        for _ in range(args.chat_actions):
+            if should_log("DEBUG", "chat_action"):
+                logger.bind(request_id="request", chat_id=1, chat_action="typing").debug("Chat action sent")
+
+        for _ in range(args.sessions):
+            if should_log("TRACE", "session"):
+                logger.trace("New requests.Session created")
+            if should_log("TRACE", "session"):
+                logger.bind(healthy=True).trace("Stopping requests.Session")
+
+        logger.bind(request_duration=1.2345).info("Request completed")
+
+
+def run_mode(mode: str, args: argparse.Namespace, devnull) -> dict:
+    custom_logger = CountingLogger(enabled=False)
+    settings = Settings(
+        telegram_bot_token="benchmark",
+        log_level=args.log_level,
+        log_sampling=args.sampling if mode == "sampled" else None,
+    )
+
+    with contextlib.redirect_stderr(devnull):
+        # the console sink is added on sys.stderr
+        setup_logger(settings=settings, loggers=[custom_logger])
+    if mode == "legacy":
+        logger.remove()
+        logger.add(devnull, level=args.log_level.upper(), format=LoggerFormat)
+        logger.add(custom_logger.log, level=custom_logger.level, serialize=True)
+
+    simulate = simulate_request_legacy if mode == "legacy" else simulate_request
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        simulate(args)
+    elapsed = time.perf_counter() - start
+
+    return dict(
+        mode=mode,
+        log_level=args.log_level,
+        requests=args.requests,
+        us_per_request=round(elapsed / args.requests * 1_000_000, 1),
+        custom_sink_records=custom_logger.count,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--chat-actions", type=int, default=20, help="chat actions sent per request")
+    parser.add_argument("--dalle-attempts", type=int, default=10, help="DALLE requests per generation")
+    parser.add_argument("--sessions", type=int, default=2, help="Telegram API sessions created per request")
+    parser.add_argument("--log-level", default="INFO")
+    parser.add_argument("--sampling", default="request 0.1,chat_action 0.1,session 0.1,dalle_request 0.1")
+    args = parser.parse_args()
+
+    with open(os.devnull, "w") as devnull:
+        for mode in ("legacy", "current", "sampled"):
+            result = run_mode(mode, args, devnull)
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
 import signal
 from threading import Event, Lock
+from typing import Optional, Union
 
-from .services.bot import Bot
-from .services.dalle import Dalle
+from .services.bot import Bot, AsyncBot
+from .services.dalle import Dalle, AsyncDalle, DalleCache, GenerationsIndex, PromptPopularity, Prewarmer
+from .services.images import ImagePostProcessor
+from .services.jobs import JobQueue, AbstractGenerationJournal, get_generation_journal
 from .services.redis import Redis
+from .services.redis_logs import RedisLogShipper
+from .services.metrics import start_metrics_server
 from .settings import Settings
 from .logger import logger, setup_logger
 
@@ -11,8 +16,15 @@ from .logger import logger, setup_logger
 class BotBackend:
     settings: Settings
     redis: Redis
-    dalle: Dalle
-    bot: Bot
+    log_shipper: RedisLogShipper
+    dalle_cache: DalleCache
+    generations_index: GenerationsIndex
+    image_postprocessor: ImagePostProcessor
+    job_queue: JobQueue
+    journal: Optional[AbstractGenerationJournal]
+    dalle: Union[Dalle, AsyncDalle]
+    prewarmer: Optional[Prewarmer]
+    bot: Union[Bot, AsyncBot]
     _teardown_event: Event
     _teardown_lock: Lock
 
@@ -24,23 +36,109 @@ class BotBackend:
         self.redis = Redis(
             settings=self.settings,
         )
+        self.log_shipper = RedisLogShipper(
+            settings=self.settings,
+            redis=self.redis,
+        )
         setup_logger(
             settings=self.settings,
-            loggers=[self.redis],
+            loggers=[self.log_shipper],
         )
         logger.debug("Initializing app...")
 
-        self.dalle = Dalle(
+        self.dalle_cache = DalleCache(
+            settings=self.settings,
+            redis=self.redis,
+        )
+        self.generations_index = GenerationsIndex(
+            settings=self.settings,
+            redis=self.redis,
+        )
+        self.image_postprocessor = ImagePostProcessor(
+            settings=self.settings,
+        )
+        self.job_queue = JobQueue(
+            settings=self.settings,
+            redis=self.redis,
+        )
+        self.journal = get_generation_journal(
+            settings=self.settings,
+            redis=self.redis,
+        )
+        self._check_settings()
+        popularity = PromptPopularity(
+            settings=self.settings,
+            redis=self.redis,
+        ) if self._prewarm_enabled() else None
+        dalle_cls, bot_cls = (AsyncDalle, AsyncBot) if self.settings.telegram_bot_async else (Dalle, Bot)
+        self.dalle = dalle_cls(
             settings=self.settings,
+            cache=self.dalle_cache,
+            popularity=popularity,
         )
-        self.bot = Bot(
+        self.prewarmer = Prewarmer(
+            settings=self.settings,
+            # prewarm requests are threaded, so the async bot requires its own client
+            dalle=self.dalle if isinstance(self.dalle, Dalle) else Dalle(
+                settings=self.settings,
+                cache=self.dalle_cache,
+            ),
+            popularity=popularity,
+            users_dalle=self.dalle,
+        ) if popularity else None
+        self.bot = bot_cls(
             settings=self.settings,
             dalle=self.dalle,
+            dalle_cache=self.dalle_cache,
+            image_postprocessor=self.image_postprocessor if self.image_postprocessor.enabled else None,
+            redis=self.redis,
+            generations_index=self._get_generations_index(),
+            **self._get_bot_extra_kwargs(),
         )
         logger.debug("App initialized")
 
+    def _check_settings(self):
+        """Fail on settings of features not supported by the configured bot"""
+        if not self.settings.telegram_bot_async:
+            return
+
+        unsupported = list()
+        if self.settings.telegram_bot_webhook_url:
+            unsupported.append("TELEGRAM_BOT_WEBHOOK_URL")
+        if self.job_queue.enabled:
+            unsupported.append("REDIS_JOBS_QUEUE_NAME")
+        if self.journal:
+            unsupported.append("REDIS_JOURNAL_KEY" if self.settings.redis_journal_key else "JOURNAL_FILE_PATH")
+        if unsupported:
+            raise ValueError(f"TELEGRAM_BOT_ASYNC does not support {', '.join(unsupported)}")
+
+    def _prewarm_enabled(self) -> bool:
+        """Prewarming requires the DALLE cache.
+        With the jobs queue, generations are requested (and prewarmed) by the workers."""
+        return self.settings.prewarm_budget_per_hour > 0 and self.dalle_cache.enabled and not self.job_queue.enabled
+
+    def _get_generations_index(self) -> Optional[GenerationsIndex]:
+        """Return the generations index for inline queries, loaded, if enabled"""
+        if not self.generations_index.enabled:
+            return None
+        self.generations_index.load()
+        return self.generations_index
+
+    def _get_bot_extra_kwargs(self) -> dict:
+        """Return the arguments for features only supported by the threaded bot"""
+        kwargs = dict()
+        if self.settings.telegram_bot_async:
+            return kwargs
+
+        if self.job_queue.enabled:
+            kwargs["job_queue"] = self.job_queue
+        elif self.journal:
+            kwargs["journal"] = self.journal
+        return kwargs
+
     def run(self):
         try:
+            start_metrics_server(self.settings)
             self.start()
             self.wait_for_end()
         finally:
@@ -57,21 +155,54 @@ class BotBackend:
             try:
                 self.stop()
             finally:
+                self._teardown_log_shipper()
                 self._teardown_event.set()
 
+    def _teardown_log_shipper(self):
+        if not self.log_shipper.enabled:
+            return
+        logger.bind(**self.log_shipper.stats).info("Redis log shipping stats")
+        self.log_shipper.teardown()
+
+    def _stop_prewarmer(self):
+        if not self.prewarmer:
+            return
+        self.prewarmer.stop()
+        logger.bind(**self.prewarmer.stats).info("DALLE prewarmer stats")
+        if self.prewarmer.dalle is not self.dalle:
+            self.prewarmer.dalle.close()
+
     def start(self):
         logger.debug("Running app...")
         self.bot.setup()
         self.bot.start()
+        if isinstance(self.bot, Bot):
+            self.bot.replay_journal()
+        if self.prewarmer:
+            self.prewarmer.start()
 
     def stop(self):
         logger.info("Stopping app...")
         self.bot.stop()
+        if self.journal:
+            self.journal.close()
+        self._stop_prewarmer()
+        if isinstance(self.dalle, Dalle):
+            self.dalle.close()
+        logger.bind(**self.dalle_cache.stats).info("DALLE cache stats")
+        logger.bind(backends=self.dalle.backends_stats).info("DALLE backends stats")
+        if self.image_postprocessor.enabled:
+            logger.bind(**self.image_postprocessor.stats).info("Images post-processing stats")
         logger.info("App stopped!")
 
 
 def main():
-    app = BotBackend()
+    if Settings().app_mode == "worker":
+        # imported here to avoid a circular import
+        from .worker import WorkerBackend
+        app = WorkerBackend()
+    else:
+        app = BotBackend()
     app.setup()
 
     signal.signal(signal.SIGINT, app.teardown)
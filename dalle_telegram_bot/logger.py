@@ -1,6 +1,7 @@
 import sys
+import itertools
 import contextlib
-from typing import Collection, Optional
+from typing import Collection, Dict, Iterator, Optional
 
 from loguru import logger
 # noinspection PyProtectedMember
@@ -9,7 +10,7 @@ from loguru._logger import context as loguru_context
 from .settings import Settings
 from .services.logger_abc import AbstractLogger
 
-__all__ = ("logger", "setup_logger", "get_request_id")
+__all__ = ("logger", "setup_logger", "should_log", "get_request_id")
 
 
 LoggerFormat = "<green>{time:YY-MM-DD HH:mm:ss}</green> | " \
@@ -17,18 +18,49 @@ LoggerFormat = "<green>{time:YY-MM-DD HH:mm:ss}</green> | " \
                "{function}: <level>{message}</level> | " \
                "{extra} {exception}"
 
+_LEVELS = ("TRACE", "DEBUG", "INFO", "SUCCESS", "WARNING", "ERROR", "CRITICAL")
+_levels_no: Dict[str, int] = dict()
+_min_level_no = 0
+_sampling_every: Dict[str, int] = dict()  # event: log 1 of each N records (0: never)
+_sampling_counters: Dict[str, Iterator[int]] = dict()
+
 
 def setup_logger(settings: Settings, loggers: Collection[AbstractLogger]):
+    global _min_level_no
     logger.remove()
-    logger.add(sys.stderr, level=settings.log_level.upper(), format=LoggerFormat)
+    levels = [settings.log_level.upper()]
+    logger.add(sys.stderr, level=levels[0], format=LoggerFormat)
 
     for custom_logger in (loggers or []):
+        if not custom_logger.enabled:
+            # not registered, so records are never serialized for it
+            continue
         logger.add(
             custom_logger.log,
-            level="TRACE",
-            enqueue=True,
+            level=custom_logger.level,
             serialize=True,  # record provided as JSON string to the handler
         )
+        levels.append(custom_logger.level)
+
+    _levels_no.update({level: logger.level(level).no for level in _LEVELS})
+    _min_level_no = min(logger.level(level).no for level in levels)
+    _sampling_every.clear()
+    _sampling_counters.clear()
+    for event, rate in settings.log_sampling_rates.items():
+        _sampling_every[event] = max(1, round(1 / rate)) if rate > 0 else 0
+        _sampling_counters[event] = itertools.count()
+
+
+def should_log(level: str, event: Optional[str] = None) -> bool:
+    """Return whether a record would be emitted: its level is accepted by any sink, and, for high-volume events
+    with a sampling rate configured (LOG_SAMPLING), the record is sampled.
+    Used on hot paths for skipping the cost of building records (bind/contextualize) that would be discarded."""
+    if _levels_no.get(level, 0) < _min_level_no:
+        return False
+    every = _sampling_every.get(event)
+    if every is None:
+        return True
+    return every > 0 and next(_sampling_counters[event]) % every == 0
 
 
 def get_request_id() -> Optional[str]:
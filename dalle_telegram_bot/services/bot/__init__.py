@@ -1 +1,2 @@
 from .bot import Bot
+from .bot_async import AsyncBot
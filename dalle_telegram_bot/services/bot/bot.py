@@ -1,33 +1,126 @@
 import contextlib
-from threading import Thread
-from typing import Optional
+import time
+from threading import Thread, Event
+from typing import Optional, List
 
 import telebot
-from telebot.types import Message, InputMediaPhoto, BotCommand
+from telebot.types import Message, InputMediaPhoto, BotCommand, InlineQuery, InlineQueryResultCachedPhoto
 
 from . import constants
 from .requester import TelegramBotAPIRequester
+from .webhook import WebhookServer
+from .dispatcher import BoundedExecutor
 from .chatactions import ActionManager
-from .middlewares import request_middleware, message_request_middleware, RateLimiter
-from ..dalle import Dalle, DalleTemporarilyUnavailableException
+from .scheduler import GenerationScheduler
+from .ratelimit import RequestRateLimiter, get_concurrency_limiter
+from .middlewares import request_middleware, message_request_middleware
+from .. import metrics
+from ..dalle import Dalle, DalleCache, DalleTemporarilyUnavailableException, GenerationsIndex
 from ..dalle.models import DalleResponse
+from ..images import ImagePostProcessor
+from ..redis import Redis
+from ..jobs import JobQueue, GenerationJob, GenerationJobStatus, AbstractGenerationJournal, PendingJobs
 from ...settings import Settings
-from ...logger import logger
+from ...logger import logger, get_request_id
+from ...utils import get_uuid, exception_is_bot_blocked_by_user
 
 
 class Bot:
-    def __init__(self, settings: Settings, dalle: Dalle):
+    def __init__(
+            self,
+            settings: Settings,
+            dalle: Dalle,
+            dalle_cache: Optional[DalleCache] = None,
+            image_postprocessor: Optional[ImagePostProcessor] = None,
+            redis: Optional[Redis] = None,
+            job_queue: Optional[JobQueue] = None,
+            journal: Optional[AbstractGenerationJournal] = None,
+            generations_index: Optional[GenerationsIndex] = None,
+    ):
         self._settings = settings
         self._dalle = dalle
+        self._dalle_cache = dalle_cache
+        self._generations_index = generations_index
+        self._image_postprocessor = image_postprocessor
+        self._journal = journal
         self._polling_thread = None
 
+        # distributed mode: generations are queued as jobs, for the DALLE workers
+        self._job_queue = job_queue
+        self._job_results_queue_name = None
+        self._job_results_thread = None
+        self._jobs_pending = PendingJobs(timeout=self._settings.jobs_result_timeout_seconds)
+        self._stop_event = Event()
+        if self._job_queue:
+            self._job_results_queue_name = self._job_queue.get_results_queue_name(
+                frontend_id=self._settings.jobs_frontend_id or get_uuid(),
+            )
+
+        if self._settings.telegram_bot_api_url:
+            telebot.apihelper.API_URL = self._settings.telegram_bot_api_url.rstrip("/") + "/bot{0}/{1}"
+
+        self._webhook_server = None
+        if self._settings.telegram_bot_webhook_url:
+            self._webhook_server = WebhookServer(
+                settings=self._settings,
+                dispatcher=lambda update: self._bot.process_new_updates([update]),
+            )
+
+        # updates are handled by the executors below (the TeleBot handlers only route them), so that
+        # instant replies never wait behind generate requests, and these never wait behind results delivery
+        self._instant_executor = BoundedExecutor(
+            name="instant",
+            threads=self._settings.telegram_bot_instant_threads,
+            queue_size=self._settings.telegram_bot_instant_queue_size,
+        )
+        self._generate_executor = BoundedExecutor(
+            name="generate",
+            threads=self._settings.telegram_bot_threads,
+            queue_size=self._settings.telegram_bot_generate_queue_size,
+        )
+        self._process_executor = self._upload_executor = self._cleanup_executor = None
+        if not self._job_queue:
+            # generate requests are pipelined: after the DALLE request (on the generate executor), the stages of
+            # post-processing, upload and cleanup run on their own executors, so each stage is never held by the others.
+            # Stages queues are blocking: when a stage falls behind, the previous one waits (backpressure).
+            self._process_executor = BoundedExecutor(
+                name="process",
+                threads=self._settings.command_generate_process_threads,
+                queue_size=self._settings.command_generate_stages_queue_size,
+                block=True,
+            )
+            self._upload_executor = BoundedExecutor(
+                name="upload",
+                threads=self._settings.command_generate_upload_threads,
+                queue_size=self._settings.command_generate_stages_queue_size,
+                block=True,
+            )
+            self._cleanup_executor = BoundedExecutor(
+                name="cleanup",
+                threads=self._settings.command_generate_cleanup_threads,
+                queue_size=self._settings.command_generate_stages_queue_size,
+                block=True,
+            )
+
+        self._delivery_executor = None
+        if self._job_queue:
+            # job results are never rejected: when the queue is full, results are not fetched until there is room
+            self._delivery_executor = BoundedExecutor(
+                name="delivery",
+                threads=self._settings.jobs_delivery_threads,
+                queue_size=self._settings.jobs_delivery_queue_size,
+                block=True,
+            )
+
         self._bot = telebot.TeleBot(
             token=self._settings.telegram_bot_token,
             parse_mode="HTML",
-            threaded=True,
-            num_threads=settings.telegram_bot_threads,
+            threaded=False,
         )
-        self._bot.message_handler(func=lambda message: True)(self._handler_message_entrypoint)
+        self._bot.message_handler(func=lambda message: True)(self._handler_message_dispatch)
+        if self._generations_index:
+            self._bot.inline_handler(func=lambda query: True)(self._handler_inline_query_dispatch)
+        metrics.HANDLER_THREADS.set(self._instant_executor.threads + self._generate_executor.threads)
 
         self._generating_bot_action = ActionManager(
             action=self._settings.command_generate_action,
@@ -35,30 +128,56 @@ class Bot:
             settings=self._settings,
             timeout=self._settings.dalle_generation_timeout_seconds,
         )
-        self._dalle_generate_rate_limiter = RateLimiter(
-            limit_per_chat=self._settings.command_generate_chat_concurrent_limit,
+        self._dalle_generate_rate_limiter = get_concurrency_limiter(
+            settings=self._settings,
+            redis=redis,
+        )
+        self._dalle_generate_request_rate_limiter = RequestRateLimiter(
+            settings=self._settings,
+            redis=redis,
         )
+        self._dalle_scheduler = None
+        if self._settings.dalle_generation_concurrent_limit > 0:
+            self._dalle_scheduler = GenerationScheduler(
+                concurrent_limit=self._settings.dalle_generation_concurrent_limit,
+            )
 
         self._requester = None
-        if self._settings.telegram_bot_ratelimit_retry:
+        if self._settings.telegram_bot_ratelimit_retry or self._settings.telegram_bot_outbound_governor:
             self._requester = TelegramBotAPIRequester(
                 settings=self._settings,
             )
 
     def setup(self):
-        """Perform initial setup (delete webhook, set commands)"""
-        if self._settings.telegram_bot_delete_webhook:
+        """Perform initial setup (set or delete webhook, set commands)"""
+        if self._webhook_server:
+            self.set_webhook()
+        elif self._settings.telegram_bot_delete_webhook:
             self.delete_webhook()
         if self._settings.telegram_bot_set_commands:
             self.set_commands()
 
     def start(self):
-        """Run the bot in background, by starting a thread running the `run` method."""
+        """Run the bot in background, by starting a thread running the `run` method,
+        or the webhook server, if using Webhook."""
         if self._polling_thread:
             return
 
-        if self._requester:
-            self._requester.start()
+        self.start_delivery()
+        for executor in self.__get_executors():
+            executor.start()
+        if self._delivery_executor:
+            self._job_results_thread = Thread(
+                target=self._job_results_worker,
+                name="TelegramBot-JobResultsConsumer",
+                daemon=True,
+            )
+            self._job_results_thread.start()
+
+        if self._webhook_server:
+            logger.info("Running bot with Webhook")
+            self._webhook_server.start()
+            return
 
         self._polling_thread = Thread(
             target=self.run,
@@ -85,9 +204,33 @@ class Bot:
         else:
             self._stop_force()
 
+        self._stop_event.set()
+        # executors are stopped in order of the pipeline, so the tasks handed over by the previous stages are completed
+        for executor in self.__get_executors():
+            executor.shutdown(wait=graceful_shutdown)
+        self._generating_bot_action.teardown()
+        self.stop_delivery()
+
+    def start_delivery(self):
+        """Start only the components required for sending generated images (`send_generated_images`),
+        without handling updates. Used by the workers."""
+        if self._requester:
+            self._requester.start()
+
+    def stop_delivery(self):
+        if self._image_postprocessor:
+            self._image_postprocessor.teardown()
         if self._requester:
             self._requester.teardown()
 
+    def __get_executors(self) -> List[BoundedExecutor]:
+        executors = [
+            self._instant_executor, self._generate_executor,
+            self._process_executor, self._upload_executor, self._cleanup_executor,
+            self._delivery_executor,
+        ]
+        return [executor for executor in executors if executor]
+
     def set_commands(self):
         logger.debug("Setting bot commands...")
         self._bot.set_my_commands([
@@ -96,6 +239,15 @@ class Bot:
         ])
         logger.info("Bot commands set")
 
+    def set_webhook(self):
+        logger.info("Setting bot webhook...")
+        self._bot.set_webhook(
+            url=self._settings.telegram_bot_webhook_url,
+            secret_token=self._settings.telegram_bot_webhook_secret_token,
+            max_connections=self._settings.telegram_bot_webhook_max_connections,
+        )
+        logger.info("Webhook set")
+
     def delete_webhook(self):
         logger.info("Deleting bot webhook...")
         self._bot.delete_webhook()
@@ -103,15 +255,51 @@ class Bot:
 
     def _stop_force(self):
         logger.info("Stopping bot polling (force-stop)...")
+        if self._webhook_server:
+            self._webhook_server.stop(wait_pending=False)
         self._bot.stop_polling()
         logger.info("Bot stopped")
 
     def _stop_gracefully(self):
         logger.info("Stopping bot gracefully (waiting for pending requests to end, not accepting new requests)...")
-        # stop_bot() waits for remaining requests to complete
+        if self._webhook_server:
+            self._webhook_server.stop(wait_pending=True)
         self._bot.stop_bot()
+        # remaining requests are waited for when shutting down the executors
         logger.info("Bot stopped")
 
+    def _handler_message_dispatch(self, message: Message):
+        """Route a message to the executor of its class: generate requests (which may wait for DALLE for minutes)
+        or instant replies. If the executor queue is full, the message is rejected.
+        Runs on the polling (or webhook) thread, so it must never raise: that would drop the rest of the updates batch.
+        Messages without text (photos, stickers, service messages...) are ignored."""
+        try:
+            if message.text is None:
+                return
+
+            if message.text.startswith(constants.COMMAND_GENERATE):
+                if self._generate_executor.submit(self._handler_message_entrypoint, message):
+                    return
+                logger.bind(chat_id=message.chat.id).warning("Generate requests queue full, rejecting request")
+                self._instant_executor.submit(self.__reply_busy, message)
+                return
+
+            if not self._instant_executor.submit(self._handler_message_entrypoint, message):
+                logger.bind(chat_id=message.chat.id).warning("Instant requests queue full, rejecting request")
+        except Exception as ex:
+            logger.opt(exception=ex).error("Failed dispatching message")
+
+    def _handler_inline_query_dispatch(self, query: InlineQuery):
+        try:
+            if not self._instant_executor.submit(self._handler_inline_query, query):
+                logger.bind(chat_id=query.from_user.id).warning("Instant requests queue full, rejecting inline query")
+        except Exception as ex:
+            logger.opt(exception=ex).error("Failed dispatching inline query")
+
+    def __reply_busy(self, message: Message):
+        with contextlib.suppress(Exception):
+            self._bot.reply_to(message, constants.COMMAND_GENERATE_REPLY_RATE_EXCEEDED)
+
     def _handler_message_entrypoint(self, message: Message):
         with request_middleware(chat_id=message.chat.id):
             with message_request_middleware(bot=self._bot, message=message):
@@ -120,6 +308,28 @@ class Bot:
                 if self._handler_command_generate(message):
                     return
 
+    def _handler_inline_query(self, query: InlineQuery):
+        """Answer inline queries with the photos of past generations whose prompts match the query.
+        Only the generations index is used (no DALLE requests)."""
+        with request_middleware(chat_id=query.from_user.id):
+            generations = self._generations_index.search(query.query, limit=self._settings.inline_query_results_limit)
+            results = list()
+            for generation in generations:
+                for i, file_id in enumerate(generation.telegram_file_ids):
+                    results.append(InlineQueryResultCachedPhoto(
+                        id=f"{generation.key}-{i}",
+                        photo_file_id=file_id,
+                        caption=generation.prompt,
+                    ))
+
+            results = results[:self._settings.inline_query_results_limit]
+            logger.bind(results_count=len(results)).info("Request is Inline query")
+            self._bot.answer_inline_query(
+                inline_query_id=query.id,
+                results=results,
+                cache_time=self._settings.inline_query_cache_seconds,
+            )
+
     def _handler_basic_command(self, message: Message) -> bool:
         for cmd, reply_text in constants.BASIC_COMMAND_REPLIES.items():
             if message.text.startswith(cmd):
@@ -144,40 +354,375 @@ class Bot:
         if not prompt:
             return True
 
+        if not self._dalle_generate_request_rate_limiter.allow(message.chat.id):
+            logger.bind(chat_id=message.chat.id).info("Generate command Request rate limit exceeded")
+            self._bot.reply_to(message, constants.COMMAND_GENERATE_REPLY_RATE_EXCEEDED)
+            return True
+
         if not self._dalle_generate_rate_limiter.increase(message.chat.id):
             logger.bind(chat_id=message.chat.id).info("Generate command Request limit exceeded for this chat")
+            self._dalle_generate_request_rate_limiter.refund(message.chat.id)
             self._bot.reply_to(message, constants.COMMAND_GENERATE_REPLY_RATELIMIT_EXCEEDED)
             return True
 
         generating_reply_message = self._bot.reply_to(message, constants.COMMAND_GENERATE_REPLY_GENERATING)
         self._generating_bot_action.start(message.chat.id)
 
-        response: Optional[DalleResponse] = None
+        job = GenerationJob(
+            job_id=get_uuid(),
+            request_id=get_request_id(),
+            chat_id=message.chat.id,
+            message_id=message.message_id,
+            generating_message_id=generating_reply_message.message_id,
+            prompt=prompt,
+        )
+        if self._job_queue:
+            self.__command_generate_enqueue_job(job)
+        else:
+            self.__command_generate_run_job(job)
+        return True
+
+    def __command_generate_run_job(self, job: GenerationJob, release_rate_limit: bool = True):
+        """Run a generate request on this instance, recording its progress on the generations journal, if enabled.
+        Only the DALLE request runs on this thread; the result is handed over to the cleanup, post-processing
+        and upload stages, so this thread (and its DALLE slot) is released as soon as the generation completes."""
+        self.__journal_record(job, GenerationJobStatus.PENDING)
         try:
-            response = self._dalle.generate(prompt)
-        except DalleTemporarilyUnavailableException:
-            pass
-        finally:
-            self._generating_bot_action.stop(message.chat.id)
-            self._dalle_generate_rate_limiter.decrease(message.chat.id)
-            with contextlib.suppress(Exception):
-                self._bot.delete_message(
-                    chat_id=generating_reply_message.chat.id,
-                    message_id=generating_reply_message.message_id
+            response: Optional[DalleResponse] = None
+            try:
+                response = self.__command_generate_request(
+                    chat_id=job.chat_id,
+                    prompt=job.prompt,
+                    generating_message_id=job.generating_message_id,
                 )
+            except DalleTemporarilyUnavailableException:
+                pass
+            finally:
+                self._cleanup_executor.submit(self.__stage_cleanup, job, release_rate_limit)
+
+            if not response:
+                self.__journal_record(job, GenerationJobStatus.FAILED)
+                self._bot.send_message(
+                    chat_id=job.chat_id,
+                    reply_to_message_id=job.message_id,
+                    text=constants.COMMAND_GENERATE_REPLY_TEMPORARILY_UNAVAILABLE,
+                )
+                return
 
-        if not response:
-            self._bot.reply_to(message, constants.COMMAND_GENERATE_REPLY_TEMPORARILY_UNAVAILABLE)
-            return True
+        except Exception:
+            if job.status in GenerationJobStatus.UNFINISHED:
+                self.__journal_record(job, GenerationJobStatus.FAILED)
+            raise
+
+        self._process_executor.submit(self.__stage_process, job, response)
+
+    def __stage_cleanup(self, job: GenerationJob, release_rate_limit: bool):
+        with logger.contextualize(request_id=job.request_id, job_id=job.job_id, chat_id=job.chat_id):
+            self.__command_generate_cleanup(
+                chat_id=job.chat_id,
+                generating_message_id=job.generating_message_id,
+                release_rate_limit=release_rate_limit,
+            )
+
+    def __stage_process(self, job: GenerationJob, response: DalleResponse):
+        """Post-process the generated images (not required if the images were already uploaded to Telegram)"""
+        with logger.contextualize(request_id=job.request_id, job_id=job.job_id, chat_id=job.chat_id):
+            try:
+                images = None if response.telegram_file_ids else self.__get_images(response)
+            except Exception as ex:
+                self.__stage_failed(job, ex)
+                return
+
+        self._upload_executor.submit(self.__stage_upload, job, response, images)
+
+    def __stage_upload(self, job: GenerationJob, response: DalleResponse, images: Optional[List[bytes]]):
+        with logger.contextualize(request_id=job.request_id, job_id=job.job_id, chat_id=job.chat_id):
+            try:
+                self.__journal_record(job, GenerationJobStatus.DELIVERING)
+                self.send_generated_images(
+                    chat_id=job.chat_id,
+                    reply_to_message_id=job.message_id,
+                    prompt=job.prompt,
+                    response=response,
+                    images=images,
+                )
+                self.__journal_record(job, GenerationJobStatus.DELIVERED)
+                logger.info("Generate command result delivered")
+            except Exception as ex:
+                self.__stage_failed(job, ex)
+
+    def __stage_failed(self, job: GenerationJob, ex: Exception):
+        if job.status in GenerationJobStatus.UNFINISHED:
+            self.__journal_record(job, GenerationJobStatus.FAILED)
+        if exception_is_bot_blocked_by_user(ex):
+            logger.info("Generate command result not delivered: Bot blocked by the user")
+            return
+
+        logger.opt(exception=ex).error("Generate command result delivery failed")
+        with contextlib.suppress(Exception):
+            self._bot.send_message(
+                chat_id=job.chat_id,
+                reply_to_message_id=job.message_id,
+                text=constants.UNKNOWN_ERROR_REPLY,
+            )
+
+    def __journal_record(self, job: GenerationJob, status: str):
+        if self._journal:
+            self._journal.record(job, status)
+        else:
+            job.status = status
 
-        images_telegram = [InputMediaPhoto(image_bytes) for image_bytes in response.images_bytes]
+    def replay_journal(self):
+        """Replay, in background, the generate requests that were not completed before the last shutdown."""
+        if not self._journal or self._job_queue:
+            return
+
+        jobs = self._journal.get_unfinished()
+        if not jobs:
+            return
+
+        logger.bind(jobs_count=len(jobs)).info("Replaying unfinished generate requests from journal")
+        for job in jobs:
+            if not self._generate_executor.submit(self._replay_job, job):
+                logger.bind(request_id=job.request_id, job_id=job.job_id, chat_id=job.chat_id).\
+                    warning("Replayed generate request rejected, generate queue is full")
+                self.__journal_record(job, GenerationJobStatus.FAILED)
+                with contextlib.suppress(Exception):
+                    self._bot.send_message(
+                        chat_id=job.chat_id,
+                        reply_to_message_id=job.message_id,
+                        text=constants.COMMAND_GENERATE_REPLY_TEMPORARILY_UNAVAILABLE,
+                    )
+
+    def _replay_job(self, job: GenerationJob):
+        with logger.contextualize(request_id=job.request_id, job_id=job.job_id, chat_id=job.chat_id):
+            logger.info("Replaying generate request")
+            try:
+                # replayed requests are always accepted; release the slot only if one was taken
+                rate_limited = self._dalle_generate_rate_limiter.increase(job.chat_id)
+                self._generating_bot_action.start(job.chat_id)
+                self.__command_generate_run_job(job, release_rate_limit=rate_limited)
+                logger.info("Replayed generate request generated")
+            except Exception as ex:
+                if exception_is_bot_blocked_by_user(ex):
+                    logger.info("Replayed generate request completed: Bot blocked by the user")
+                    return
+                logger.opt(exception=ex).error("Replayed generate request failed")
+
+    def __command_generate_cleanup(
+            self, chat_id: int, generating_message_id: Optional[int], release_rate_limit: bool = True
+    ):
+        """Complete a generate request: stop the chat action, release the rate limit, delete the 'generating' message."""
+        self._generating_bot_action.stop(chat_id)
+        if release_rate_limit:
+            self._dalle_generate_rate_limiter.decrease(chat_id)
+        if generating_message_id is None:
+            return
+        with contextlib.suppress(Exception):
+            self._bot.delete_message(
+                chat_id=chat_id,
+                message_id=generating_message_id,
+            )
+
+    def __command_generate_enqueue_job(self, job: GenerationJob):
+        """Queue the generation as a job for the DALLE workers.
+        The request is completed once the job result is received, on the job results worker."""
+        job.results_queue_name = self._job_results_queue_name
+        self._jobs_pending.add(job)
+        try:
+            self._job_queue.push_job(job)
+        except Exception:
+            self._jobs_pending.pop(job)
+            self.__command_generate_cleanup(chat_id=job.chat_id, generating_message_id=job.generating_message_id)
+            raise
+
+        logger.bind(job_id=job.job_id).info("Generate command job queued")
+
+    def _job_results_worker(self):
+        logger.debug("Start of job results worker")
+        while not self._stop_event.is_set():
+            try:
+                job = self._job_queue.pop_result(self._job_results_queue_name, timeout=5)
+            except Exception as ex:
+                logger.opt(exception=ex).error("Failed fetching job results")
+                self._stop_event.wait(5)
+                continue
+
+            if job:
+                self._delivery_executor.submit(self._job_result_handler, job)
+            for job in self._jobs_pending.pop_expired():
+                self._delivery_executor.submit(self._job_expired_handler, job)
+
+    def _job_expired_handler(self, job: GenerationJob):
+        """The result of a job was not received in time: release the chat and notify the user.
+        If the result arrives later, it is still delivered when generated."""
+        with logger.contextualize(request_id=job.request_id, job_id=job.job_id, chat_id=job.chat_id):
+            logger.warning("Job result timed out")
+            try:
+                self.__command_generate_cleanup(chat_id=job.chat_id, generating_message_id=job.generating_message_id)
+                self._bot.send_message(
+                    chat_id=job.chat_id,
+                    reply_to_message_id=job.message_id,
+                    text=constants.COMMAND_GENERATE_REPLY_TEMPORARILY_UNAVAILABLE,
+                )
+            except Exception as ex:
+                if exception_is_bot_blocked_by_user(ex):
+                    logger.info("Job expired: Bot blocked by the user")
+                    return
+                logger.opt(exception=ex).error("Job expiration handling failed")
+
+    def _job_result_handler(self, job: GenerationJob):
+        with logger.contextualize(request_id=job.request_id, job_id=job.job_id, chat_id=job.chat_id):
+            logger.bind(job_status=job.status).debug("Job result received")
+            try:
+                # if the job expired, the chat was already released (and might be running a new request)
+                pending = self._jobs_pending.pop(job)
+                if pending:
+                    self.__command_generate_cleanup(
+                        chat_id=job.chat_id,
+                        generating_message_id=job.generating_message_id,
+                    )
+
+                if job.status == GenerationJobStatus.GENERATED and job.response:
+                    self.send_generated_images(
+                        chat_id=job.chat_id,
+                        reply_to_message_id=job.message_id,
+                        prompt=job.prompt,
+                        response=job.response,
+                    )
+                elif job.status == GenerationJobStatus.DELIVERED:
+                    self.index_generation(prompt=job.prompt, file_ids=job.telegram_file_ids)
+                elif not pending:
+                    logger.info("Job failed after expiring, the user was already notified")
+                    return
+                else:
+                    self._bot.send_message(
+                        chat_id=job.chat_id,
+                        reply_to_message_id=job.message_id,
+                        text=constants.COMMAND_GENERATE_REPLY_TEMPORARILY_UNAVAILABLE,
+                    )
+
+                logger.info("Job completed")
+            except Exception as ex:
+                if exception_is_bot_blocked_by_user(ex):
+                    logger.info("Job completed: Bot blocked by the user")
+                    return
+                logger.opt(exception=ex).error("Job result handling failed")
+
+    def __command_generate_request(self, chat_id: int, prompt: str, generating_message_id: int) -> DalleResponse:
+        """Request the generation of a prompt to DALLE.
+        If the generation scheduler is enabled and the result is neither cached nor being generated, wait for a
+        generation slot (up to the generation timeout), informing the user about its position on the queue."""
+        if not self._dalle_scheduler:
+            return self._dalle.generate(prompt)
+
+        response = self._dalle.get_cached(prompt)
+        if response:
+            logger.debug("DALLE response returned from cache")
+            return response
+        if self._dalle.is_generating(prompt):
+            # waits on the in-flight generation, not taking a generation slot
+            return self._dalle.generate(prompt)
+
+        ticket = self._dalle_scheduler.enqueue(chat_id)
+        try:
+            deadline = time.monotonic() + self._settings.dalle_generation_timeout_seconds
+            position = 0
+            while True:
+                new_position = self._dalle_scheduler.position(ticket)
+                if new_position and new_position != position:
+                    if not position:
+                        logger.bind(queue_position=new_position).info("Generate command Request queued")
+                    position = new_position
+                    with contextlib.suppress(Exception):
+                        self._bot.edit_message_text(
+                            text=constants.COMMAND_GENERATE_REPLY_QUEUED.format(position=position),
+                            chat_id=chat_id,
+                            message_id=generating_message_id,
+                        )
+
+                timeout = min(self._settings.dalle_generation_queue_update_seconds, deadline - time.monotonic())
+                if self._dalle_scheduler.wait(ticket, timeout=max(timeout, 0)):
+                    break
+                if time.monotonic() >= deadline:
+                    logger.bind(queue_position=position).warning("Generate command Request timed out on the queue")
+                    raise DalleTemporarilyUnavailableException()
+
+            return self._dalle.generate(prompt)
+        finally:
+            self._dalle_scheduler.release(ticket)
+
+    def send_generated_images(
+            self,
+            chat_id: int,
+            reply_to_message_id: int,
+            prompt: str,
+            response: DalleResponse,
+            images: Optional[List[bytes]] = None,
+    ) -> Optional[List[str]]:
+        """Send the generated images as an album, replying to the request message.
+        If the images were previously uploaded to Telegram, their file_ids are sent instead of the images data.
+        Otherwise, the file_ids returned after uploading them are stored on the cache.
+        The images can be given already post-processed; if not, they are post-processed here.
+        Return the file_ids of the sent images (if available), which are added to the generations index."""
+        if response.telegram_file_ids:
+            try:
+                self.__send_photos(
+                    chat_id=chat_id, reply_to_message_id=reply_to_message_id, prompt=prompt, media=response.telegram_file_ids
+                )
+                logger.debug("Generated images sent using cached file_ids")
+                self.index_generation(prompt=prompt, file_ids=response.telegram_file_ids)
+                return response.telegram_file_ids
+            except Exception as ex:
+                if exception_is_bot_blocked_by_user(ex):
+                    raise ex
+                logger.opt(exception=ex).warning("Failed sending images by cached file_ids, uploading them")
+
+        if images is None:
+            images = self.__get_images(response)
+
+        sent_messages = self.__send_photos(
+            chat_id=chat_id, reply_to_message_id=reply_to_message_id, prompt=prompt, media=images
+        )
+        file_ids = [sent_message.photo[-1].file_id for sent_message in sent_messages if sent_message.photo]
+        if len(file_ids) != len(images):
+            return None
+
+        if self._dalle_cache:
+            self._dalle_cache.set_telegram_file_ids(prompt=prompt, response=response, file_ids=file_ids)
+        self.index_generation(prompt=prompt, file_ids=file_ids)
+        return file_ids
+
+    def __get_images(self, response: DalleResponse) -> List[bytes]:
+        """Return the images to send of a generation, post-processed if enabled"""
+        images = response.images_bytes
+        if self._image_postprocessor:
+            images = self._image_postprocessor.process(images)
+        return images
+
+    def index_generation(self, prompt: str, file_ids: Optional[List[str]]):
+        """Add a delivered generation to the generations index (if enabled), for inline queries"""
+        if self._generations_index and file_ids:
+            self._generations_index.add(prompt=prompt, telegram_file_ids=file_ids)
+
+    def __send_photos(self, chat_id: int, reply_to_message_id: int, prompt: str, media: list) -> List[Message]:
+        """Send an album of photos (or a single photo, for collages), given as bytes or Telegram file_ids,
+        replying to the given message."""
+        if len(media) == 1:
+            return [self._bot.send_photo(
+                chat_id=chat_id,
+                reply_to_message_id=reply_to_message_id,
+                photo=media[0],
+                caption=prompt,
+            )]
+
+        images_telegram = [InputMediaPhoto(image) for image in media]
         images_telegram[0].caption = prompt
-        self._bot.send_media_group(
-            chat_id=message.chat.id,
-            reply_to_message_id=message.message_id,
+        return self._bot.send_media_group(
+            chat_id=chat_id,
+            reply_to_message_id=reply_to_message_id,
             media=images_telegram,
         )
-        return True
 
     def __command_generate_get_prompt(self, message: Message) -> Optional[str]:
         """Get the prompt text from a /generate command and return it.
@@ -0,0 +1,388 @@
+import asyncio
+import contextlib
+import time
+from threading import Thread
+from typing import Optional, List
+
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Message, InputMediaPhoto, BotCommand, InlineQuery, InlineQueryResultCachedPhoto
+
+from . import constants
+from .chatactions_async import AsyncActionManager
+from .scheduler import GenerationScheduler
+from .ratelimit import RequestRateLimiter, get_concurrency_limiter
+from .middlewares import request_middleware, async_message_request_middleware
+from ..dalle import AsyncDalle, DalleCache, DalleTemporarilyUnavailableException, GenerationsIndex
+from ..dalle.models import DalleResponse
+from ..images import ImagePostProcessor
+from ..redis import Redis
+from ...settings import Settings
+from ...logger import logger
+from ...utils import exception_is_bot_blocked_by_user
+
+
+class AsyncBot:
+    """asyncio version of the Bot. The bot, the DALLE client and the chat actions run on a single event loop,
+    so pending generations do not require a thread each. Exposes the same interface as the Bot."""
+
+    def __init__(
+            self,
+            settings: Settings,
+            dalle: AsyncDalle,
+            dalle_cache: Optional[DalleCache] = None,
+            image_postprocessor: Optional[ImagePostProcessor] = None,
+            redis: Optional[Redis] = None,
+            generations_index: Optional[GenerationsIndex] = None,
+    ):
+        self._settings = settings
+        self._dalle = dalle
+        self._dalle_cache = dalle_cache
+        self._generations_index = generations_index
+        self._image_postprocessor = image_postprocessor
+        self._loop_thread = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._polling_task: Optional[asyncio.Task] = None
+        self._stopped: Optional[asyncio.Event] = None
+        self._pending_requests = 0
+        self._pending_requests_empty: Optional[asyncio.Event] = None
+
+        if self._settings.telegram_bot_api_url:
+            asyncio_helper.API_URL = self._settings.telegram_bot_api_url.rstrip("/") + "/bot{0}/{1}"
+
+        self._bot = AsyncTeleBot(
+            token=self._settings.telegram_bot_token,
+            parse_mode="HTML",
+        )
+        self._bot.message_handler(func=lambda message: True)(self._handler_message_entrypoint)
+        if self._generations_index:
+            self._bot.inline_handler(func=lambda query: True)(self._handler_inline_query)
+
+        self._generating_bot_action = AsyncActionManager(
+            action=self._settings.command_generate_action,
+            bot=self._bot,
+            timeout=self._settings.dalle_generation_timeout_seconds,
+        )
+        self._dalle_generate_rate_limiter = get_concurrency_limiter(
+            settings=self._settings,
+            redis=redis,
+        )
+        self._dalle_generate_request_rate_limiter = RequestRateLimiter(
+            settings=self._settings,
+            redis=redis,
+        )
+        self._dalle_scheduler = None
+        if self._settings.dalle_generation_concurrent_limit > 0:
+            self._dalle_scheduler = GenerationScheduler(
+                concurrent_limit=self._settings.dalle_generation_concurrent_limit,
+            )
+
+    def setup(self):
+        """Perform initial setup (delete webhook, set commands)"""
+        if self._settings.telegram_bot_delete_webhook:
+            asyncio.run(self.delete_webhook())
+        if self._settings.telegram_bot_set_commands:
+            asyncio.run(self.set_commands())
+
+    def start(self):
+        """Run the bot in background, by starting a thread running the event loop."""
+        if self._loop_thread:
+            return
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = Thread(
+            target=self._loop.run_until_complete,
+            args=(self.run(),),
+            name="TelegramBotAsyncLoop",
+            daemon=True,
+        )
+        self._loop_thread.start()
+
+    async def run(self):
+        """Run the bot in foreground, on the current event loop, until stopped."""
+        logger.info("Running async bot with Polling")
+        self._pending_requests_empty = asyncio.Event()
+        self._pending_requests_empty.set()
+        self._stopped = asyncio.Event()
+        self._polling_task = asyncio.create_task(self._bot.infinity_polling(logger_level=None))
+        await self._stopped.wait()
+
+    def stop(self, graceful_shutdown: Optional[bool] = None):
+        """Stop the bot execution, from outside the event loop.
+        :param graceful_shutdown: if True, wait for pending requests to finalize (but stop accepting new requests).
+                                  If false, stop inmediately. If None (default), use the configured setting.
+        """
+        if graceful_shutdown is None:
+            graceful_shutdown = self._settings.telegram_bot_graceful_shutdown
+        if not self._loop:
+            return
+
+        asyncio.run_coroutine_threadsafe(self._stop(graceful_shutdown), self._loop).result()
+
+    async def _stop(self, graceful_shutdown: bool):
+        if graceful_shutdown:
+            logger.info("Stopping bot gracefully (waiting for pending requests to end, not accepting new requests)...")
+        else:
+            logger.info("Stopping bot polling (force-stop)...")
+
+        try:
+            # AsyncTeleBot has no stop_polling: cancelling the polling task stops it
+            if self._polling_task:
+                self._polling_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await self._polling_task
+            if graceful_shutdown and self._pending_requests_empty:
+                await self._pending_requests_empty.wait()
+        finally:
+            try:
+                await self._dalle.close()
+                if self._image_postprocessor:
+                    self._image_postprocessor.teardown()
+                await self._bot.close_session()
+            finally:
+                if self._stopped:
+                    self._stopped.set()
+        logger.info("Bot stopped")
+
+    async def set_commands(self):
+        logger.debug("Setting bot commands...")
+        await self._bot.set_my_commands([
+            BotCommand(command=k, description=v)
+            for k, v in constants.COMMANDS_HELP.items()
+        ])
+        await self._bot.close_session()
+        logger.info("Bot commands set")
+
+    async def delete_webhook(self):
+        logger.info("Deleting bot webhook...")
+        await self._bot.delete_webhook()
+        await self._bot.close_session()
+        logger.info("Webhook deleted")
+
+    async def _handler_message_entrypoint(self, message: Message):
+        self._pending_requests += 1
+        self._pending_requests_empty.clear()
+        try:
+            with request_middleware(chat_id=message.chat.id):
+                async with async_message_request_middleware(bot=self._bot, message=message):
+                    if await self._handler_basic_command(message):
+                        return
+                    if await self._handler_command_generate(message):
+                        return
+        finally:
+            self._pending_requests -= 1
+            if self._pending_requests == 0:
+                self._pending_requests_empty.set()
+
+    async def _handler_inline_query(self, query: InlineQuery):
+        """Same behaviour as Bot: answer with the photos of past generations from the generations index.
+        The index lives in memory, so it is searched on the event loop."""
+        with request_middleware(chat_id=query.from_user.id):
+            generations = self._generations_index.search(query.query, limit=self._settings.inline_query_results_limit)
+            results = list()
+            for generation in generations:
+                for i, file_id in enumerate(generation.telegram_file_ids):
+                    results.append(InlineQueryResultCachedPhoto(
+                        id=f"{generation.key}-{i}",
+                        photo_file_id=file_id,
+                        caption=generation.prompt,
+                    ))
+
+            results = results[:self._settings.inline_query_results_limit]
+            logger.bind(results_count=len(results)).info("Request is Inline query")
+            await self._bot.answer_inline_query(
+                inline_query_id=query.id,
+                results=results,
+                cache_time=self._settings.inline_query_cache_seconds,
+            )
+
+    async def _handler_basic_command(self, message: Message) -> bool:
+        for cmd, reply_text in constants.BASIC_COMMAND_REPLIES.items():
+            if message.text.startswith(cmd):
+                logger.bind(command=cmd).info("Request is Basic command")
+
+                disable_link_preview = cmd in constants.BASIC_COMMAND_DISABLE_LINK_PREVIEWS
+                await self._bot.reply_to(
+                    message=message,
+                    text=reply_text,
+                    disable_web_page_preview=disable_link_preview,
+                )
+                return True
+
+        return False
+
+    async def _handler_command_generate(self, message: Message) -> bool:
+        if not message.text.startswith(constants.COMMAND_GENERATE):
+            return False
+
+        logger.bind(cmd=constants.COMMAND_GENERATE).info("Request is Generate command")
+        prompt = await self.__command_generate_get_prompt(message)
+        if not prompt:
+            return True
+
+        # rate limiters may be on Redis (blocking I/O)
+        if not await asyncio.to_thread(self._dalle_generate_request_rate_limiter.allow, message.chat.id):
+            logger.bind(chat_id=message.chat.id).info("Generate command Request rate limit exceeded")
+            await self._bot.reply_to(message, constants.COMMAND_GENERATE_REPLY_RATE_EXCEEDED)
+            return True
+
+        if not await asyncio.to_thread(self._dalle_generate_rate_limiter.increase, message.chat.id):
+            logger.bind(chat_id=message.chat.id).info("Generate command Request limit exceeded for this chat")
+            await asyncio.to_thread(self._dalle_generate_request_rate_limiter.refund, message.chat.id)
+            await self._bot.reply_to(message, constants.COMMAND_GENERATE_REPLY_RATELIMIT_EXCEEDED)
+            return True
+
+        generating_reply_message = await self._bot.reply_to(message, constants.COMMAND_GENERATE_REPLY_GENERATING)
+        self._generating_bot_action.start(message.chat.id)
+
+        response: Optional[DalleResponse] = None
+        try:
+            response = await self.__command_generate_request(
+                message=message,
+                prompt=prompt,
+                generating_reply_message=generating_reply_message,
+            )
+        except DalleTemporarilyUnavailableException:
+            pass
+        finally:
+            self._generating_bot_action.stop(message.chat.id)
+            await asyncio.to_thread(self._dalle_generate_rate_limiter.decrease, message.chat.id)
+            with contextlib.suppress(Exception):
+                await self._bot.delete_message(
+                    chat_id=generating_reply_message.chat.id,
+                    message_id=generating_reply_message.message_id
+                )
+
+        if not response:
+            await self._bot.reply_to(message, constants.COMMAND_GENERATE_REPLY_TEMPORARILY_UNAVAILABLE)
+            return True
+
+        await self.__command_generate_send_images(message=message, prompt=prompt, response=response)
+        return True
+
+    async def __command_generate_request(
+            self, message: Message, prompt: str, generating_reply_message: Message
+    ) -> DalleResponse:
+        """Request the generation of a prompt to DALLE.
+        If the generation scheduler is enabled and the result is neither cached nor being generated, wait for a
+        generation slot (up to the generation timeout), informing the user about its position on the queue."""
+        if not self._dalle_scheduler:
+            return await self._dalle.generate(prompt)
+
+        response = await self._dalle.get_cached(prompt)
+        if response:
+            logger.debug("DALLE response returned from cache")
+            return response
+        if self._dalle.is_generating(prompt):
+            # waits on the in-flight generation, not taking a generation slot
+            return await self._dalle.generate(prompt)
+
+        ticket = self._dalle_scheduler.enqueue(message.chat.id, loop=asyncio.get_running_loop())
+        try:
+            deadline = time.monotonic() + self._settings.dalle_generation_timeout_seconds
+            position = 0
+            while True:
+                new_position = self._dalle_scheduler.position(ticket)
+                if new_position and new_position != position:
+                    if not position:
+                        logger.bind(queue_position=new_position).info("Generate command Request queued")
+                    position = new_position
+                    with contextlib.suppress(Exception):
+                        await self._bot.edit_message_text(
+                            text=constants.COMMAND_GENERATE_REPLY_QUEUED.format(position=position),
+                            chat_id=generating_reply_message.chat.id,
+                            message_id=generating_reply_message.message_id,
+                        )
+
+                timeout = min(self._settings.dalle_generation_queue_update_seconds, deadline - time.monotonic())
+                if await self._dalle_scheduler.wait_async(ticket, timeout=max(timeout, 0)):
+                    break
+                if time.monotonic() >= deadline:
+                    logger.bind(queue_position=position).warning("Generate command Request timed out on the queue")
+                    raise DalleTemporarilyUnavailableException()
+
+            return await self._dalle.generate(prompt)
+        finally:
+            self._dalle_scheduler.release(ticket)
+
+    async def __command_generate_send_images(self, message: Message, prompt: str, response: DalleResponse):
+        """Send the generated images as an album, replying to the request message.
+        Same behaviour as Bot: cached file_ids are sent when available, and stored after uploading otherwise."""
+        if response.telegram_file_ids:
+            try:
+                await self.__send_photos(message=message, prompt=prompt, media=response.telegram_file_ids)
+                logger.debug("Generated images sent using cached file_ids")
+                await self.__index_generation(prompt=prompt, file_ids=response.telegram_file_ids)
+                return
+            except Exception as ex:
+                if exception_is_bot_blocked_by_user(ex):
+                    raise ex
+                logger.opt(exception=ex).warning("Failed sending images by cached file_ids, uploading them")
+
+        images = response.images_bytes
+        if self._image_postprocessor:
+            images = await self._image_postprocessor.process_async(images)
+
+        sent_messages = await self.__send_photos(message=message, prompt=prompt, media=images)
+        file_ids = [sent_message.photo[-1].file_id for sent_message in sent_messages if sent_message.photo]
+        if len(file_ids) != len(images):
+            return
+
+        if self._dalle_cache:
+            await asyncio.to_thread(
+                self._dalle_cache.set_telegram_file_ids,
+                prompt=prompt,
+                response=response,
+                file_ids=file_ids,
+            )
+        await self.__index_generation(prompt=prompt, file_ids=file_ids)
+
+    async def __index_generation(self, prompt: str, file_ids: List[str]):
+        if self._generations_index:
+            # may persist on Redis, so run it outside the event loop
+            await asyncio.to_thread(self._generations_index.add, prompt=prompt, telegram_file_ids=file_ids)
+
+    async def __send_photos(self, message: Message, prompt: str, media: list) -> List[Message]:
+        """Send an album of photos (or a single photo, for collages), given as bytes or Telegram file_ids,
+        replying to the given message."""
+        if len(media) == 1:
+            return [await self._bot.send_photo(
+                chat_id=message.chat.id,
+                reply_to_message_id=message.message_id,
+                photo=media[0],
+                caption=prompt,
+            )]
+
+        images_telegram = [InputMediaPhoto(image) for image in media]
+        images_telegram[0].caption = prompt
+        return await self._bot.send_media_group(
+            chat_id=message.chat.id,
+            reply_to_message_id=message.message_id,
+            media=images_telegram,
+        )
+
+    async def __command_generate_get_prompt(self, message: Message) -> Optional[str]:
+        """Get the prompt text from a /generate command and return it.
+        If the prompt is invalid, replies to the user and returns None."""
+        prompt = message.text.replace(constants.COMMAND_GENERATE, "").strip()
+        prompt_length = len(prompt)
+        min_length = self._settings.command_generate_prompt_length_min
+        max_length = self._settings.command_generate_prompt_length_max
+
+        with logger.contextualize(prompt_length=prompt_length):
+            if prompt_length < min_length:
+                logger.debug("Generate command prompt too short")
+                await self._bot.reply_to(
+                    message, constants.COMMAND_GENERATE_PROMPT_TOO_SHORT.format(characters=min_length)
+                )
+                return None
+
+            if prompt_length > max_length:
+                logger.debug("Generate command prompt too long")
+                await self._bot.reply_to(
+                    message, constants.COMMAND_GENERATE_PROMPT_TOO_LONG.format(characters=max_length)
+                )
+                return None
+
+            logger.debug("Generate command prompt is valid")
+            return prompt
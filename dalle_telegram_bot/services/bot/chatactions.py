@@ -1,52 +1,75 @@
+import heapq
+import itertools
 import time
-from threading import Thread, Event, Lock
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Condition
 from collections import Counter
-from typing import Dict
+from typing import Dict, List, Optional, Set, Tuple
 
 import telebot
 
+from .. import metrics
 from ...utils import exception_is_bot_blocked_by_user
-from ...logger import logger, get_request_id
+from ...logger import logger, should_log, get_request_id
 from ...settings import Settings
 
+ACTION_INTERVAL_SECONDS = 4.5
+
+
+class _ChatAction:
+    def __init__(self, chat_id: int, request_id: Optional[str]):
+        self.chat_id = chat_id
+        self.request_id = request_id
+        self.start = time.time()
+
 
 class ActionManager:
+    """Send a chat action periodically to the chats with running requests.
+    A single scheduler thread keeps a heap of (next_due, chat), and dispatches the due chat actions
+    to a small pool of sender threads."""
+
     def __init__(self, action: str, timeout: float, bot: telebot.TeleBot, settings: Settings):
         self._action = action
         self._timeout = timeout
         self._bot = bot
         self._settings = settings
 
-        self._chatids_events: Dict[int, Event] = dict()
+        self._chatids_actions: Dict[int, _ChatAction] = dict()
+        self._chatids_sending: Set[int] = set()
         self._chatids_counter = Counter()
-        self._chatids_counter_lock = Lock()
+        self._chatids_counter_lock = Condition()
+
+        self._heap: List[Tuple[float, int, _ChatAction]] = list()
+        self._heap_sequence = itertools.count()
+        self._scheduler_thread: Optional[Thread] = None
+        self._senders_pool = ThreadPoolExecutor(
+            max_workers=self._settings.command_generate_action_senders,
+            thread_name_prefix=f"TelegramBot-ActionSender-{self._action}",
+        )
+        self._running = True
 
     def start(self, chat_id: int):
         """Register a 'start' Action for a chat.
         If no action was currently running for the chat, start it.
         In all cases, increase the counter for the chat."""
-        do_start = False
         with self._chatids_counter_lock:
             if self._chatids_counter[chat_id] == 0:
-                do_start = True
+                self._start_action(chat_id)
             self.increase(chat_id)
 
-        if do_start:
-            # run the start outside the counter lock
-            self._start_action_thread(chat_id)
-
     def stop(self, chat_id: int):
         """Register a 'stop' Action for a chat.
         Decrease the counter; if just one action was running for the chat, stop it."""
-        do_stop = False
         with self._chatids_counter_lock:
             if self._chatids_counter[chat_id] != 0:
                 if self.decrease(chat_id) == 0:
-                    do_stop = True
+                    self._stop_action(chat_id)
 
-        if do_stop:
-            # run the stop outside the counter lock
-            self._stop_action_thread(chat_id)
+    def teardown(self):
+        with self._chatids_counter_lock:
+            self._running = False
+            self._chatids_counter_lock.notify()
+        self._senders_pool.shutdown(wait=False)
 
     def increase(self, chat_id: int) -> int:
         """Increase the request counter for a chat, and return the new value.
@@ -68,54 +91,85 @@ class ActionManager:
 
         return current
 
-    def _start_action_thread(self, chat_id: int):
-        """Start the action thread. The chat_id MUST not be currently running any actions."""
-        event = Event()
-        self._chatids_events[chat_id] = event
-        request_id = get_request_id()
-
-        Thread(
-            target=self._action_worker,
-            kwargs=dict(
-                request_id=request_id,
-                chat_id=chat_id,
-                event=event,
-            ),
-            name=f"TelegramBot-ActionWorker-{self._action}-{chat_id}",
-            daemon=True
-        ).start()
-
-    def _stop_action_thread(self, chat_id: int):
-        """Stop the action thread for a chat_id. The chat_id MUST be currently running an action."""
-        event = self._chatids_events.pop(chat_id, None)
-        if event:
-            event.set()
-
-    def _action_worker(self, request_id: str, chat_id: int, event: Event):
-        with logger.contextualize(request_id=request_id, chat_id=chat_id, chat_action=self._action):
-            start = time.time()
-            while not event.is_set():
-                try:
-                    logger.trace("Sending chat action...")
-                    self._bot.send_chat_action(
-                        chat_id=chat_id,
-                        action=self._action,
-                    )
-                    logger.debug("Chat action sent")
-
-                except Exception as ex:
-                    if exception_is_bot_blocked_by_user(ex):
-                        logger.info("Bot blocked by user, stopping chat action")
-                        self._stop_action_thread(chat_id)
-                        return
-                    logger.opt(exception=ex).warning("Chat action failed delivery")
-
-                elapsed = time.time() - start
+    def _start_action(self, chat_id: int):
+        """Schedule the action for a chat_id, to be sent right away.
+        The chat_id MUST not be currently running any actions. The counter lock must be acquired."""
+        chat_action = _ChatAction(chat_id=chat_id, request_id=get_request_id())
+        self._chatids_actions[chat_id] = chat_action
+        metrics.CHAT_ACTIONS_ACTIVE.labels(action=self._action).set(len(self._chatids_actions))
+        heapq.heappush(self._heap, (chat_action.start, next(self._heap_sequence), chat_action))
+
+        if not self._scheduler_thread:
+            self._scheduler_thread = Thread(
+                target=self._scheduler_worker,
+                name=f"TelegramBot-ActionScheduler-{self._action}",
+                daemon=True,
+            )
+            self._scheduler_thread.start()
+        self._chatids_counter_lock.notify()
+
+    def _stop_action(self, chat_id: int):
+        """Unschedule the action for a chat_id; its entry on the heap is discarded when due.
+        The counter lock must be acquired."""
+        self._chatids_actions.pop(chat_id, None)
+        metrics.CHAT_ACTIONS_ACTIVE.labels(action=self._action).set(len(self._chatids_actions))
+
+    def _scheduler_worker(self):
+        logger.debug("Start of chat actions scheduler worker")
+        with self._chatids_counter_lock:
+            while self._running:
+                if not self._heap:
+                    self._chatids_counter_lock.wait()
+                    continue
+
+                now = time.time()
+                next_due = self._heap[0][0]
+                if next_due > now:
+                    self._chatids_counter_lock.wait(next_due - now)
+                    continue
+
+                _, _, chat_action = heapq.heappop(self._heap)
+                if self._chatids_actions.get(chat_action.chat_id) is not chat_action:
+                    # action stopped (or restarted)
+                    continue
+
+                elapsed = now - chat_action.start
                 if elapsed >= self._timeout:
-                    logger.bind(elapsed_time_seconds=round(elapsed, 3)).warning("Chat action timed out")
-                    self._stop_action_thread(chat_id)
-                    return
-
-                event.wait(4.5)
-
-            logger.debug("Chat action finalized")
+                    with logger.contextualize(request_id=chat_action.request_id, chat_id=chat_action.chat_id):
+                        logger.bind(elapsed_time_seconds=round(elapsed, 3)).warning("Chat action timed out")
+                    self._stop_action(chat_action.chat_id)
+                    continue
+
+                heapq.heappush(self._heap, (now + ACTION_INTERVAL_SECONDS, next(self._heap_sequence), chat_action))
+                if chat_action.chat_id in self._chatids_sending:
+                    # previous chat action still being sent
+                    continue
+
+                self._chatids_sending.add(chat_action.chat_id)
+                self._senders_pool.submit(self._send_action, chat_action)
+
+    def _send_action(self, chat_action: _ChatAction):
+        # sent every few seconds per chat: the log context is only built for the records actually emitted
+        try:
+            self._bot.send_chat_action(
+                chat_id=chat_action.chat_id,
+                action=self._action,
+            )
+            if should_log("DEBUG", "chat_action"):
+                self._get_logger(chat_action).debug("Chat action sent")
+
+        except Exception as ex:
+            if exception_is_bot_blocked_by_user(ex):
+                self._get_logger(chat_action).info("Bot blocked by user, stopping chat action")
+                with self._chatids_counter_lock:
+                    if self._chatids_actions.get(chat_action.chat_id) is chat_action:
+                        self._stop_action(chat_action.chat_id)
+                return
+            self._get_logger(chat_action).opt(exception=ex).warning("Chat action failed delivery")
+
+        finally:
+            with self._chatids_counter_lock:
+                self._chatids_sending.discard(chat_action.chat_id)
+
+    def _get_logger(self, chat_action: _ChatAction):
+        return logger.bind(request_id=chat_action.request_id, chat_id=chat_action.chat_id, chat_action=self._action)
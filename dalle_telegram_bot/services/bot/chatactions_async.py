@@ -0,0 +1,87 @@
+import asyncio
+import time
+from collections import Counter
+from typing import Dict
+
+from telebot.async_telebot import AsyncTeleBot
+
+from .. import metrics
+from ...utils import exception_is_bot_blocked_by_user
+from ...logger import logger, should_log
+
+
+class AsyncActionManager:
+    """asyncio version of the ActionManager: chat actions are sent from tasks running on the bot event loop,
+    instead of one thread per chat. Its methods must be called from the event loop."""
+
+    def __init__(self, action: str, timeout: float, bot: AsyncTeleBot):
+        self._action = action
+        self._timeout = timeout
+        self._bot = bot
+
+        self._chatids_tasks: Dict[int, asyncio.Task] = dict()
+        self._chatids_counter = Counter()
+
+    def start(self, chat_id: int):
+        """Register a 'start' Action for a chat.
+        If no action was currently running for the chat, start it.
+        In all cases, increase the counter for the chat."""
+        self._chatids_counter[chat_id] += 1
+        if self._chatids_counter[chat_id] == 1:
+            # the task inherits the current context, hence the request_id used by the logger
+            self._chatids_tasks[chat_id] = asyncio.create_task(self._action_worker(chat_id))
+            metrics.CHAT_ACTIONS_ACTIVE.labels(action=self._action).set(len(self._chatids_tasks))
+
+    def stop(self, chat_id: int):
+        """Register a 'stop' Action for a chat.
+        Decrease the counter; if just one action was running for the chat, stop it."""
+        if self._chatids_counter[chat_id] == 0:
+            return
+
+        self._chatids_counter[chat_id] -= 1
+        if self._chatids_counter[chat_id] == 0:
+            del self._chatids_counter[chat_id]
+            self._stop_action_task(chat_id)
+
+    def _stop_action_task(self, chat_id: int):
+        task = self._chatids_tasks.pop(chat_id, None)
+        metrics.CHAT_ACTIONS_ACTIVE.labels(action=self._action).set(len(self._chatids_tasks))
+        if task and task is not asyncio.current_task():
+            task.cancel()
+
+    async def _action_worker(self, chat_id: int):
+        # sent every few seconds per chat: the log context is only built for the records actually emitted
+        start = time.time()
+        try:
+            while True:
+                try:
+                    await self._bot.send_chat_action(
+                        chat_id=chat_id,
+                        action=self._action,
+                    )
+                    if should_log("DEBUG", "chat_action"):
+                        self._get_logger(chat_id).debug("Chat action sent")
+
+                except Exception as ex:
+                    if exception_is_bot_blocked_by_user(ex):
+                        self._get_logger(chat_id).info("Bot blocked by user, stopping chat action")
+                        self._stop_action_task(chat_id)
+                        return
+                    self._get_logger(chat_id).opt(exception=ex).warning("Chat action failed delivery")
+
+                elapsed = time.time() - start
+                if elapsed >= self._timeout:
+                    action_logger = self._get_logger(chat_id).bind(elapsed_time_seconds=round(elapsed, 3))
+                    action_logger.warning("Chat action timed out")
+                    self._stop_action_task(chat_id)
+                    return
+
+                await asyncio.sleep(4.5)
+
+        except asyncio.CancelledError:
+            if should_log("DEBUG", "chat_action"):
+                self._get_logger(chat_id).debug("Chat action finalized")
+
+    def _get_logger(self, chat_id: int):
+        # the request_id is on the context inherited by the task
+        return logger.bind(chat_id=chat_id, chat_action=self._action)
@@ -10,9 +10,15 @@ COMMAND_GENERATE = "/generate"
 
 COMMAND_GENERATE_REPLY_GENERATING = "The image is being generated. Please wait a few minutes for it..."
 
+COMMAND_GENERATE_REPLY_QUEUED = "There are many images being generated right now. " \
+                                "Your request is on position {position} of the queue; please wait a few minutes for it..."
+
 COMMAND_GENERATE_REPLY_RATELIMIT_EXCEEDED = "You have other images being generated. " \
                                             "Please wait until those are sent to you before asking for more."
 
+COMMAND_GENERATE_REPLY_RATE_EXCEEDED = "Too many images are being requested right now. " \
+                                       "Please wait a few minutes before asking for more."
+
 COMMAND_GENERATE_PROMPT_TOO_SHORT = "Your prompt message is too short, try with something longer " \
                                     "(at least {characters} characters)."
 
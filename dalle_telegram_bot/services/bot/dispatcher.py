@@ -0,0 +1,101 @@
+import queue
+import threading
+from typing import Callable, List, Optional, Tuple
+
+from .. import metrics
+from ...logger import logger
+
+__all__ = ("BoundedExecutor",)
+
+_Task = Tuple[Callable, tuple]
+
+
+class BoundedExecutor:
+    """Pool of worker threads consuming tasks from a bounded queue.
+    When the queue is full, the task is either rejected (`submit` returns False), or, with `block=True`,
+    the caller waits until there is room on the queue (backpressure)."""
+
+    def __init__(self, name: str, threads: int, queue_size: int, block: bool = False):
+        self._name = name
+        self._threads_count = threads
+        self._block = block
+        self._queue: "queue.Queue[Optional[_Task]]" = queue.Queue(maxsize=queue_size)
+        self._threads: List[threading.Thread] = list()
+        self.rejected_count = 0
+        metrics.DISPATCH_QUEUE_SIZE.labels(pool=self._name).set_function(self._queue.qsize)
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def threads(self) -> int:
+        return self._threads_count
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        if self._threads:
+            return
+
+        for i in range(self._threads_count):
+            thread = threading.Thread(
+                target=self._worker,
+                name=f"TelegramBot-{self._name}-{i}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn: Callable, *args) -> bool:
+        """Queue a task. Return False if it was rejected because the queue is full."""
+        if self._block:
+            self._queue.put((fn, args))
+            return True
+
+        try:
+            self._queue.put_nowait((fn, args))
+            return True
+        except queue.Full:
+            self.rejected_count += 1
+            metrics.DISPATCH_REJECTED.labels(pool=self._name).inc()
+            return False
+
+    def shutdown(self, wait: bool = False):
+        """Stop the workers. If wait, the queued tasks are completed first; otherwise, they are discarded."""
+        for _ in self._threads:
+            if wait:
+                self._queue.put(None)
+            else:
+                self._put_stop_nowait()
+
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads.clear()
+
+    def _put_stop_nowait(self):
+        # discard pending tasks, to make room for the stop signal
+        while True:
+            try:
+                self._queue.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _worker(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+
+            fn, args = task
+            try:
+                fn(*args)
+            except Exception as ex:
+                logger.opt(exception=ex).bind(pool=self._name).error("Unhandled error on bot executor task")
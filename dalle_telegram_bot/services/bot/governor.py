@@ -0,0 +1,155 @@
+import json
+import time
+import threading
+from typing import Dict, Optional, Union
+
+from ...settings import Settings
+
+__all__ = ("OutboundRateGovernor",)
+
+ChatId = Union[int, str]
+
+
+class _Bucket:
+    """Token bucket that can go into debt: a request is let through when there is at least one token available,
+    and then its full cost is taken (so heavier requests delay the following ones, instead of never fitting)."""
+
+    def __init__(self, rate_per_second: float, burst: float, now: float):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.tokens = burst
+        self.timestamp = now
+        self.blocked_until = 0.0  # set from the retry_after of 429 responses
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.timestamp) * self.rate_per_second)
+        self.timestamp = now
+
+    def get_wait(self, now: float, required_tokens: float = 1) -> float:
+        """Return the time to wait until `required_tokens` are available (0 if available now)."""
+        self.refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < required_tokens:
+            wait = max(wait, (required_tokens - self.tokens) / self.rate_per_second)
+        return wait
+
+    def is_idle(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.burst and self.blocked_until <= now
+
+
+class OutboundRateGovernor:
+    """Paces the outgoing Telegram Bot API requests to stay within Telegram's limits, instead of reacting to 429 errors:
+    a global messages/second budget, and a budget per chat (lower for groups).
+    Media groups cost one message per media on the global budget, but a single message on the chat budget
+    (a chat receives an album as one delivery). Low priority requests (chat actions) leave a reserve of the global budget
+    for the high priority ones (replies, results delivery)."""
+
+    CHAT_BURST = 3
+    GROUP_BURST = 5
+    LOW_PRIORITY_RESERVE_RATIO = 0.2
+    PRUNE_INTERVAL_SECONDS = 60
+
+    LOW_PRIORITY_METHODS = ("sendChatAction",)
+
+    def __init__(self, settings: Settings):
+        self._settings = settings
+        now = time.monotonic()
+        self._global_bucket = _Bucket(
+            rate_per_second=self._settings.telegram_bot_outbound_global_per_second,
+            burst=self._settings.telegram_bot_outbound_global_per_second,
+            now=now,
+        )
+        self._low_priority_reserve = self._global_bucket.burst * self.LOW_PRIORITY_RESERVE_RATIO
+        self._chats_buckets: Dict[ChatId, _Bucket] = dict()
+        self._last_prune = now
+        self._lock = threading.Condition()
+
+    @staticmethod
+    def is_governed(api_method: str) -> bool:
+        """Return True if the API method sends (or edits) messages on a chat, hence is subject to the limits."""
+        return api_method.startswith("send") or api_method.startswith("editMessage")
+
+    @classmethod
+    def get_cost(cls, api_method: str, params: Optional[dict]) -> int:
+        if api_method == "sendMediaGroup" and params and params.get("media"):
+            media = params["media"]
+            if isinstance(media, str):
+                media = json.loads(media)
+            return max(1, len(media))
+        return 1
+
+    def acquire(self, api_method: str, chat_id: Optional[ChatId], params: Optional[dict] = None):
+        """Wait until a request for the given API method and chat can be sent, taking its cost from the budgets."""
+        cost = self.get_cost(api_method, params)
+        low_priority = api_method in self.LOW_PRIORITY_METHODS
+
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                wait = self._get_wait(chat_id=chat_id, low_priority=low_priority, now=now)
+                if wait <= 0:
+                    self._take(chat_id=chat_id, cost=cost, low_priority=low_priority)
+                    self._prune(now)
+                    return
+                self._lock.wait(wait)
+
+    def penalize(self, chat_id: Optional[ChatId], retry_after: float):
+        """Block requests after a 429 response, for the `retry_after` returned by Telegram.
+        If the request had no chat, the global budget is blocked."""
+        until = time.monotonic() + retry_after
+        with self._lock:
+            bucket = self._global_bucket if chat_id is None else self._get_chat_bucket(chat_id)
+            bucket.blocked_until = max(bucket.blocked_until, until)
+
+    def _get_wait(self, chat_id: Optional[ChatId], low_priority: bool, now: float) -> float:
+        # low priority requests must leave a reserve on the global budget, so under load the high priority ones,
+        # which only require one token, get the budget first
+        required_tokens = 1 + (self._low_priority_reserve if low_priority else 0)
+        wait = self._global_bucket.get_wait(now, required_tokens=required_tokens)
+        if chat_id is not None:
+            chat_bucket = self._get_chat_bucket(chat_id)
+            if low_priority:
+                # chat actions are not messages, so they do not count for the chat limits (but honor its 429s)
+                wait = max(wait, chat_bucket.blocked_until - now)
+            else:
+                wait = max(wait, chat_bucket.get_wait(now))
+        return wait
+
+    def _take(self, chat_id: Optional[ChatId], cost: int, low_priority: bool):
+        self._global_bucket.tokens -= cost
+        if chat_id is not None and not low_priority:
+            self._get_chat_bucket(chat_id).tokens -= 1
+
+    def _get_chat_bucket(self, chat_id: ChatId) -> _Bucket:
+        bucket = self._chats_buckets.get(chat_id)
+        if not bucket:
+            if self._is_group(chat_id):
+                bucket = _Bucket(
+                    rate_per_second=self._settings.telegram_bot_outbound_group_per_minute / 60,
+                    burst=self.GROUP_BURST,
+                    now=time.monotonic(),
+                )
+            else:
+                bucket = _Bucket(
+                    rate_per_second=self._settings.telegram_bot_outbound_chat_per_second,
+                    burst=self.CHAT_BURST,
+                    now=time.monotonic(),
+                )
+            self._chats_buckets[chat_id] = bucket
+        return bucket
+
+    def _prune(self, now: float):
+        """Remove the buckets of chats that are full (equivalent to new ones)."""
+        if now - self._last_prune < self.PRUNE_INTERVAL_SECONDS:
+            return
+        self._last_prune = now
+        for chat_id in [chat_id for chat_id, bucket in self._chats_buckets.items() if bucket.is_idle(now)]:
+            del self._chats_buckets[chat_id]
+
+    @staticmethod
+    def _is_group(chat_id: ChatId) -> bool:
+        # groups and channels have negative ids; channels can also be referenced by @username
+        if isinstance(chat_id, str):
+            return not chat_id.lstrip("-").isdigit() or chat_id.startswith("-")
+        return chat_id < 0
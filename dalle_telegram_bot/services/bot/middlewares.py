@@ -1,15 +1,15 @@
 import contextlib
 import time
 import threading
-from threading import Lock
-from collections import Counter
 
 import telebot
+from telebot.async_telebot import AsyncTeleBot
 from telebot.types import Message
 from telebot.apihelper import ApiTelegramException
 
 from . import constants
-from ...logger import logger
+from .. import metrics
+from ...logger import logger, should_log
 from ...utils import get_uuid, exception_is_bot_blocked_by_user
 
 
@@ -18,12 +18,13 @@ def request_middleware(chat_id: int):
     request_id = get_uuid()
     start = time.time()
 
-    with logger.contextualize(request_id=request_id):
+    with logger.contextualize(request_id=request_id), metrics.HANDLER_THREADS_BUSY.track_inprogress():
         try:
-            logger.bind(
-                chat_id=chat_id,
-                thread_name=threading.current_thread().name
-            ).info("Request started")
+            if should_log("INFO", "request"):
+                logger.bind(
+                    chat_id=chat_id,
+                    thread_name=threading.current_thread().name
+                ).info("Request started")
             yield
 
         except Exception as ex:
@@ -53,24 +54,11 @@ def message_request_middleware(bot: telebot.TeleBot, message: Message):
         raise ex
 
 
-class RateLimiter:
-    def __init__(self, limit_per_chat: int):
-        self._limit_per_chat = limit_per_chat
-        self._counter = Counter()
-        self._counter_lock = Lock()
-
-    def increase(self, chat_id: int) -> bool:
-        with self._counter_lock:
-            current = self._counter[chat_id]
-            if current >= self._limit_per_chat:
-                return False
-
-            self._counter[chat_id] = current + 1
-            return True
+@contextlib.asynccontextmanager
+async def async_message_request_middleware(bot: AsyncTeleBot, message: Message):
+    try:
+        yield
+    except Exception as ex:
+        await bot.reply_to(message, constants.UNKNOWN_ERROR_REPLY)
+        raise ex
 
-    def decrease(self, chat_id: int):
-        new_value = self._counter[chat_id] - 1
-        if new_value <= 0:
-            del self._counter[chat_id]
-            return
-        self._counter[chat_id] = new_value
@@ -0,0 +1,340 @@
+import abc
+import time
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from ..redis import Redis
+from ...settings import Settings
+from ...logger import logger
+from ...utils import get_uuid
+
+__all__ = (
+    "AbstractConcurrencyLimiter", "RateLimiter", "RedisRateLimiter",
+    "AbstractTokenBucket", "TokenBucket", "RedisTokenBucket",
+    "RequestRateLimiter", "get_concurrency_limiter",
+)
+
+
+# Concurrency limiters (max concurrent requests per chat)
+
+class AbstractConcurrencyLimiter(abc.ABC):
+    @abc.abstractmethod
+    def increase(self, chat_id: int) -> bool:
+        """Take a slot for the chat. Return False if the chat is at its limit."""
+        pass
+
+    @abc.abstractmethod
+    def decrease(self, chat_id: int):
+        """Release a slot previously taken for the chat."""
+        pass
+
+
+class RateLimiter(AbstractConcurrencyLimiter):
+    """Process-local concurrency limiter."""
+
+    def __init__(self, limit_per_chat: int):
+        self._limit_per_chat = limit_per_chat
+        self._counter = Counter()
+        self._counter_lock = threading.Lock()
+
+    def increase(self, chat_id: int) -> bool:
+        with self._counter_lock:
+            current = self._counter[chat_id]
+            if current >= self._limit_per_chat:
+                return False
+
+            self._counter[chat_id] = current + 1
+            return True
+
+    def decrease(self, chat_id: int):
+        with self._counter_lock:
+            new_value = self._counter[chat_id] - 1
+            if new_value <= 0:
+                self._counter.pop(chat_id, None)
+                return
+            self._counter[chat_id] = new_value
+
+
+class RedisRateLimiter(AbstractConcurrencyLimiter):
+    """Cluster-wide concurrency limiter on Redis, shared by all the bot replicas.
+    Each taken slot is a lease (member of a sorted set per chat, scored by its expiration), renewed in background
+    while the request is in progress; leases not released (e.g. because the replica holding them crashed)
+    are reclaimed once expired.
+    If Redis fails, requests are allowed (fail-open)."""
+
+    INCREASE_SCRIPT = """
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+    local limit = tonumber(ARGV[1])
+    local lease_ms = tonumber(ARGV[2])
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+    if redis.call('ZCARD', KEYS[1]) >= limit then
+        return 0
+    end
+    redis.call('ZADD', KEYS[1], now + lease_ms, ARGV[3])
+    redis.call('PEXPIRE', KEYS[1], lease_ms)
+    return 1
+    """
+
+    RENEW_SCRIPT = """
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+    local lease_ms = tonumber(ARGV[1])
+    for i = 2, #ARGV do
+        redis.call('ZADD', KEYS[1], 'XX', now + lease_ms, ARGV[i])
+    end
+    redis.call('PEXPIRE', KEYS[1], lease_ms)
+    return 1
+    """
+
+    def __init__(self, limit_per_chat: int, lease_seconds: float, redis: Redis, key_prefix: str):
+        self._limit_per_chat = limit_per_chat
+        self._lease_ms = int(lease_seconds * 1000)
+        self._redis = redis
+        self._key_prefix = key_prefix
+        self._increase_script = self._redis.register_script(self.INCREASE_SCRIPT)
+        self._renew_script = self._redis.register_script(self.RENEW_SCRIPT)
+
+        # leases taken by this replica, to release them on decrease, and renew them meanwhile
+        self._leases: Dict[int, List[Optional[str]]] = defaultdict(list)
+        self._leases_lock = threading.Lock()
+        self._renew_thread = threading.Thread(target=self._renew_worker, name="RedisRateLimiterRenew", daemon=True)
+        self._renew_thread.start()
+
+    def increase(self, chat_id: int) -> bool:
+        lease_id = get_uuid()
+        try:
+            allowed = bool(self._increase_script(
+                keys=[self._get_key(chat_id)],
+                args=[self._limit_per_chat, self._lease_ms, lease_id],
+            ))
+        except Exception as ex:
+            logger.opt(exception=ex).warning("Failed checking chat concurrency limit on Redis, allowing request")
+            allowed, lease_id = True, None
+
+        if allowed:
+            with self._leases_lock:
+                self._leases[chat_id].append(lease_id)
+        return allowed
+
+    def decrease(self, chat_id: int):
+        with self._leases_lock:
+            leases = self._leases.get(chat_id)
+            if not leases:
+                return
+            lease_id = leases.pop()
+            if not leases:
+                del self._leases[chat_id]
+
+        if lease_id is None:
+            return
+        try:
+            self._redis.zrem(self._get_key(chat_id), lease_id)
+        except Exception as ex:
+            logger.opt(exception=ex).warning("Failed releasing chat concurrency lease on Redis (will expire)")
+
+    def renew(self):
+        """Extend the expiration of the leases held by this replica"""
+        with self._leases_lock:
+            leases = {chat_id: [lease_id for lease_id in lease_ids if lease_id is not None]
+                      for chat_id, lease_ids in self._leases.items()}
+
+        for chat_id, lease_ids in leases.items():
+            if not lease_ids:
+                continue
+            try:
+                self._renew_script(
+                    keys=[self._get_key(chat_id)],
+                    args=[self._lease_ms, *lease_ids],
+                )
+            except Exception as ex:
+                logger.opt(exception=ex).warning("Failed renewing chat concurrency leases on Redis")
+
+    def _renew_worker(self):
+        while True:
+            time.sleep(self._lease_ms / 1000 / 3)
+            self.renew()
+
+    def _get_key(self, chat_id: int) -> str:
+        return f"{self._key_prefix}/concurrency/{chat_id}"
+
+
+# Token buckets (request rate limits)
+
+class AbstractTokenBucket(abc.ABC):
+    def __init__(self, rate_per_minute: float, burst: int):
+        self._rate_per_second = rate_per_minute / 60
+        self._burst = max(burst, 1)
+
+    @abc.abstractmethod
+    def acquire(self, key: str) -> bool:
+        """Take a token from the bucket identified by key. Return False if the bucket is empty."""
+        pass
+
+    @abc.abstractmethod
+    def refund(self, key: str):
+        """Return a token previously taken from the bucket identified by key (the request was rejected later)."""
+        pass
+
+
+class TokenBucket(AbstractTokenBucket):
+    """Process-local token bucket."""
+
+    def __init__(self, rate_per_minute: float, burst: int):
+        super().__init__(rate_per_minute=rate_per_minute, burst=burst)
+        self._buckets: Dict[str, Tuple[float, float]] = dict()  # key: (tokens, last timestamp)
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str) -> bool:
+        now = time.time()
+        with self._lock:
+            tokens, timestamp = self._buckets.get(key, (self._burst, now))
+            tokens = min(self._burst, tokens + (now - timestamp) * self._rate_per_second)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            if tokens >= self._burst:
+                # full bucket, equivalent to a new one
+                self._buckets.pop(key, None)
+            else:
+                self._buckets[key] = (tokens, now)
+            return allowed
+
+    def refund(self, key: str):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if not bucket:
+                return
+            tokens, timestamp = bucket
+            tokens += 1
+            if tokens >= self._burst:
+                self._buckets.pop(key, None)
+            else:
+                self._buckets[key] = (tokens, timestamp)
+
+
+class RedisTokenBucket(AbstractTokenBucket):
+    """Cluster-wide token bucket on Redis, updated atomically with a Lua script.
+    If Redis fails, requests are allowed (fail-open)."""
+
+    ACQUIRE_SCRIPT = """
+    local t = redis.call('TIME')
+    local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(data[1]) or burst
+    local ts = tonumber(data[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+    return allowed
+    """
+
+    REFUND_SCRIPT = """
+    local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+    if tokens then
+        redis.call('HSET', KEYS[1], 'tokens', tostring(math.min(tonumber(ARGV[1]), tokens + 1)))
+    end
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int, redis: Redis, key_prefix: str):
+        super().__init__(rate_per_minute=rate_per_minute, burst=burst)
+        self._redis = redis
+        self._key_prefix = key_prefix
+        self._acquire_script = self._redis.register_script(self.ACQUIRE_SCRIPT)
+        self._refund_script = self._redis.register_script(self.REFUND_SCRIPT)
+
+    def acquire(self, key: str) -> bool:
+        try:
+            return bool(self._acquire_script(
+                keys=[self._get_key(key)],
+                args=[self._rate_per_second, self._burst],
+            ))
+        except Exception as ex:
+            logger.opt(exception=ex).warning("Failed checking rate limit on Redis, allowing request")
+            return True
+
+    def refund(self, key: str):
+        try:
+            self._refund_script(
+                keys=[self._get_key(key)],
+                args=[self._burst],
+            )
+        except Exception as ex:
+            logger.opt(exception=ex).warning("Failed refunding rate limit token on Redis")
+
+    def _get_key(self, key: str) -> str:
+        return f"{self._key_prefix}/bucket/{key}"
+
+
+class RequestRateLimiter:
+    """Rate limits for requests, with token buckets per chat and global (shared by all chats).
+    Tokens are only spent by allowed requests: when a bucket rejects the request, the tokens taken are refunded.
+    Limits with a rate of 0 are disabled."""
+
+    def __init__(self, settings: Settings, redis: Optional[Redis] = None):
+        self._chat_bucket = self._get_bucket(
+            settings=settings,
+            redis=redis,
+            rate_per_minute=settings.command_generate_chat_rate_limit_per_minute,
+            burst=settings.command_generate_chat_rate_limit_burst,
+        )
+        self._global_bucket = self._get_bucket(
+            settings=settings,
+            redis=redis,
+            rate_per_minute=settings.command_generate_global_rate_limit_per_minute,
+            burst=settings.command_generate_global_rate_limit_burst,
+        )
+
+    def allow(self, chat_id: int) -> bool:
+        if self._chat_bucket and not self._chat_bucket.acquire(f"chat/{chat_id}"):
+            return False
+        if self._global_bucket and not self._global_bucket.acquire("global"):
+            if self._chat_bucket:
+                self._chat_bucket.refund(f"chat/{chat_id}")
+            return False
+        return True
+
+    def refund(self, chat_id: int):
+        """Return the tokens taken by an allowed request, that was rejected later (e.g. by the concurrency limit)"""
+        if self._chat_bucket:
+            self._chat_bucket.refund(f"chat/{chat_id}")
+        if self._global_bucket:
+            self._global_bucket.refund("global")
+
+    @staticmethod
+    def _get_bucket(
+            settings: Settings, redis: Optional[Redis], rate_per_minute: float, burst: int
+    ) -> Optional[AbstractTokenBucket]:
+        if rate_per_minute <= 0:
+            return None
+        if redis and redis.enabled and settings.redis_ratelimit_prefix:
+            return RedisTokenBucket(
+                rate_per_minute=rate_per_minute,
+                burst=burst,
+                redis=redis,
+                key_prefix=settings.redis_ratelimit_prefix,
+            )
+        return TokenBucket(rate_per_minute=rate_per_minute, burst=burst)
+
+
+def get_concurrency_limiter(settings: Settings, redis: Optional[Redis] = None) -> AbstractConcurrencyLimiter:
+    """Return the per-chat concurrency limiter for the Generate command:
+    on Redis (shared by all replicas) if a Redis ratelimit prefix is configured, or process-local otherwise."""
+    if redis and redis.enabled and settings.redis_ratelimit_prefix:
+        return RedisRateLimiter(
+            limit_per_chat=settings.command_generate_chat_concurrent_limit,
+            lease_seconds=settings.command_generate_chat_concurrent_lease_seconds,
+            redis=redis,
+            key_prefix=settings.redis_ratelimit_prefix,
+        )
+    return RateLimiter(limit_per_chat=settings.command_generate_chat_concurrent_limit)
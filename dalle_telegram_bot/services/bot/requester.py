@@ -1,29 +1,32 @@
 import contextlib
 import threading
 import time
-from typing import Dict
+from typing import List, Tuple
 
 import requests
-import wait4it
+import requests.adapters
 import telebot.apihelper
 
+from .governor import OutboundRateGovernor
+from .. import metrics
 from ...settings import Settings
-from ...logger import logger
+from ...logger import logger, should_log
 
 
 class TelegramBotAPIRequester:
     def __init__(self, settings: Settings):
         self._settings = settings
-        self._sessions: Dict[str, requests.Session] = dict()
-        self._sessions_last_timestamp: Dict[str, float] = dict()
-        self._sessions_lock = threading.Lock()
+        self._sessions_pool = RequestsSessionPool(
+            max_sessions=self._settings.telegram_bot_api_max_connections,
+            idle_ttl=self._settings.telegram_bot_api_sessions_ttl_seconds,
+        )
         self._cleanup_thread = None
 
-        telebot.apihelper.CUSTOM_REQUEST_SENDER = wait4it.wait_for_pass(
-            exceptions=[TelegramBotAPITooManyRequestsException],  # TODO Add other Request errors?
-            retries=self._settings.telegram_bot_ratelimit_retries_limit,
-            retries_delay=self._settings.telegram_bot_ratelimit_retry_delay_seconds,
-        )(self.request)
+        self._governor = None
+        if self._settings.telegram_bot_outbound_governor:
+            self._governor = OutboundRateGovernor(settings=self._settings)
+
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = self.request
 
     def start(self):
         """Start the cleanup thread"""
@@ -34,69 +37,180 @@ class TelegramBotAPIRequester:
             target=self._cleanup_worker,
             name="TelegramBotAPIRequester-cleanup",
             daemon=True,
-        ).start()
-
-    def request(self, *args, **kwargs):
-        if self._settings.telegram_bot_api_sessions_enabled:
-            session = self.get_session()
-            r = session.request(*args, **kwargs)
-        else:
-            r = requests.request(*args, **kwargs)
-
-        if self._response_is_toomanyrequests(r):
-            raise TelegramBotAPITooManyRequestsException(r.json().get("description"))
-        return r
-
-    def get_session(self) -> requests.Session:
-        thread_name = threading.current_thread().name
-        with self._sessions_lock:
-            self._sessions_last_timestamp[thread_name] = time.time()
-            session = self._sessions.get(thread_name)
-
-            if not session:
-                session = requests.Session()
-                self._sessions[thread_name] = session
-                logger.bind(thread_name=thread_name).trace("New requests.Session created")
+        )
+        self._cleanup_thread.start()
+
+    def request(self, method: str, url: str, *args, **kwargs):
+        """Perform a Telegram Bot API request, paced by the outbound governor (if enabled).
+        Requests failed because of Too Many Requests are retried (if enabled) after the retry_after returned by Telegram,
+        until the ratelimit retry timeout."""
+        api_method = url.rsplit("/", 1)[-1]
+        params = kwargs.get("params") or dict()
+        chat_id = params.get("chat_id")
+        governed = self._governor is not None and self._governor.is_governed(api_method)
+        deadline = time.time() + self._settings.telegram_bot_ratelimit_retry_timeout_seconds
 
-        return session
+        while True:
+            if governed:
+                self._governor.acquire(api_method=api_method, chat_id=chat_id, params=params)
+
+            r = self._send_request(method, url, *args, api_method=api_method, **kwargs)
+            if not self._response_is_toomanyrequests(r):
+                return r
+
+            metrics.TELEGRAM_API_RATELIMIT_RETRIES.labels(method=api_method).inc()
+            retry_after = self._get_retry_after(r)
+            if self._governor:
+                self._governor.penalize(chat_id=chat_id, retry_after=retry_after)
+
+            if not self._settings.telegram_bot_ratelimit_retry or time.time() + retry_after >= deadline:
+                raise TelegramBotAPITooManyRequestsException(api_method, r, self._get_result_json(r))
+
+            logger.bind(api_method=api_method, retry_after=retry_after).\
+                warning("Telegram Bot API request failed with Too Many Requests, retrying")
+            if not governed:
+                # governed requests wait for the penalty on the governor
+                time.sleep(retry_after)
+
+    def _send_request(self, method: str, url: str, *args, api_method: str, **kwargs) -> requests.Response:
+        with metrics.TELEGRAM_API_REQUEST_DURATION.labels(method=api_method).time():
+            if self._settings.telegram_bot_api_sessions_enabled:
+                with self._sessions_pool.checkout() as session:
+                    return session.request(method, url, *args, **kwargs)
+            return requests.request(method, url, *args, **kwargs)
 
     def teardown(self):
-        with logger.contextualize(sessions_count=len(self._sessions)):
-            logger.debug("Closing TelegramBotAPI request sessions...")
-            for k in list(self._sessions.keys()):
-                self.stop_session(k)
-
-            logger.info("Closed TelegramBotAPI request sessions")
-
-    def stop_session(self, thread_name: str):
-        with self._sessions_lock:
-            session = self._sessions.pop(thread_name, None)
-            self._sessions_last_timestamp.pop(thread_name, None)
-
-        if not session:
-            return
-
-        with contextlib.suppress(Exception):
-            logger.bind(thread_name=thread_name).trace("Stopping requests.Session")
-            session.close()
+        logger.debug("Closing TelegramBotAPI request sessions...")
+        closed_count = self._sessions_pool.close()
+        logger.bind(sessions_count=closed_count).info("Closed TelegramBotAPI request sessions")
 
     def _cleanup_worker(self):
         logger.debug("Start of TelegramBotAPIRequester requests.Sessions cleanup worker")
         while True:
-            with self._sessions_lock:
-                sessions_timestamps = tuple(self._sessions_last_timestamp.items())
+            time.sleep(30)
+            self._sessions_pool.evict_idle()
 
-            now = time.time()
-            for session_threadname, session_timestamp in sessions_timestamps:
-                if (now - session_timestamp) >= self._settings.telegram_bot_api_sessions_ttl_seconds:
-                    self.stop_session(session_threadname)
+    @staticmethod
+    def _get_result_json(response: requests.Response) -> dict:
+        with contextlib.suppress(Exception):
+            return response.json()
+        return dict(ok=False, error_code=response.status_code, description=response.text)
 
-            time.sleep(30)
+    def _get_retry_after(self, response: requests.Response) -> float:
+        with contextlib.suppress(Exception):
+            return float(response.json()["parameters"]["retry_after"])
+        return self._settings.telegram_bot_ratelimit_retry_delay_seconds
 
     @staticmethod
     def _response_is_toomanyrequests(response: requests.Response) -> bool:
         return response.status_code == 429
 
 
-class TelegramBotAPITooManyRequestsException(Exception):
+class RequestsSessionPool:
+    """Bounded pool of requests.Session, shared by all the threads: each request checks out a session
+    (waiting if all of them are in use) and returns it when completed, keeping its connection warm for the next one.
+    Sessions are reused LIFO, so the least used ones stay idle and are closed after the idle TTL.
+    Sessions whose request failed with a connection error are closed instead of returned."""
+
+    def __init__(self, max_sessions: int, idle_ttl: float):
+        self._max_sessions = max_sessions
+        self._idle_ttl = idle_ttl
+        self._idle_sessions: List[Tuple[requests.Session, float]] = list()  # (session, returned at); last is newest
+        self._sessions_count = 0
+        self._closed = False
+        self._lock = threading.Condition()
+
+    @contextlib.contextmanager
+    def checkout(self):
+        session = self._acquire()
+        healthy = True
+        try:
+            yield session
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            healthy = False
+            raise
+        finally:
+            self._release(session, healthy)
+
+    def evict_idle(self):
+        """Close the sessions not used for the idle TTL"""
+        min_timestamp = time.monotonic() - self._idle_ttl
+        with self._lock:
+            expired_count = 0
+            while expired_count < len(self._idle_sessions) and self._idle_sessions[expired_count][1] < min_timestamp:
+                expired_count += 1
+            expired = [session for session, _ in self._idle_sessions[:expired_count]]
+            del self._idle_sessions[:expired_count]
+            self._sessions_count -= expired_count
+            self._update_metrics()
+
+        for session in expired:
+            self._close_session(session)
+        if expired and should_log("DEBUG", "session"):
+            logger.bind(sessions_count=len(expired)).debug("Closed idle requests.Sessions")
+
+    def close(self) -> int:
+        """Close the idle sessions; sessions in use are closed when returned. Return the count of closed sessions."""
+        with self._lock:
+            self._closed = True
+            sessions = [session for session, _ in self._idle_sessions]
+            self._idle_sessions.clear()
+            self._sessions_count -= len(sessions)
+            self._update_metrics()
+
+        for session in sessions:
+            self._close_session(session)
+        return len(sessions)
+
+    def _acquire(self) -> requests.Session:
+        with self._lock:
+            while True:
+                if self._idle_sessions:
+                    return self._idle_sessions.pop()[0]
+                if self._sessions_count < self._max_sessions:
+                    self._sessions_count += 1
+                    self._update_metrics()
+                    break
+                self._lock.wait()
+
+        if should_log("TRACE", "session"):
+            logger.trace("New requests.Session created")
+        return self._new_session()
+
+    def _release(self, session: requests.Session, healthy: bool):
+        with self._lock:
+            keep = healthy and not self._closed
+            if keep:
+                self._idle_sessions.append((session, time.monotonic()))
+            else:
+                self._sessions_count -= 1
+                self._update_metrics()
+            self._lock.notify()
+
+        if not keep:
+            if should_log("TRACE", "session"):
+                logger.bind(healthy=healthy).trace("Stopping requests.Session")
+            self._close_session(session)
+
+    @staticmethod
+    def _new_session() -> requests.Session:
+        # each session serves one request at a time, so needs a single connection per host
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @staticmethod
+    def _close_session(session: requests.Session):
+        with contextlib.suppress(Exception):
+            session.close()
+
+    def _update_metrics(self):
+        metrics.TELEGRAM_API_SESSIONS.set(self._sessions_count)
+
+
+class TelegramBotAPITooManyRequestsException(telebot.apihelper.ApiTelegramException):
+    """Too Many Requests not retried. Subclass of the exception raised by telebot for failed requests,
+    so it is handled the same as when the requester is not used."""
     pass
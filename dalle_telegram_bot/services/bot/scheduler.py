@@ -0,0 +1,128 @@
+import asyncio
+import threading
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from ...logger import logger
+
+
+class GenerationTicket:
+    """A request for a generation slot, returned by GenerationScheduler.enqueue."""
+
+    def __init__(self, chat_id: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.chat_id = chat_id
+        self.granted = False
+        self._event = threading.Event()
+        self._loop = loop
+        self._future: Optional[asyncio.Future] = loop.create_future() if loop else None
+
+    def grant(self):
+        """Mark the ticket as granted and wake up its waiter. Must be called with the scheduler lock held."""
+        self.granted = True
+        self._event.set()
+        if self._future:
+            self._loop.call_soon_threadsafe(self._set_future_result)
+
+    def _set_future_result(self):
+        if not self._future.done():
+            self._future.set_result(True)
+
+
+class GenerationScheduler:
+    """Global admission control for DALLE generations.
+    At most `concurrent_limit` generations run at once; waiting requests are queued per chat,
+    and slots are granted round-robin across chats, so a single chat can not starve the others."""
+
+    def __init__(self, concurrent_limit: int):
+        self._concurrent_limit = concurrent_limit
+        self._running = 0
+        self._chats_queues: Dict[int, Deque[GenerationTicket]] = dict()
+        self._chats_order: Deque[int] = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def queued(self) -> int:
+        with self._lock:
+            return sum(len(q) for q in self._chats_queues.values())
+
+    def enqueue(self, chat_id: int, loop: Optional[asyncio.AbstractEventLoop] = None) -> GenerationTicket:
+        """Queue a request for a generation slot. The ticket may be granted immediately, if slots are available.
+        :param loop: asyncio event loop where the ticket will be awaited, if using wait_async"""
+        ticket = GenerationTicket(chat_id=chat_id, loop=loop)
+        with self._lock:
+            queue = self._chats_queues.get(chat_id)
+            if queue is None:
+                queue = self._chats_queues[chat_id] = deque()
+                self._chats_order.append(chat_id)
+            queue.append(ticket)
+            self._dispatch()
+
+        return ticket
+
+    def position(self, ticket: GenerationTicket) -> int:
+        """Return the position (starting at 1) of the ticket on the queue, or 0 if granted or not queued."""
+        with self._lock:
+            if ticket.granted:
+                return 0
+
+            # simulate the round-robin dispatching
+            queues = {chat_id: list(queue) for chat_id, queue in self._chats_queues.items()}
+            position = 0
+            rnd = 0
+            while True:
+                for chat_id in self._chats_order:
+                    queue = queues[chat_id]
+                    if rnd >= len(queue):
+                        continue
+                    if queue[rnd] is ticket:
+                        return position + 1
+                    position += 1
+                rnd += 1
+                if rnd > len(queues.get(ticket.chat_id, ())):
+                    # ticket not queued (released)
+                    return 0
+
+    def wait(self, ticket: GenerationTicket, timeout: Optional[float] = None) -> bool:
+        """Block until the ticket is granted. Return False on timeout."""
+        return ticket._event.wait(timeout)
+
+    async def wait_async(self, ticket: GenerationTicket, timeout: Optional[float] = None) -> bool:
+        """Wait (on an asyncio event loop) until the ticket is granted. Return False on timeout."""
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket._future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def release(self, ticket: GenerationTicket):
+        """Release the slot of a granted ticket, or remove a not-yet granted ticket from the queue."""
+        with self._lock:
+            if ticket.granted:
+                self._running -= 1
+            else:
+                queue = self._chats_queues.get(ticket.chat_id)
+                if queue and ticket in queue:
+                    queue.remove(ticket)
+                    if not queue:
+                        del self._chats_queues[ticket.chat_id]
+                        self._chats_order.remove(ticket.chat_id)
+            self._dispatch()
+
+    def _dispatch(self):
+        """Grant queued tickets while slots are available. Must be called with the lock held."""
+        while self._running < self._concurrent_limit and self._chats_order:
+            chat_id = self._chats_order.popleft()
+            queue = self._chats_queues[chat_id]
+            ticket = queue.popleft()
+            if queue:
+                self._chats_order.append(chat_id)
+            else:
+                del self._chats_queues[chat_id]
+
+            self._running += 1
+            ticket.grant()
+            logger.bind(chat_id=chat_id, generations_running=self._running).trace("Generation slot granted")
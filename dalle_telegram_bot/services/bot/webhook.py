@@ -0,0 +1,125 @@
+import hmac
+import json
+import threading
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Optional
+
+from telebot.types import Update
+
+from .dispatcher import BoundedExecutor
+from ...settings import Settings
+from ...logger import logger
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """Lightweight HTTP server receiving Telegram updates via Webhook.
+    Each connection is served on its own thread (Telegram keeps up to `telegram_bot_webhook_max_connections`
+    concurrent connections). Received updates are validated (path and secret token) and submitted to a bounded executor,
+    whose threads call `dispatcher` with each update. When the executor queue is full, the request is
+    rejected with 503, so Telegram retries it later."""
+
+    # dispatching an update only routes it to the bot executors, so a few threads are enough
+    DISPATCHER_THREADS = 4
+
+    def __init__(self, settings: Settings, dispatcher: Callable[[Update], None]):
+        self._settings = settings
+        self._dispatcher = dispatcher
+        self._executor = BoundedExecutor(
+            name="webhook",
+            threads=self.DISPATCHER_THREADS,
+            queue_size=self._settings.telegram_bot_webhook_queue_size,
+        )
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._server_thread: Optional[threading.Thread] = None
+
+    @property
+    def queue_size(self) -> int:
+        return self._executor.queue_size
+
+    def start(self):
+        if self._server:
+            return
+
+        self._server = ThreadingHTTPServer(
+            (self._settings.telegram_bot_webhook_listen_host, self._settings.telegram_bot_webhook_listen_port),
+            self._get_request_handler_class(),
+        )
+        self._server_thread = threading.Thread(
+            target=self._server.serve_forever,
+            name="TelegramBotWebhookServer",
+            daemon=True,
+        )
+        self._server_thread.start()
+        self._executor.start()
+
+        logger.bind(
+            host=self._settings.telegram_bot_webhook_listen_host,
+            port=self._settings.telegram_bot_webhook_listen_port,
+        ).info("Webhook server started")
+
+    def stop(self, wait_pending: bool = False):
+        """Stop receiving updates. If wait_pending, wait until the queued updates are dispatched and completed."""
+        if not self._server:
+            return
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        self._executor.shutdown(wait=wait_pending)
+        logger.info("Webhook server stopped")
+
+    def enqueue(self, update: Update) -> bool:
+        """Queue an update for dispatching. Return False if the queue is full."""
+        return self._executor.submit(self._dispatch, update)
+
+    def _dispatch(self, update: Update):
+        try:
+            self._dispatcher(update)
+        except Exception as ex:
+            logger.opt(exception=ex).error("Failed dispatching webhook update")
+
+    def _get_request_handler_class(self):
+        server = self
+
+        class WebhookRequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server._settings.telegram_bot_webhook_path:
+                    self._reply(HTTPStatus.NOT_FOUND)
+                    return
+
+                secret_token = server._settings.telegram_bot_webhook_secret_token
+                if secret_token and not hmac.compare_digest(
+                        self.headers.get(SECRET_TOKEN_HEADER, ""), secret_token
+                ):
+                    logger.warning("Webhook request with invalid secret token")
+                    self._reply(HTTPStatus.FORBIDDEN)
+                    return
+
+                try:
+                    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                    update = Update.de_json(json.loads(body))
+                except Exception as ex:
+                    logger.opt(exception=ex).warning("Invalid webhook request body")
+                    self._reply(HTTPStatus.BAD_REQUEST)
+                    return
+
+                if not server.enqueue(update):
+                    logger.warning("Webhook updates queue full, rejecting update")
+                    self._reply(HTTPStatus.SERVICE_UNAVAILABLE)
+                    return
+
+                self._reply(HTTPStatus.OK)
+
+            def _reply(self, status: HTTPStatus):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *_):
+                # disable stderr logging of requests
+                pass
+
+        return WebhookRequestHandler
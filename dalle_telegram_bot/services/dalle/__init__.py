@@ -1,2 +1,6 @@
 from .dalle import *
+from .dalle_async import *
+from .cache import *
 from .exceptions import *
+from .index import *
+from .prewarmer import *
@@ -0,0 +1,165 @@
+import random
+import threading
+from typing import List, Optional, Union
+from urllib.parse import urljoin
+
+import requests
+
+from .. import metrics
+from ...settings import Settings
+from ...logger import logger, should_log
+
+__all__ = ("DalleBackend", "DalleLoadBalancer")
+
+
+class DalleBackend:
+    def __init__(self, url: str, weight: float):
+        self.url = url
+        self.weight = weight
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected = False
+
+        self.requests_count = 0
+        self.errors_count = 0
+        self.unavailable_count = 0
+        self.latency_ewma: Optional[float] = None
+
+    @property
+    def stats(self) -> dict:
+        return dict(
+            url=self.url,
+            weight=self.weight,
+            outstanding=self.outstanding,
+            ejected=self.ejected,
+            requests=self.requests_count,
+            errors=self.errors_count,
+            unavailable=self.unavailable_count,
+            latency_ewma_seconds=round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+        )
+
+
+class DalleLoadBalancer:
+    """Spread the DALLE requests across the configured backends, choosing the backend with the fewest
+    outstanding requests (relative to its weight). Backends failing (errors or 5xx) several times in a row are
+    ejected, and re-admitted once an active health probe succeeds. A 503 is the normal reply of a busy DALLE,
+    so it does not count towards ejecting a backend. If all the backends are ejected,
+    all of them are used again (better than failing every request)."""
+
+    LATENCY_EWMA_ALPHA = 0.2
+
+    def __init__(self, settings: Settings):
+        self._settings = settings
+        self._backends = [DalleBackend(url=url, weight=weight) for url, weight in self._settings.dalle_api_backends]
+        self._lock = threading.Lock()
+        self._probe_thread: Optional[threading.Thread] = None
+        self._probe_event = threading.Event()
+        self._running = True
+
+        for backend in self._backends:
+            metrics.DALLE_BACKEND_HEALTHY.labels(backend=backend.url).set(1)
+
+    @property
+    def backends(self) -> List[DalleBackend]:
+        return self._backends
+
+    @property
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [backend.stats for backend in self._backends]
+
+    def pick(self) -> DalleBackend:
+        """Choose the backend for a request. It must be released with `release` after the request."""
+        with self._lock:
+            candidates = [backend for backend in self._backends if not backend.ejected] or self._backends
+            min_load = min((backend.outstanding + 1) / backend.weight for backend in candidates)
+            backend = random.choice([
+                backend for backend in candidates if (backend.outstanding + 1) / backend.weight == min_load
+            ])
+            backend.outstanding += 1
+            metrics.DALLE_BACKEND_OUTSTANDING.labels(backend=backend.url).set(backend.outstanding)
+            return backend
+
+    def release(self, backend: DalleBackend, status: Union[int, str], duration: float):
+        """Record the result of a request sent to a backend: the status code of the response,
+        or "error" if no response was received."""
+        metrics.DALLE_REQUEST_DURATION.labels(backend=backend.url, status=status).observe(duration)
+        failed = status == "error" or status >= 500
+        # busy, but alive: counted as unavailable, but does not count for (nor resets) the consecutive failures
+        busy = status == 503
+
+        with self._lock:
+            backend.outstanding -= 1
+            backend.requests_count += 1
+            if status == 503:
+                backend.unavailable_count += 1
+            elif failed:
+                backend.errors_count += 1
+            if backend.latency_ewma is None:
+                backend.latency_ewma = duration
+            else:
+                backend.latency_ewma += self.LATENCY_EWMA_ALPHA * (duration - backend.latency_ewma)
+            metrics.DALLE_BACKEND_OUTSTANDING.labels(backend=backend.url).set(backend.outstanding)
+
+            if busy:
+                return
+            if not failed:
+                backend.consecutive_failures = 0
+                return
+
+            backend.consecutive_failures += 1
+            threshold = self._settings.dalle_backend_eject_failures_threshold
+            if backend.ejected or threshold <= 0 or backend.consecutive_failures < threshold or len(self._backends) < 2:
+                return
+            backend.ejected = True
+
+        metrics.DALLE_BACKEND_HEALTHY.labels(backend=backend.url).set(0)
+        logger.bind(backend=backend.url, consecutive_failures=backend.consecutive_failures).\
+            warning("DALLE backend ejected")
+        self._start_probe_thread()
+
+    def close(self):
+        self._running = False
+        self._probe_event.set()
+
+    def _start_probe_thread(self):
+        with self._lock:
+            if self._probe_thread:
+                return
+            self._probe_thread = threading.Thread(
+                target=self._probe_worker,
+                name="DalleLoadBalancer-probes",
+                daemon=True,
+            )
+        self._probe_thread.start()
+
+    def _probe_worker(self):
+        while not self._probe_event.wait(self._settings.dalle_backend_probe_interval_seconds) and self._running:
+            for backend in [backend for backend in self._backends if backend.ejected]:
+                if self._probe(backend):
+                    with self._lock:
+                        backend.ejected = False
+                        backend.consecutive_failures = 0
+                    metrics.DALLE_BACKEND_HEALTHY.labels(backend=backend.url).set(1)
+                    logger.bind(backend=backend.url).info("DALLE backend re-admitted")
+
+    def _probe(self, backend: DalleBackend) -> bool:
+        """Health probe, with a GET request.
+        If a health endpoint is configured (`dalle_backend_probe_path`, relative to the backend URL), the backend
+        is healthy if it replies with a 2xx status. Otherwise, the backend URL (the generate endpoint) is probed,
+        and any HTTP response (usually a 405) means the backend is alive."""
+        probe_path = self._settings.dalle_backend_probe_path
+        url = urljoin(backend.url, probe_path.lstrip("/")) if probe_path else backend.url
+        try:
+            response = requests.get(
+                url=url,
+                timeout=self._settings.dalle_api_connect_timeout_seconds,
+                proxies=self._settings.dalle_api_request_socks_proxy_for_requests_lib,
+            )
+            healthy = 200 <= response.status_code < 300 if probe_path else True
+            if not healthy and should_log("DEBUG", "dalle_request"):
+                logger.bind(backend=backend.url, status_code=response.status_code).debug("DALLE backend probe failed")
+            return healthy
+        except Exception as ex:
+            logger.bind(backend=backend.url, error=str(ex)).debug("DALLE backend probe failed")
+            return False
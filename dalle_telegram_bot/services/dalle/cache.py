@@ -0,0 +1,147 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple, List
+
+from .models import DalleResponse
+from ..redis import Redis
+from ...settings import Settings
+from ...logger import logger
+from ...utils import normalize_prompt
+
+__all__ = ("DalleCache",)
+
+
+class DalleCache:
+    """Cache of DALLE responses, keyed by normalized prompt.
+    Results are kept on an in-process LRU with TTL; if Redis is configured with a cache prefix,
+    results are also stored on Redis, so they can be shared between multiple bot instances."""
+
+    def __init__(self, settings: Settings, redis: Optional[Redis] = None):
+        self._settings = settings
+        self._redis = redis
+        self._entries: "OrderedDict[str, Tuple[float, DalleResponse]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._settings.dalle_cache_enabled and self._settings.dalle_cache_size > 0
+
+    @property
+    def redis_enabled(self) -> bool:
+        return bool(self._redis and self._redis.enabled and self._settings.redis_dalle_cache_prefix)
+
+    @property
+    def stats(self) -> dict:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self._entries),
+        )
+
+    def get(self, prompt: str) -> Optional[DalleResponse]:
+        if not self.enabled:
+            return None
+
+        key = normalize_prompt(prompt)
+        response = self._memory_get(key)
+        if response is None and self.redis_enabled:
+            response = self._redis_get(key)
+            if response is not None:
+                self._memory_set(key, response, self._settings.dalle_cache_ttl_seconds)
+
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        logger.bind(cache_hit=response is not None, **self.stats).trace("DALLE cache lookup")
+        return response
+
+    def contains(self, prompt: str) -> bool:
+        """Return True if the prompt is cached, without counting a hit or miss, nor refreshing the entry"""
+        if not self.enabled:
+            return False
+
+        key = normalize_prompt(prompt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                return True
+
+        if not self.redis_enabled:
+            return False
+        try:
+            return self._redis.exists(self._redis_key(key))
+        except Exception as ex:
+            logger.opt(exception=ex).warning("Failed reading DALLE cache from Redis")
+            return False
+
+    def set(self, prompt: str, response: DalleResponse, ttl_seconds: Optional[float] = None):
+        """Cache a response, for `ttl_seconds` (by default, `dalle_cache_ttl_seconds`)"""
+        if not self.enabled:
+            return
+
+        key = normalize_prompt(prompt)
+        ttl_seconds = ttl_seconds or self._settings.dalle_cache_ttl_seconds
+        self._memory_set(key, response, ttl_seconds)
+        if self.redis_enabled:
+            self._redis_set(key, response, ttl_seconds)
+
+    def set_telegram_file_ids(self, prompt: str, response: DalleResponse, file_ids: List[str]):
+        """Store the Telegram file_ids of an uploaded result, so further deliveries can avoid uploading the images."""
+        self.set(prompt, response.copy(update=dict(telegram_file_ids=file_ids)))
+
+    def _memory_get(self, key: str) -> Optional[DalleResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expiration, response = entry
+            if expiration <= time.time():
+                del self._entries[key]
+                self.evictions += 1
+                return None
+
+            self._entries.move_to_end(key)
+            return response
+
+    def _memory_set(self, key: str, response: DalleResponse, ttl_seconds: float):
+        expiration = time.time() + ttl_seconds
+        with self._lock:
+            self._entries[key] = (expiration, response)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._settings.dalle_cache_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _redis_get(self, key: str) -> Optional[DalleResponse]:
+        try:
+            data = self._redis.get(self._redis_key(key))
+            if data is None:
+                return None
+            return DalleResponse.parse_raw(data)
+        except Exception as ex:
+            logger.opt(exception=ex).warning("Failed reading DALLE cache from Redis")
+            return None
+
+    def _redis_set(self, key: str, response: DalleResponse, ttl_seconds: float):
+        try:
+            self._redis.set(
+                key=self._redis_key(key),
+                value=response.json().encode(),
+                ttl_seconds=ttl_seconds,
+            )
+        except Exception as ex:
+            logger.opt(exception=ex).warning("Failed writing DALLE cache to Redis")
+
+    def _redis_key(self, key: str) -> str:
+        return f"{self._settings.redis_dalle_cache_prefix}/{key}"
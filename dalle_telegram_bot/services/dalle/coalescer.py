@@ -0,0 +1,49 @@
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, TypeVar
+
+from ...logger import logger
+
+__all__ = ("RequestCoalescer",)
+
+T = TypeVar("T")
+
+
+class RequestCoalescer:
+    """Single-flight: concurrent calls for the same key wait on one execution of the function,
+    and all of them get its result (or exception)."""
+
+    def __init__(self):
+        self._inflight: Dict[str, Future] = dict()
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def is_inflight(self, key: str) -> bool:
+        with self._lock:
+            return key in self._inflight
+
+    def run(self, key: str, func: Callable[..., T], *args, **kwargs) -> T:
+        with self._lock:
+            future = self._inflight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._inflight[key] = future
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            logger.debug("Waiting for an in-flight request with the same key")
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
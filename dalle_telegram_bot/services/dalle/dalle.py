@@ -1,39 +1,246 @@
+import contextlib
+import time
+import threading
+from typing import Optional, List, Iterator, TYPE_CHECKING
+
 import requests
-import wait4it
+import requests.adapters
 
+from .cache import DalleCache
+from .coalescer import RequestCoalescer
+from .balancer import DalleLoadBalancer
+from .retry import CircuitBreaker, get_backoff_delay
 from .models import DalleResponse
 from .exceptions import DalleTemporarilyUnavailableException
+from .. import metrics
 from ...settings import Settings
-from ...logger import logger
+from ...logger import logger, should_log
+from ...utils import normalize_prompt
+
+if TYPE_CHECKING:
+    from .prewarmer import PromptPopularity
 
 __all__ = ("Dalle",)
 
 
+class _PrewarmFailedException(Exception):
+    """A prewarm generation failed; user requests waiting on it must request the generation themselves"""
+    pass
+
+
 class Dalle:
-    def __init__(self, settings: Settings):
+    def __init__(
+            self,
+            settings: Settings,
+            cache: Optional[DalleCache] = None,
+            popularity: Optional["PromptPopularity"] = None,
+    ):
         self._settings = settings
-
-        self._generate_until_complete = wait4it.wait_for_pass(
-            exceptions=(DalleTemporarilyUnavailableException,),
-            retries=self._settings.dalle_generation_retries_limit,
-            retries_delay=self._settings.dalle_generation_retry_delay_seconds,
-        )(lambda prompt: self._simple_request(prompt))
+        self._cache = cache
+        self._popularity = popularity
+        self._inflight_count = 0
+        self._inflight_lock = threading.Lock()
+        self._coalescer = RequestCoalescer()
+        self._balancer = DalleLoadBalancer(settings=self._settings)
+        self._session: Optional[requests.Session] = None
+        self._session_last_used = 0.0
+        self._session_active = 0
+        self._session_lock = threading.Lock()
+        self._circuit_breaker = CircuitBreaker(
+            failure_threshold=self._settings.dalle_circuit_breaker_failures_threshold,
+            reset_timeout=self._settings.dalle_circuit_breaker_reset_seconds,
+            probe_interval=self._settings.dalle_generation_retry_delay_seconds,
+        )
 
     def generate(self, prompt: str) -> DalleResponse:
-        return self._generate_until_complete(prompt)
+        if self._popularity:
+            self._popularity.record(prompt)
+        response = self.get_cached(prompt)
+        if response:
+            logger.debug("DALLE response returned from cache")
+            return response
+
+        if not self._settings.dalle_coalesce_requests:
+            return self._generate_and_cache(prompt)
+        while True:
+            try:
+                return self._coalescer.run(normalize_prompt(prompt), self._generate_and_cache, prompt)
+            except _PrewarmFailedException:
+                # waited on a prewarm of the same prompt, which failed
+                continue
+
+    def is_generating(self, prompt: str) -> bool:
+        """Return True if the prompt is being generated, and a request for it would wait on that generation"""
+        return self._settings.dalle_coalesce_requests and self._coalescer.is_inflight(normalize_prompt(prompt))
+
+    def get_cached(self, prompt: str) -> Optional[DalleResponse]:
+        if not self._cache:
+            return None
+        return self._cache.get(prompt)
+
+    def is_cached(self, prompt: str) -> bool:
+        """Return True if the prompt is cached (not counted on the cache stats)"""
+        return bool(self._cache and self._cache.contains(prompt))
+
+    def prewarm(self, prompt: str) -> bool:
+        """Generate and cache a prompt in background, with a single DALLE request (not retried, and not counted
+        by the circuit breaker, so it never affects user requests). Return False if the generation failed.
+        User requests for the prompt arriving meanwhile wait on the prewarm generation (if coalescing is enabled)."""
+        try:
+            if not self._settings.dalle_coalesce_requests:
+                self._prewarm_and_cache(prompt)
+            else:
+                self._coalescer.run(normalize_prompt(prompt), self._prewarm_and_cache, prompt)
+        except _PrewarmFailedException:
+            return False
+        except Exception:
+            # joined an in-flight user generation, which failed (and was logged by its request)
+            return False
+        return True
+
+    @property
+    def inflight_count(self) -> int:
+        """Number of user generations in progress (including those waiting to retry)"""
+        return self._inflight_count
+
+    @property
+    def circuit_closed(self) -> bool:
+        return self._circuit_breaker.state == CircuitBreaker.CLOSED
+
+    @property
+    def backends_stats(self) -> List[dict]:
+        return self._balancer.stats
+
+    def close(self):
+        """Close the connections pool"""
+        self._balancer.close()
+        with self._session_lock:
+            if self._session:
+                self._session.close()
+                self._session = None
+
+    @contextlib.contextmanager
+    def _use_session(self) -> Iterator[requests.Session]:
+        """Use the session for DALLE requests, shared by all threads, keeping a bounded pool of keep-alive connections.
+        If the pool was not used for the idle timeout (since the last request completed, with no requests in progress),
+        its connections are closed."""
+        with self._session_lock:
+            now = time.monotonic()
+            if self._session and not self._session_active and \
+                    now - self._session_last_used >= self._settings.dalle_api_pool_idle_seconds:
+                logger.trace("Closing idle DALLE connections")
+                self._session.close()
+                self._session = None
+
+            if not self._session:
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self._settings.dalle_api_pool_size,
+                )
+                self._session = requests.Session()
+                self._session.mount("http://", adapter)
+                self._session.mount("https://", adapter)
+                proxies = self._settings.dalle_api_request_socks_proxy_for_requests_lib
+                if proxies:
+                    self._session.proxies.update(proxies)
+
+            self._session_active += 1
+            session = self._session
+
+        try:
+            yield session
+        finally:
+            with self._session_lock:
+                self._session_active -= 1
+                self._session_last_used = time.monotonic()
+
+    def _generate_and_cache(self, prompt: str) -> DalleResponse:
+        with self._inflight_lock:
+            self._inflight_count += 1
+        try:
+            with metrics.DALLE_GENERATIONS_IN_FLIGHT.track_inprogress():
+                response = self._generate_until_complete(prompt)
+        finally:
+            with self._inflight_lock:
+                self._inflight_count -= 1
+        if self._cache:
+            self._cache.set(prompt, response)
+        return response
+
+    def _prewarm_and_cache(self, prompt: str) -> DalleResponse:
+        try:
+            response = self._simple_request(prompt)
+        except DalleTemporarilyUnavailableException as ex:
+            raise _PrewarmFailedException() from ex
+        except Exception as ex:
+            logger.bind(error=str(ex)).warning("DALLE prewarm request failed")
+            raise _PrewarmFailedException() from ex
+
+        if self._cache:
+            self._cache.set(prompt, response, ttl_seconds=self._settings.prewarm_cache_ttl_seconds)
+        return response
+
+    def _generate_until_complete(self, prompt: str) -> DalleResponse:
+        """Request DALLE until a generation is completed, retrying while the backend is unavailable (503),
+        with exponential backoff and jitter, and honoring the circuit breaker. Fails after the generation timeout."""
+        deadline = time.time() + self._settings.dalle_generation_timeout_seconds
+        attempt = 0
+        while True:
+            delay = self._circuit_breaker.acquire()
+            if not delay:
+                try:
+                    response = self._simple_request(prompt)
+                except DalleTemporarilyUnavailableException:
+                    self._circuit_breaker.record_failure()
+                    delay = get_backoff_delay(
+                        attempt=attempt,
+                        base_delay=self._settings.dalle_generation_retry_delay_seconds,
+                        max_delay=self._settings.dalle_generation_retry_max_delay_seconds,
+                    )
+                    attempt += 1
+                except Exception:
+                    self._circuit_breaker.record_failure()
+                    metrics.DALLE_GENERATION_ATTEMPTS.labels(result="error").observe(attempt + 1)
+                    raise
+                else:
+                    self._circuit_breaker.record_success()
+                    metrics.DALLE_GENERATION_ATTEMPTS.labels(result="success").observe(attempt + 1)
+                    return response
+
+            if time.time() + delay >= deadline:
+                metrics.DALLE_GENERATION_ATTEMPTS.labels(result="timeout").observe(attempt)
+                logger.bind(attempts=attempt, circuit_breaker=self._circuit_breaker.state).\
+                    warning("DALLE generation timed out")
+                raise DalleTemporarilyUnavailableException()
+
+            if should_log("TRACE", "dalle_request"):
+                logger.bind(retry_delay=round(delay, 3)).trace("Waiting before retrying DALLE request")
+            time.sleep(delay)
 
     def _simple_request(self, prompt: str) -> DalleResponse:
-        logger.debug("Requesting DALLE...")
+        if should_log("DEBUG", "dalle_request"):
+            logger.debug("Requesting DALLE...")
         body = dict(
             prompt=prompt,
         )
-        response = requests.post(
-            url=self._settings.dalle_api_url,
-            json=body,
-            timeout=self._settings.dalle_api_request_timeout_seconds,
-            proxies=self._settings.dalle_api_request_socks_proxy_for_requests_lib,
-        )
-        logger.bind(status_code=response.status_code).debug("DALLE response received")
+        backend = self._balancer.pick()
+        start = time.monotonic()
+        try:
+            with self._use_session() as session:
+                response = session.post(
+                    url=backend.url,
+                    json=body,
+                    timeout=(
+                        self._settings.dalle_api_connect_timeout_seconds,
+                        self._settings.dalle_api_request_timeout_seconds,
+                    ),
+                )
+        except Exception:
+            self._balancer.release(backend, status="error", duration=time.monotonic() - start)
+            raise
+        self._balancer.release(backend, status=response.status_code, duration=time.monotonic() - start)
+        if should_log("DEBUG", "dalle_request"):
+            logger.bind(status_code=response.status_code, backend=backend.url).debug("DALLE response received")
 
         return self._parse_response(
             response=response,
@@ -46,7 +253,7 @@ class Dalle:
             raise DalleTemporarilyUnavailableException()
         response.raise_for_status()
 
-        return DalleResponse(
-            **response.json(),
+        return DalleResponse.parse_api_response(
+            body=response.content,
             prompt=prompt,
         )
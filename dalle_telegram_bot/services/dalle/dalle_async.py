@@ -0,0 +1,210 @@
+import asyncio
+import time
+from typing import Optional, Dict, List, TYPE_CHECKING
+
+import aiohttp
+import aiohttp_socks
+
+from .cache import DalleCache
+from .balancer import DalleLoadBalancer
+from .models import DalleResponse
+from .retry import CircuitBreaker, get_backoff_delay
+from .exceptions import DalleTemporarilyUnavailableException
+from .. import metrics
+from ...settings import Settings
+from ...logger import logger, should_log
+from ...utils import normalize_prompt
+
+if TYPE_CHECKING:
+    from .prewarmer import PromptPopularity
+
+__all__ = ("AsyncDalle",)
+
+
+class AsyncDalle:
+    """asyncio version of the Dalle client. All its coroutines must run on the same event loop."""
+
+    def __init__(
+            self,
+            settings: Settings,
+            cache: Optional[DalleCache] = None,
+            popularity: Optional["PromptPopularity"] = None,
+    ):
+        self._settings = settings
+        self._cache = cache
+        self._popularity = popularity
+        self._inflight_count = 0
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._inflight: Dict[str, asyncio.Future] = dict()
+        self._balancer = DalleLoadBalancer(settings=self._settings)
+        self._circuit_breaker = CircuitBreaker(
+            failure_threshold=self._settings.dalle_circuit_breaker_failures_threshold,
+            reset_timeout=self._settings.dalle_circuit_breaker_reset_seconds,
+            probe_interval=self._settings.dalle_generation_retry_delay_seconds,
+        )
+
+    async def generate(self, prompt: str) -> DalleResponse:
+        if self._popularity:
+            self._popularity.record(prompt)
+        response = await self.get_cached(prompt)
+        if response:
+            logger.debug("DALLE response returned from cache")
+            return response
+
+        if not self._settings.dalle_coalesce_requests:
+            return await self._generate_and_cache(prompt)
+
+        # single-flight: concurrent requests for the same prompt wait on the same generation
+        key = normalize_prompt(prompt)
+        future = self._inflight.get(key)
+        if future:
+            logger.debug("Waiting for an in-flight request with the same key")
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            response = await self._generate_and_cache(prompt)
+        except asyncio.CancelledError:
+            # only the leader is cancelled: the followers fail as if DALLE was unavailable, so they get a reply
+            future.set_exception(DalleTemporarilyUnavailableException())
+            future.exception()
+            raise
+        except Exception as ex:
+            future.set_exception(ex)
+            # avoid "exception never retrieved" warnings when no other request was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(response)
+            return response
+        finally:
+            self._inflight.pop(key, None)
+
+    def is_generating(self, prompt: str) -> bool:
+        """Return True if the prompt is being generated, and a request for it would wait on that generation"""
+        return self._settings.dalle_coalesce_requests and normalize_prompt(prompt) in self._inflight
+
+    async def get_cached(self, prompt: str) -> Optional[DalleResponse]:
+        if not self._cache:
+            return None
+        # the cache may query Redis, so run it outside the event loop
+        return await asyncio.to_thread(self._cache.get, prompt)
+
+    @property
+    def inflight_count(self) -> int:
+        """Number of user generations in progress (including those waiting to retry)"""
+        return self._inflight_count
+
+    @property
+    def circuit_closed(self) -> bool:
+        return self._circuit_breaker.state == CircuitBreaker.CLOSED
+
+    @property
+    def backends_stats(self) -> List[dict]:
+        return self._balancer.stats
+
+    async def close(self):
+        self._balancer.close()
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    async def _generate_and_cache(self, prompt: str) -> DalleResponse:
+        self._inflight_count += 1
+        try:
+            with metrics.DALLE_GENERATIONS_IN_FLIGHT.track_inprogress():
+                response = await self._generate_until_complete(prompt)
+        finally:
+            self._inflight_count -= 1
+        if self._cache:
+            await asyncio.to_thread(self._cache.set, prompt, response)
+        return response
+
+    async def _generate_until_complete(self, prompt: str) -> DalleResponse:
+        """Same retry logic as Dalle._generate_until_complete, but waiting on the event loop."""
+        deadline = time.time() + self._settings.dalle_generation_timeout_seconds
+        attempt = 0
+        while True:
+            delay = self._circuit_breaker.acquire()
+            if not delay:
+                try:
+                    response = await self._simple_request(prompt)
+                except DalleTemporarilyUnavailableException:
+                    self._circuit_breaker.record_failure()
+                    delay = get_backoff_delay(
+                        attempt=attempt,
+                        base_delay=self._settings.dalle_generation_retry_delay_seconds,
+                        max_delay=self._settings.dalle_generation_retry_max_delay_seconds,
+                    )
+                    attempt += 1
+                except Exception:
+                    self._circuit_breaker.record_failure()
+                    metrics.DALLE_GENERATION_ATTEMPTS.labels(result="error").observe(attempt + 1)
+                    raise
+                else:
+                    self._circuit_breaker.record_success()
+                    metrics.DALLE_GENERATION_ATTEMPTS.labels(result="success").observe(attempt + 1)
+                    return response
+
+            if time.time() + delay >= deadline:
+                metrics.DALLE_GENERATION_ATTEMPTS.labels(result="timeout").observe(attempt)
+                logger.bind(attempts=attempt, circuit_breaker=self._circuit_breaker.state).\
+                    warning("DALLE generation timed out")
+                raise DalleTemporarilyUnavailableException()
+
+            if should_log("TRACE", "dalle_request"):
+                logger.bind(retry_delay=round(delay, 3)).trace("Waiting before retrying DALLE request")
+            await asyncio.sleep(delay)
+
+    async def _simple_request(self, prompt: str) -> DalleResponse:
+        if should_log("DEBUG", "dalle_request"):
+            logger.debug("Requesting DALLE...")
+        body = dict(
+            prompt=prompt,
+        )
+        backend = self._balancer.pick()
+        start = time.monotonic()
+        status = "error"
+        try:
+            async with self._get_session().post(
+                url=backend.url,
+                json=body,
+                timeout=aiohttp.ClientTimeout(
+                    # connect includes waiting for a free connection from the pool
+                    connect=self._settings.dalle_api_connect_timeout_seconds,
+                    sock_connect=self._settings.dalle_api_connect_timeout_seconds,
+                    sock_read=self._settings.dalle_api_request_timeout_seconds,
+                ),
+            ) as response:
+                status = response.status
+                if should_log("DEBUG", "dalle_request"):
+                    logger.bind(status_code=response.status, backend=backend.url).debug("DALLE response received")
+                if response.status == 503:
+                    raise DalleTemporarilyUnavailableException()
+                response.raise_for_status()
+
+                return DalleResponse.parse_api_response(
+                    body=await response.read(),
+                    prompt=prompt,
+                )
+        finally:
+            self._balancer.release(backend, status=status, duration=time.monotonic() - start)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if not self._session:
+            # no limit of concurrent connections: the concurrent generations are limited by the scheduler
+            # (dalle_generation_concurrent_limit); idle keep-alive connections are closed by keepalive_timeout
+            connector_kwargs = dict(
+                limit=0,
+                keepalive_timeout=self._settings.dalle_api_pool_idle_seconds,
+            )
+            if self._settings.dalle_api_request_socks_proxy:
+                connector = aiohttp_socks.ProxyConnector.from_url(
+                    str(self._settings.dalle_api_request_socks_proxy),
+                    **connector_kwargs,
+                )
+            else:
+                connector = aiohttp.TCPConnector(**connector_kwargs)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
@@ -0,0 +1,152 @@
+import bisect
+import contextlib
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+import pydantic
+
+from ..redis import Redis
+from ...settings import Settings
+from ...logger import logger
+from ...utils import normalize_prompt
+
+__all__ = ("GenerationsIndex", "IndexedGeneration")
+
+
+class IndexedGeneration(pydantic.BaseModel):
+    prompt: str
+    telegram_file_ids: List[str]
+    timestamp: float
+
+    @property
+    def key(self) -> str:
+        """Short identifier of the generation, for the inline query results ids (max 64 bytes)"""
+        return hashlib.sha1(normalize_prompt(self.prompt).encode()).hexdigest()[:16]
+
+
+class GenerationsIndex:
+    """Index of the past generations delivered to users (their prompts and the Telegram file_ids of their images),
+    searchable by the words of the prompts, being the last word of the query a prefix (search-as-you-type).
+    Kept in memory (bounded, the least recently generated are discarded), and optionally persisted on Redis,
+    so searches never perform I/O."""
+
+    def __init__(self, settings: Settings, redis: Optional[Redis] = None):
+        self._settings = settings
+        self._redis = redis if redis and redis.enabled and settings.redis_inline_index_key else None
+        self._entries: "OrderedDict[str, IndexedGeneration]" = OrderedDict()  # normalized prompt: generation
+        self._tokens_prompts: Dict[str, Set[str]] = dict()  # token: normalized prompts
+        self._tokens_sorted: List[str] = list()  # for prefix searches
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._settings.inline_index_size > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        """Load the generations persisted on Redis"""
+        if not self._redis:
+            return
+        try:
+            generations = [IndexedGeneration.parse_raw(data) for data in self._redis.hvals(self._get_key())]
+        except Exception as ex:
+            logger.opt(exception=ex).warning("Failed loading generations index from Redis")
+            return
+
+        generations.sort(key=lambda generation: generation.timestamp)
+        evicted = list()
+        for generation in generations:
+            evicted.extend(self._add(generation))
+        if evicted:
+            with contextlib.suppress(Exception):
+                self._redis.hdel(self._get_key(), *evicted)
+        logger.bind(generations_count=len(self)).info("Generations index loaded")
+
+    def add(self, prompt: str, telegram_file_ids: List[str]):
+        generation = IndexedGeneration(prompt=prompt, telegram_file_ids=telegram_file_ids, timestamp=time.time())
+        evicted = self._add(generation)
+
+        if not self._redis:
+            return
+        try:
+            self._redis.hset(self._get_key(), normalize_prompt(prompt), generation.json().encode())
+            if evicted:
+                self._redis.hdel(self._get_key(), *evicted)
+        except Exception as ex:
+            logger.opt(exception=ex).warning("Failed persisting generation on index")
+
+    def search(self, query: str, limit: int) -> List[IndexedGeneration]:
+        """Return the most recent generations matching all the words of the query (the last one as prefix).
+        An empty query returns the most recent generations."""
+        tokens = self._tokenize(query)
+        with self._lock:
+            if not tokens:
+                return list(reversed(self._entries.values()))[:limit]
+
+            prefix = None if query[-1:].isspace() else tokens.pop()
+            matches: Optional[Set[str]] = None
+            for token in tokens:
+                prompts = self._tokens_prompts.get(token, set())
+                matches = prompts.copy() if matches is None else matches & prompts
+                if not matches:
+                    return list()
+
+            if prefix:
+                prefix_matches = set()
+                i = bisect.bisect_left(self._tokens_sorted, prefix)
+                while i < len(self._tokens_sorted) and self._tokens_sorted[i].startswith(prefix):
+                    prefix_matches.update(self._tokens_prompts[self._tokens_sorted[i]])
+                    i += 1
+                matches = prefix_matches if matches is None else matches & prefix_matches
+
+            generations = [self._entries[prompt] for prompt in matches]
+
+        generations.sort(key=lambda generation: generation.timestamp, reverse=True)
+        return generations[:limit]
+
+    def _add(self, generation: IndexedGeneration) -> List[str]:
+        """Add the generation to the memory index. Return the normalized prompts evicted."""
+        key = normalize_prompt(generation.prompt)
+        evicted = list()
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                for token in self._tokenize(key):
+                    prompts = self._tokens_prompts.get(token)
+                    if prompts is None:
+                        prompts = self._tokens_prompts[token] = set()
+                        bisect.insort(self._tokens_sorted, token)
+                    prompts.add(key)
+            self._entries[key] = generation
+
+            while len(self._entries) > self._settings.inline_index_size:
+                evicted_key, _ = self._entries.popitem(last=False)
+                self._remove_tokens(evicted_key)
+                evicted.append(evicted_key)
+        return evicted
+
+    def _remove_tokens(self, key: str):
+        for token in self._tokenize(key):
+            prompts = self._tokens_prompts.get(token)
+            if prompts is None:
+                continue
+            prompts.discard(key)
+            if not prompts:
+                del self._tokens_prompts[token]
+                i = bisect.bisect_left(self._tokens_sorted, token)
+                if i < len(self._tokens_sorted) and self._tokens_sorted[i] == token:
+                    del self._tokens_sorted[i]
+
+    def _get_key(self) -> str:
+        return self._settings.redis_inline_index_key
+
+    @staticmethod
+    def _tokenize(text: str) -> List[str]:
+        return re.findall(r"\w+", normalize_prompt(text))
@@ -1,23 +1,44 @@
+import json
 import base64
 import pathlib
-from typing import List
+from typing import List, Optional, Union
 
 import pydantic
 
 
 class DalleResponse(pydantic.BaseModel):
     # Fields returned from API response
-    images: List[str] = pydantic.Field(..., min_items=9, max_items=9)  # images as base64 strings
+    images: List[bytes] = pydantic.Field(..., min_items=9, max_items=9)  # images decoded from base64 strings
 
     # Fields we complete
     prompt: str
+    telegram_file_ids: Optional[List[str]] = None  # file_ids of the images, once uploaded to Telegram
+
+    @pydantic.validator("images", pre=True)
+    def _decode_images(cls, images: List[Union[str, bytes]]) -> List[bytes]:
+        """Decode images given as base64 strings (from the API response, or serialized responses).
+        Each string is released as soon as it is decoded."""
+        if not isinstance(images, list):
+            return images
+
+        for i, image in enumerate(images):
+            if isinstance(image, str):
+                images[i] = base64.b64decode(image)
+        return images
+
+    @classmethod
+    def parse_api_response(cls, body: bytes, prompt: str) -> "DalleResponse":
+        """Parse the raw body returned by the DALLE API.
+        The images are decoded once and in place, so each base64 string is released right after being decoded."""
+        data = json.loads(body)
+        return cls(
+            images=data.pop("images", None),
+            prompt=prompt,
+        )
 
     @property
-    def images_bytes(self):
-        images_parsed: List[bytes] = list()
-        for image_base64 in self.images:
-            images_parsed.append(base64.b64decode(image_base64))
-        return images_parsed
+    def images_bytes(self) -> List[bytes]:
+        return self.images
 
     def save_images(self, directory: str):
         directory_path = pathlib.Path(directory)
@@ -26,3 +47,8 @@ class DalleResponse(pydantic.BaseModel):
             image_path = directory_path / image_filename
             with open(image_path, "wb") as f:
                 f.write(image_data)
+
+    class Config:
+        json_encoders = {
+            bytes: lambda data: base64.b64encode(data).decode(),
+        }
@@ -0,0 +1,171 @@
+import threading
+import time
+from collections import Counter
+from typing import List, Optional, Union
+
+from .dalle import Dalle
+from .dalle_async import AsyncDalle
+from ..redis import Redis
+from ...settings import Settings
+from ...logger import logger
+from ...utils import normalize_prompt
+
+__all__ = ("PromptPopularity", "Prewarmer")
+
+
+class PromptPopularity:
+    """Counters of requests per normalized prompt. Recording is in-memory only (no I/O);
+    if a Redis key is configured, the counters are periodically merged on a Redis sorted set, shared by all replicas.
+    In-memory counters are bounded (the least popular are discarded) and halved on each `decay`."""
+
+    def __init__(self, settings: Settings, redis: Optional[Redis] = None):
+        self._settings = settings
+        self._redis = redis if redis and redis.enabled and settings.redis_prewarm_popularity_key else None
+        self._counters = Counter()
+        self._pending = Counter()  # increments not yet merged on Redis
+        self._lock = threading.Lock()
+
+    def record(self, prompt: str):
+        key = normalize_prompt(prompt)
+        with self._lock:
+            if self._redis:
+                self._pending[key] += 1
+                return
+
+            self._counters[key] += 1
+            if len(self._counters) > self._settings.prewarm_tracked_prompts * 2:
+                self._counters = Counter(dict(self._counters.most_common(self._settings.prewarm_tracked_prompts)))
+
+    def top(self, count: int, min_requests: float) -> List[str]:
+        """Return the most requested prompts, with at least `min_requests` requests"""
+        if self._redis:
+            counters = self._redis.zrevrange_with_scores(self._settings.redis_prewarm_popularity_key, count)
+        else:
+            with self._lock:
+                counters = self._counters.most_common(count)
+        return [prompt if isinstance(prompt, str) else prompt.decode() for prompt, score in counters
+                if score >= min_requests]
+
+    def flush(self):
+        """Merge the pending counters on Redis"""
+        if not self._redis:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        if not pending:
+            return
+
+        key = self._settings.redis_prewarm_popularity_key
+        try:
+            self._redis.zincrby_many(key, pending)
+            self._redis.ztrim(key, self._settings.prewarm_tracked_prompts)
+        except Exception as ex:
+            logger.opt(exception=ex).warning("Failed storing prompts popularity on Redis")
+
+    def decay(self):
+        """Halve the counters, so popularity reflects the recent requests.
+        Counters on Redis are not decayed, as they are shared by all the replicas."""
+        if self._redis:
+            return
+        with self._lock:
+            self._counters = Counter({key: count / 2 for key, count in self._counters.items() if count >= 1})
+
+
+class Prewarmer:
+    """Generate (and cache) the most popular prompts in background, while the DALLE backend has spare capacity:
+    no more than `PREWARM_MAX_INFLIGHT` user generations in progress, and the circuit breaker closed.
+    Prewarm generations are single DALLE requests (never retried), limited by an hourly budget.
+    Popular prompts already cached, or being generated for users, are skipped.
+    The load is measured on `users_dalle` (the client used by the bot), which can be an AsyncDalle;
+    prewarm generations are always requested with a (threaded) Dalle client."""
+
+    def __init__(
+            self,
+            settings: Settings,
+            dalle: Dalle,
+            popularity: PromptPopularity,
+            users_dalle: Union[Dalle, AsyncDalle, None] = None,
+    ):
+        self._settings = settings
+        self._dalle = dalle
+        self._popularity = popularity
+        self._users_dalle = users_dalle or dalle
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+        self._budget_reset_at = 0.0
+        self._budget_left = 0
+        self.generated_count = 0
+        self.failed_count = 0
+
+    @property
+    def dalle(self) -> Dalle:
+        return self._dalle
+
+    @property
+    def enabled(self) -> bool:
+        return self._settings.prewarm_budget_per_hour > 0
+
+    @property
+    def stats(self) -> dict:
+        return dict(
+            generated=self.generated_count,
+            failed=self.failed_count,
+            budget_left=self._budget_left,
+        )
+
+    def start(self):
+        if not self.enabled or self._thread:
+            return
+        self._thread = threading.Thread(target=self._worker, name="DallePrewarmer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+
+    def _worker(self):
+        logger.bind(budget_per_hour=self._settings.prewarm_budget_per_hour).info("DALLE prewarmer started")
+        while not self._stop_event.wait(self._settings.prewarm_interval_seconds):
+            try:
+                self._popularity.flush()
+                self._prewarm()
+            except Exception as ex:
+                logger.opt(exception=ex).error("DALLE prewarm failed")
+
+    def _prewarm(self):
+        now = time.time()
+        if now >= self._budget_reset_at:
+            if self._budget_reset_at:
+                self._popularity.decay()
+            self._budget_reset_at = now + 3600
+            self._budget_left = self._settings.prewarm_budget_per_hour
+
+        if not self._has_spare_capacity():
+            return
+
+        prompts = self._popularity.top(
+            count=self._settings.prewarm_top_prompts,
+            min_requests=self._settings.prewarm_min_requests,
+        )
+        for prompt in prompts:
+            if not self._budget_left or self._stop_event.is_set() or not self._has_spare_capacity():
+                return
+            if self._dalle.is_cached(prompt) or self._users_dalle.is_generating(prompt):
+                continue
+
+            self._budget_left -= 1
+            with logger.contextualize(prompt=prompt):
+                if self._dalle.prewarm(prompt):
+                    self.generated_count += 1
+                    logger.info("DALLE prompt prewarmed")
+                else:
+                    # backend busy, wait until the next round
+                    self.failed_count += 1
+                    logger.debug("DALLE prompt prewarm failed, backend unavailable")
+                    return
+
+    def _has_spare_capacity(self) -> bool:
+        return self._users_dalle.inflight_count <= self._settings.prewarm_max_inflight and \
+            self._users_dalle.circuit_closed
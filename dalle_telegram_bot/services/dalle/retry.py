@@ -0,0 +1,83 @@
+import random
+import threading
+import time
+
+from ...logger import logger
+
+__all__ = ("CircuitBreaker", "get_backoff_delay")
+
+
+def get_backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """Return the delay before retrying, using exponential backoff with "full jitter"
+    (random delay between 0 and base*2^attempt, capped), so waiting requests do not retry in lockstep."""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """Circuit breaker shared by all the DALLE requests.
+    After `failure_threshold` consecutive failures the circuit opens, and requests are not sent to the backend
+    until `reset_timeout` seconds have passed. Then the circuit is half-open: a single probe request is allowed,
+    which closes the circuit on success, or opens it again on failure."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, probe_interval: float):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._probe_interval = probe_interval
+        self._lock = threading.Lock()
+
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    @property
+    def consecutive_failures(self) -> int:
+        return self._consecutive_failures
+
+    def acquire(self) -> float:
+        """Ask for permission to send a request. Return 0 if allowed;
+        otherwise, return the seconds to wait before asking again."""
+        if self._failure_threshold <= 0:
+            return 0
+
+        with self._lock:
+            if self._state == self.CLOSED:
+                return 0
+
+            if self._state == self.OPEN:
+                remaining = self._opened_at + self._reset_timeout - time.time()
+                if remaining > 0:
+                    return remaining + random.uniform(0, self._probe_interval)
+
+                logger.info("DALLE circuit breaker half-open, sending probe request")
+                self._state = self.HALF_OPEN
+                return 0
+
+            # half-open: a probe request is in-flight
+            return random.uniform(self._probe_interval / 2, self._probe_interval)
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("DALLE circuit breaker closed")
+            self._state = self.CLOSED
+            self._consecutive_failures = 0
+
+    def record_failure(self):
+        if self._failure_threshold <= 0:
+            return
+
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._state == self.HALF_OPEN or self._consecutive_failures >= self._failure_threshold:
+                if self._state != self.OPEN:
+                    logger.bind(consecutive_failures=self._consecutive_failures).warning("DALLE circuit breaker open")
+                self._state = self.OPEN
+                self._opened_at = time.time()
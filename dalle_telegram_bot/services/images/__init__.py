@@ -0,0 +1 @@
+from .postprocessing import *
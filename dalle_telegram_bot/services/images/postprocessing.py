@@ -0,0 +1,171 @@
+import asyncio
+import io
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from ...settings import Settings
+from ...logger import logger
+
+__all__ = ("ImagePostProcessor",)
+
+MODE_NONE = "none"
+MODE_RECOMPRESS = "recompress"
+MODE_COLLAGE = "collage"
+
+COLLAGE_COLUMNS = 3
+RECOMPRESS_QUALITY_STEP = 10
+RECOMPRESS_QUALITY_MIN = 40
+
+
+class ImagePostProcessor:
+    """Optional post-processing of the generated images before delivering them:
+    - "collage" mode: compose the 9 images into a single 3x3 grid image
+    - "recompress" mode: re-encode each image as JPEG with the configured quality
+    In both modes, images are re-encoded lowering the quality until fitting the configured max size (if any).
+    The CPU-bound work runs on a process pool, so it does not block the handler threads (nor the event loop)."""
+
+    def __init__(self, settings: Settings):
+        self._settings = settings
+        self._mode = self._settings.images_postprocessing_mode.lower()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+        self.processed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.stages_seconds: Dict[str, float] = dict()
+
+    @property
+    def enabled(self) -> bool:
+        return self._mode != MODE_NONE
+
+    @property
+    def stats(self) -> dict:
+        return dict(
+            processed=self.processed,
+            bytes_in=self.bytes_in,
+            bytes_out=self.bytes_out,
+            bytes_saved=self.bytes_in - self.bytes_out,
+            **{f"{stage}_seconds": round(seconds, 3) for stage, seconds in self.stages_seconds.items()},
+        )
+
+    def process(self, images: List[bytes]) -> List[bytes]:
+        """Post-process the images on the process pool, blocking until done."""
+        if not self.enabled:
+            return images
+
+        start = time.time()
+        result = self._get_pool().submit(*self._get_task(images)).result()
+        return self._complete(images=images, result=result, start=start)
+
+    async def process_async(self, images: List[bytes]) -> List[bytes]:
+        """Post-process the images on the process pool, awaiting from the event loop."""
+        if not self.enabled:
+            return images
+
+        start = time.time()
+        result = await asyncio.get_running_loop().run_in_executor(self._get_pool(), *self._get_task(images))
+        return self._complete(images=images, result=result, start=start)
+
+    def teardown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False)
+
+    def _get_task(self, images: List[bytes]) -> tuple:
+        if self._mode == MODE_COLLAGE:
+            return _make_collage, images, self._settings.images_jpeg_quality, self._settings.images_max_size_bytes
+        if self._mode == MODE_RECOMPRESS:
+            return _recompress, images, self._settings.images_jpeg_quality, self._settings.images_max_size_bytes
+        raise ValueError(f"Invalid images post-processing mode {self._mode}")
+
+    def _complete(
+            self, images: List[bytes], result: Tuple[List[bytes], Dict[str, float]], start: float
+    ) -> List[bytes]:
+        output, stages_seconds = result
+        bytes_in = sum(len(image) for image in images)
+        bytes_out = sum(len(image) for image in output)
+
+        with self._stats_lock:
+            self.processed += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            for stage, seconds in stages_seconds.items():
+                self.stages_seconds[stage] = self.stages_seconds.get(stage, 0) + seconds
+
+        logger.bind(
+            postprocessing_mode=self._mode,
+            postprocessing_duration=round(time.time() - start, 4),
+            bytes_in=bytes_in,
+            bytes_out=bytes_out,
+            **{f"{stage}_duration": round(seconds, 4) for stage, seconds in stages_seconds.items()},
+        ).debug("Images post-processed")
+        return output
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._pool_lock:
+            if not self._pool:
+                self._pool = ProcessPoolExecutor(max_workers=self._settings.images_postprocessing_processes)
+            return self._pool
+
+
+# Functions run on the process pool
+
+def _make_collage(images: List[bytes], quality: int, max_size: Optional[int]) -> Tuple[List[bytes], Dict[str, float]]:
+    start = time.time()
+    decoded = [Image.open(io.BytesIO(image)).convert("RGB") for image in images]
+    decode_end = time.time()
+
+    width, height = decoded[0].size
+    rows = -(-len(decoded) // COLLAGE_COLUMNS)
+    collage = Image.new("RGB", (width * COLLAGE_COLUMNS, height * rows))
+    for i, image in enumerate(decoded):
+        if image.size != (width, height):
+            image = image.resize((width, height))
+        collage.paste(image, ((i % COLLAGE_COLUMNS) * width, (i // COLLAGE_COLUMNS) * height))
+    compose_end = time.time()
+
+    output = _encode(collage, quality=quality, max_size=max_size)
+    return [output], dict(
+        decode=decode_end - start,
+        compose=compose_end - decode_end,
+        encode=time.time() - compose_end,
+    )
+
+
+def _recompress(images: List[bytes], quality: int, max_size: Optional[int]) -> Tuple[List[bytes], Dict[str, float]]:
+    decode_seconds = 0
+    encode_seconds = 0
+    output = list()
+
+    for image in images:
+        start = time.time()
+        decoded = Image.open(io.BytesIO(image)).convert("RGB")
+        decode_end = time.time()
+        encoded = _encode(decoded, quality=quality, max_size=max_size)
+        # never return an image bigger than the original
+        output.append(encoded if len(encoded) < len(image) else image)
+
+        decode_seconds += decode_end - start
+        encode_seconds += time.time() - decode_end
+
+    return output, dict(
+        decode=decode_seconds,
+        encode=encode_seconds,
+    )
+
+
+def _encode(image: Image.Image, quality: int, max_size: Optional[int]) -> bytes:
+    """Encode the image as JPEG. If max_size given, lower the quality until the result fits it (or reaching a minimum)."""
+    while True:
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+        data = buffer.getvalue()
+
+        if not max_size or len(data) <= max_size or quality <= RECOMPRESS_QUALITY_MIN:
+            return data
+        quality = max(RECOMPRESS_QUALITY_MIN, quality - RECOMPRESS_QUALITY_STEP)
@@ -0,0 +1,4 @@
+from .models import *
+from .queue import *
+from .pending import *
+from .journal import *
@@ -0,0 +1,180 @@
+import abc
+import os
+import threading
+import time
+from typing import Dict, List, Optional, TextIO
+
+from .models import GenerationJob, GenerationJobStatus
+from ..redis import Redis
+from ...settings import Settings
+from ...logger import logger
+
+__all__ = ("AbstractGenerationJournal", "FileGenerationJournal", "RedisGenerationJournal", "get_generation_journal")
+
+
+class AbstractGenerationJournal(abc.ABC):
+    """Durable record of the accepted generate requests and their state transitions,
+    used for replaying the unfinished requests after a restart."""
+
+    def __init__(self, settings: Settings):
+        self._settings = settings
+
+    def record(self, job: GenerationJob, status: str):
+        """Record a state transition of a job. The response is never stored on the journal."""
+        job.status = status
+        try:
+            self._record(job.copy(exclude={"response"}))
+        except Exception as ex:
+            logger.opt(exception=ex).warning("Failed recording job on journal")
+
+    def get_unfinished(self) -> List[GenerationJob]:
+        """Return the jobs that did not complete, and are recent enough to be replayed.
+        Older unfinished jobs are recorded as failed."""
+        jobs = list()
+        min_created_at = time.time() - self._settings.journal_max_age_seconds
+        for job in self._load():
+            if job.status not in GenerationJobStatus.UNFINISHED:
+                continue
+            if job.created_at < min_created_at:
+                self.record(job, GenerationJobStatus.FAILED)
+                continue
+            jobs.append(job)
+        return jobs
+
+    def close(self):
+        """Persist the pending records and release the resources of the journal"""
+        pass
+
+    @abc.abstractmethod
+    def _record(self, job: GenerationJob):
+        pass
+
+    @abc.abstractmethod
+    def _load(self) -> List[GenerationJob]:
+        """Return the last recorded state of each job."""
+        pass
+
+
+class FileGenerationJournal(AbstractGenerationJournal):
+    """Journal on a local append-only file, one JSON record per line.
+    Records are fsynced in batches by a background thread, every `journal_fsync_interval_seconds`
+    (or on each record, if 0). The file is compacted (keeping only the unfinished jobs) when loaded,
+    and by the background thread once it exceeds `journal_compact_size_bytes`."""
+
+    def __init__(self, settings: Settings):
+        super().__init__(settings)
+        self._path = self._settings.journal_file_path
+        self._lock = threading.Lock()
+        self._file: Optional[TextIO] = None
+        self._pending_fsync = False
+        self._flusher_thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+    def close(self):
+        self._stop_event.set()
+        if self._flusher_thread:
+            self._flusher_thread.join()
+        with self._lock:
+            if self._file:
+                self._fsync()
+                self._file.close()
+                self._file = None
+
+    def _record(self, job: GenerationJob):
+        line = job.json() + "\n"
+        with self._lock:
+            if not self._file:
+                self._file = open(self._path, "a")
+            self._file.write(line)
+            self._file.flush()
+
+            if self._settings.journal_fsync_interval_seconds > 0:
+                self._pending_fsync = True
+                self._start_flusher()
+            else:
+                os.fsync(self._file.fileno())
+
+    def _load(self) -> List[GenerationJob]:
+        with self._lock:
+            return list(self._compact().values())
+
+    def _start_flusher(self):
+        """Start the background thread fsyncing (and compacting) the journal. Must be called with the lock held."""
+        if self._flusher_thread:
+            return
+        self._flusher_thread = threading.Thread(target=self._flusher, name="JournalFlusher", daemon=True)
+        self._flusher_thread.start()
+
+    def _flusher(self):
+        while not self._stop_event.wait(self._settings.journal_fsync_interval_seconds):
+            try:
+                with self._lock:
+                    self._fsync()
+                    if self._file and self._file.tell() >= self._settings.journal_compact_size_bytes:
+                        self._compact()
+            except Exception as ex:
+                logger.opt(exception=ex).warning("Failed flushing journal")
+
+    def _fsync(self):
+        """Must be called with the lock held"""
+        if self._file and self._pending_fsync:
+            os.fsync(self._file.fileno())
+            self._pending_fsync = False
+
+    def _compact(self) -> Dict[str, GenerationJob]:
+        """Rewrite the journal keeping only the unfinished jobs. Return the last recorded state of each job.
+        Must be called with the lock held."""
+        jobs: Dict[str, GenerationJob] = dict()
+        if self._file:
+            self._file.close()
+            self._file = None
+        if not os.path.exists(self._path):
+            return jobs
+
+        with open(self._path, "r") as file:
+            for line in file:
+                try:
+                    job = GenerationJob.parse_raw(line)
+                except Exception:
+                    # incomplete last line, if the process died while writing it
+                    continue
+                jobs[job.job_id] = job
+
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "w") as file:
+            for job in jobs.values():
+                if job.status in GenerationJobStatus.UNFINISHED:
+                    file.write(job.json() + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self._path)
+        self._pending_fsync = False
+        logger.bind(jobs_count=len(jobs)).debug("Journal compacted")
+        return jobs
+
+
+class RedisGenerationJournal(AbstractGenerationJournal):
+    """Journal on a Redis hash (job_id: job), where finished jobs are removed."""
+
+    def __init__(self, settings: Settings, redis: Redis):
+        super().__init__(settings)
+        self._redis = redis
+        self._key = self._settings.redis_journal_key
+
+    def _record(self, job: GenerationJob):
+        if job.status in GenerationJobStatus.UNFINISHED:
+            self._redis.hset(self._key, job.job_id, job.json().encode())
+        else:
+            self._redis.hdel(self._key, job.job_id)
+
+    def _load(self) -> List[GenerationJob]:
+        return [GenerationJob.parse_raw(data) for data in self._redis.hvals(self._key)]
+
+
+def get_generation_journal(settings: Settings, redis: Optional[Redis] = None) -> Optional[AbstractGenerationJournal]:
+    """Return the configured generation journal (Redis or file), or None if disabled."""
+    if redis and redis.enabled and settings.redis_journal_key:
+        return RedisGenerationJournal(settings=settings, redis=redis)
+    if settings.journal_file_path:
+        return FileGenerationJournal(settings=settings)
+    return None
@@ -0,0 +1,35 @@
+import time
+from typing import Optional, List
+
+import pydantic
+
+from ..dalle.models import DalleResponse
+
+__all__ = ("GenerationJob", "GenerationJobStatus")
+
+
+class GenerationJobStatus:
+    PENDING = "pending"
+    GENERATED = "generated"  # generated by the worker, must be delivered by the bot
+    DELIVERING = "delivering"  # delivery started; not retried on replay, to avoid duplicates
+    DELIVERED = "delivered"  # generated and delivered by the worker
+    FAILED = "failed"
+
+    UNFINISHED = (PENDING, GENERATED)
+
+
+class GenerationJob(pydantic.BaseModel):
+    """A /generate request: queued by the bot for the DALLE workers and returned back to the bot once completed,
+    or recorded on the generations journal."""
+    job_id: str
+    request_id: Optional[str]
+    chat_id: int
+    message_id: int
+    generating_message_id: Optional[int]
+    prompt: str
+    results_queue_name: Optional[str] = None  # where the worker must push the job once completed
+    created_at: float = pydantic.Field(default_factory=time.time)
+
+    status: str = GenerationJobStatus.PENDING
+    response: Optional[DalleResponse] = None
+    telegram_file_ids: Optional[List[str]] = None  # of the images delivered by the worker
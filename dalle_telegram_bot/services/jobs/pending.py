@@ -0,0 +1,39 @@
+import time
+import threading
+from typing import Dict, List, Tuple
+
+from .models import GenerationJob
+
+__all__ = ("PendingJobs",)
+
+
+class PendingJobs:
+    """Jobs queued by a bot frontend, waiting for their results.
+    Each job is waited for up to `timeout` seconds since queued; after that, it is returned by `pop_expired`."""
+
+    def __init__(self, timeout: float):
+        self._timeout = timeout
+        self._jobs: Dict[str, Tuple[GenerationJob, float]] = dict()  # job_id: (job, result deadline)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def add(self, job: GenerationJob):
+        with self._lock:
+            self._jobs[job.job_id] = (job, time.monotonic() + self._timeout)
+
+    def pop(self, job: GenerationJob) -> bool:
+        """Stop waiting for the result of a job. Return False if it was not pending
+        (expired, or queued before a restart)."""
+        with self._lock:
+            return self._jobs.pop(job.job_id, None) is not None
+
+    def pop_expired(self) -> List[GenerationJob]:
+        """Stop waiting for the results of the jobs past their deadline, and return them"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [job for job, deadline in self._jobs.values() if deadline <= now]
+            for job in expired:
+                self._jobs.pop(job.job_id)
+        return expired
@@ -0,0 +1,95 @@
+from typing import Optional, Tuple
+
+from .models import GenerationJob
+from ..redis import Redis
+from ...settings import Settings
+from ...logger import logger
+
+__all__ = ("JobQueue",)
+
+
+class JobQueue:
+    """Queue of generation jobs on Redis, shared by the bot frontends and the DALLE workers.
+    Pending jobs are pushed to a single queue, consumed by the workers. Completed jobs are pushed back
+    to the results queue of the frontend that queued them.
+    Workers claim jobs by moving them to their own processing queue, and remove them once completed.
+    While alive, workers refresh a heartbeat; the processing queues of dead workers are moved back to the jobs queue."""
+
+    def __init__(self, settings: Settings, redis: Redis):
+        self._settings = settings
+        self._redis = redis
+
+    @property
+    def enabled(self) -> bool:
+        return self._redis.enabled and bool(self._settings.redis_jobs_queue_name)
+
+    def get_results_queue_name(self, frontend_id: str) -> str:
+        return f"{self._settings.redis_jobs_results_queue_prefix}/{frontend_id}"
+
+    def push_job(self, job: GenerationJob):
+        self._redis.push(self._settings.redis_jobs_queue_name, job.json().encode())
+
+    def claim_job(self, worker_id: str, timeout: float) -> Optional[Tuple[GenerationJob, bytes]]:
+        """Pop a pending job, moving it to the processing queue of the worker. Return the job and its raw data
+        (required for `complete_job`), or None on timeout."""
+        data = self._redis.pop_into(
+            self._settings.redis_jobs_queue_name,
+            self._get_processing_queue_name(worker_id),
+            timeout=timeout,
+        )
+        if data is None:
+            return None
+        return GenerationJob.parse_raw(data), data
+
+    def complete_job(self, worker_id: str, data: bytes):
+        """Remove a claimed job from the processing queue of the worker"""
+        self._redis.lrem(self._get_processing_queue_name(worker_id), data)
+
+    def heartbeat(self, worker_id: str):
+        self._redis.sadd(self._get_workers_key(), worker_id)
+        self._redis.set(
+            self._get_heartbeat_key(worker_id),
+            b"1",
+            ttl_seconds=self._settings.jobs_worker_heartbeat_seconds * 3,
+        )
+
+    def requeue_claimed_jobs(self, worker_id: str) -> int:
+        """Move the jobs claimed by a worker back to the jobs queue. Return the count of requeued jobs."""
+        count = self._redis.requeue_all(
+            self._get_processing_queue_name(worker_id),
+            self._settings.redis_jobs_queue_name,
+        )
+        if count:
+            logger.bind(worker_id=worker_id, jobs_count=count).warning("Requeued jobs claimed by a dead worker")
+        return count
+
+    def requeue_orphaned_jobs(self, worker_id: str) -> int:
+        """Move the jobs claimed by dead workers (without heartbeat) back to the jobs queue.
+        Return the count of requeued jobs."""
+        count = 0
+        for other_worker_id in self._redis.smembers(self._get_workers_key()):
+            other_worker_id = other_worker_id.decode()
+            if other_worker_id == worker_id or self._redis.exists(self._get_heartbeat_key(other_worker_id)):
+                continue
+
+            count += self.requeue_claimed_jobs(other_worker_id)
+            self._redis.srem(self._get_workers_key(), other_worker_id)
+        return count
+
+    def push_result(self, job: GenerationJob):
+        self._redis.push(job.results_queue_name, job.json().encode())
+
+    def pop_result(self, results_queue_name: str, timeout: float) -> Optional[GenerationJob]:
+        data = self._redis.pop(results_queue_name, timeout=timeout)
+        if data is None:
+            return None
+        return GenerationJob.parse_raw(data)
+
+    def _get_processing_queue_name(self, worker_id: str) -> str:
+        return f"{self._settings.redis_jobs_queue_name}/processing/{worker_id}"
+
+    def _get_heartbeat_key(self, worker_id: str) -> str:
+        return f"{self._settings.redis_jobs_queue_name}/heartbeats/{worker_id}"
+
+    def _get_workers_key(self) -> str:
+        return f"{self._settings.redis_jobs_queue_name}/workers"
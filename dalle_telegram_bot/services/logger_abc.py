@@ -2,9 +2,19 @@ import abc
 
 
 class AbstractLogger(abc.ABC):
+    @property
+    def enabled(self) -> bool:
+        """Disabled loggers are not registered as sinks"""
+        return True
+
+    @property
+    def level(self) -> str:
+        """Minimum level of the records sent to this logger"""
+        return "TRACE"
+
     @abc.abstractmethod
     def log(self, data: str):
         """
-        :param data: log record as JSON string
+        :param data: log record as JSON string. Called from the thread logging the record, so must not block.
         """
         pass
@@ -0,0 +1,88 @@
+import prometheus_client
+
+from ..settings import Settings
+from ..logger import logger
+
+__all__ = (
+    "DALLE_REQUEST_DURATION", "DALLE_GENERATION_ATTEMPTS", "DALLE_GENERATIONS_IN_FLIGHT",
+    "DALLE_BACKEND_OUTSTANDING", "DALLE_BACKEND_HEALTHY",
+    "TELEGRAM_API_REQUEST_DURATION", "TELEGRAM_API_RATELIMIT_RETRIES", "TELEGRAM_API_SESSIONS",
+    "CHAT_ACTIONS_ACTIVE", "HANDLER_THREADS", "HANDLER_THREADS_BUSY", "DISPATCH_QUEUE_SIZE", "DISPATCH_REJECTED",
+    "start_metrics_server",
+)
+
+DALLE_REQUEST_DURATION = prometheus_client.Histogram(
+    "dalle_request_duration_seconds",
+    "Duration of individual requests to the DALLE API",
+    labelnames=("backend", "status"),
+    buckets=(1, 5, 10, 20, 30, 45, 60, 90, 120, 180, 240, float("inf")),
+)
+DALLE_GENERATION_ATTEMPTS = prometheus_client.Histogram(
+    "dalle_generation_attempts",
+    "Requests sent to the DALLE API per generation (including retries)",
+    labelnames=("result",),
+    buckets=(1, 2, 3, 5, 10, 20, 40, 80, float("inf")),
+)
+DALLE_GENERATIONS_IN_FLIGHT = prometheus_client.Gauge(
+    "dalle_generations_in_flight",
+    "Generations currently being requested to the DALLE API",
+)
+DALLE_BACKEND_OUTSTANDING = prometheus_client.Gauge(
+    "dalle_backend_outstanding_requests",
+    "Requests currently sent to each DALLE API backend",
+    labelnames=("backend",),
+)
+DALLE_BACKEND_HEALTHY = prometheus_client.Gauge(
+    "dalle_backend_healthy",
+    "Whether each DALLE API backend is healthy (1) or ejected from the load balancer (0)",
+    labelnames=("backend",),
+)
+TELEGRAM_API_REQUEST_DURATION = prometheus_client.Histogram(
+    "telegram_api_request_duration_seconds",
+    "Duration of requests to the Telegram Bot API",
+    labelnames=("method",),
+)
+TELEGRAM_API_RATELIMIT_RETRIES = prometheus_client.Counter(
+    "telegram_api_ratelimit_retries",
+    "Telegram Bot API requests failed with 429 Too Many Requests (and retried)",
+    labelnames=("method",),
+)
+TELEGRAM_API_SESSIONS = prometheus_client.Gauge(
+    "telegram_api_sessions",
+    "Live requests.Session objects used for Telegram Bot API requests",
+)
+CHAT_ACTIONS_ACTIVE = prometheus_client.Gauge(
+    "chat_actions_active",
+    "Chats currently receiving a chat action",
+    labelnames=("action",),
+)
+HANDLER_THREADS = prometheus_client.Gauge(
+    "handler_threads",
+    "Threads available for handling bot requests",
+)
+HANDLER_THREADS_BUSY = prometheus_client.Gauge(
+    "handler_threads_busy",
+    "Requests currently being handled",
+)
+DISPATCH_QUEUE_SIZE = prometheus_client.Gauge(
+    "dispatch_queue_size",
+    "Tasks waiting on the queue of each bot executor (instant, generate, delivery)",
+    labelnames=("pool",),
+)
+DISPATCH_REJECTED = prometheus_client.Counter(
+    "dispatch_rejected",
+    "Tasks rejected because the queue of the bot executor was full",
+    labelnames=("pool",),
+)
+
+
+def start_metrics_server(settings: Settings):
+    """Start the HTTP server exposing the metrics on /metrics, if enabled by settings."""
+    if not settings.metrics_port:
+        return
+
+    prometheus_client.start_http_server(
+        port=settings.metrics_port,
+        addr=settings.metrics_host,
+    )
+    logger.bind(host=settings.metrics_host, port=settings.metrics_port).info("Metrics server started")
@@ -1,10 +1,11 @@
+from typing import Optional, List, Union, Dict, Tuple
+
 import redis
 
-from .logger_abc import AbstractLogger
 from ..settings import Settings
 
 
-class Redis(AbstractLogger):
+class Redis:
     def __init__(self, settings: Settings):
         self._settings = settings
         self._redis = None
@@ -18,18 +19,92 @@ class Redis(AbstractLogger):
             **self._get_auth_kwargs(),
         )
 
-    def log(self, data: str):
-        if not self._redis or not self._settings.redis_logs_queue_name:
+    @property
+    def enabled(self) -> bool:
+        return self._redis is not None
+
+    def get(self, key: str) -> Optional[bytes]:
+        if not self._redis:
+            return None
+        return self._redis.get(key)
+
+    def set(self, key: str, value: bytes, ttl_seconds: Optional[float] = None):
+        if not self._redis:
             return
+        px = int(ttl_seconds * 1000) if ttl_seconds else None
+        self._redis.set(key, value, px=px)
+
+    def push(self, queue_name: str, data: bytes):
+        self._redis.rpush(queue_name, data)
+
+    def push_many(self, queue_name: str, items: List[Union[str, bytes]]):
+        """Push many items to a queue, in a single command."""
+        self._redis.rpush(queue_name, *items)
+
+    def pop(self, queue_name: str, timeout: float) -> Optional[bytes]:
+        """Pop the first item of a queue, waiting up to `timeout` seconds for it. Return None on timeout."""
+        result = self._redis.blpop([queue_name], timeout=timeout)
+        if result is None:
+            return None
+        return result[1]
+
+    def pop_into(self, queue_name: str, processing_queue_name: str, timeout: float) -> Optional[bytes]:
+        """Pop the first item of a queue, atomically pushing it to a processing queue (BLMOVE),
+        waiting up to `timeout` seconds for it. Return None on timeout."""
+        return self._redis.blmove(queue_name, processing_queue_name, timeout, src="LEFT", dest="RIGHT")
+
+    def requeue_all(self, processing_queue_name: str, queue_name: str) -> int:
+        """Move all the items of a processing queue back to the head of a queue. Return the count of moved items."""
+        count = 0
+        while self._redis.lmove(processing_queue_name, queue_name, src="RIGHT", dest="LEFT") is not None:
+            count += 1
+        return count
+
+    def lrem(self, queue_name: str, data: bytes):
+        self._redis.lrem(queue_name, 1, data)
+
+    def sadd(self, key: str, *members: str):
+        self._redis.sadd(key, *members)
+
+    def srem(self, key: str, *members: str):
+        self._redis.srem(key, *members)
+
+    def smembers(self, key: str) -> List[bytes]:
+        return list(self._redis.smembers(key))
+
+    def exists(self, key: str) -> bool:
+        return bool(self._redis.exists(key))
+
+    def zrem(self, key: str, *members: str):
+        self._redis.zrem(key, *members)
+
+    def zincrby_many(self, key: str, increments: Dict[str, float]):
+        """Increment the score of many members of a sorted set, in a single round-trip."""
+        pipeline = self._redis.pipeline(transaction=False)
+        for member, increment in increments.items():
+            pipeline.zincrby(key, increment, member)
+        pipeline.execute()
+
+    def zrevrange_with_scores(self, key: str, count: int) -> List[Tuple[bytes, float]]:
+        """Return the `count` members of a sorted set with the highest scores, with their scores."""
+        return self._redis.zrevrange(key, 0, count - 1, withscores=True)
+
+    def ztrim(self, key: str, count: int):
+        """Remove the members of a sorted set with the lowest scores, keeping the `count` highest."""
+        self._redis.zremrangebyrank(key, 0, -count - 1)
+
+    def hset(self, key: str, field: str, value: bytes):
+        self._redis.hset(key, field, value)
+
+    def hdel(self, key: str, *fields: str):
+        self._redis.hdel(key, *fields)
+
+    def hvals(self, key: str) -> List[bytes]:
+        return self._redis.hvals(key)
 
-        try:
-            self._redis.rpush(
-                self._settings.redis_logs_queue_name,
-                data,
-            )
-        except Exception:
-            # TODO Log errors?
-            pass
+    def register_script(self, script: str):
+        """Register a Lua script, returning a callable that runs it (with `keys` and `args` kwargs)."""
+        return self._redis.register_script(script)
 
     def _get_auth_kwargs(self):
         kwargs = dict()
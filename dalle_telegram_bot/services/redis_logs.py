@@ -0,0 +1,120 @@
+import sys
+import time
+import threading
+from collections import deque
+from typing import Deque, Optional
+
+from .logger_abc import AbstractLogger
+from .redis import Redis
+from ..settings import Settings
+
+__all__ = ("RedisLogShipper",)
+
+
+class RedisLogShipper(AbstractLogger):
+    """Ship log records to a Redis queue in batches, pushing all the records of a batch in a single command.
+    Records are buffered in memory (bounded); when the buffer is full, the oldest records are dropped.
+    A batch is sent when it reaches the batch size, or after the flush interval since the last one."""
+
+    def __init__(self, settings: Settings, redis: Redis):
+        self._settings = settings
+        self._redis = redis
+        self._queue_name = self._settings.redis_logs_queue_name
+        self._batch_size = self._settings.redis_logs_batch_size
+        self._flush_interval = self._settings.redis_logs_flush_interval_seconds
+
+        self._buffer: Deque[str] = deque()
+        self._buffer_size = self._settings.redis_logs_buffer_size
+        self._lock = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._running = True
+        self._thread: Optional[threading.Thread] = None
+
+        self._shipped_count = 0
+        self._dropped_count = 0  # records discarded because the buffer was full
+        self._failed_count = 0  # records discarded because shipping them to Redis failed
+        self._failing = False
+
+    @property
+    def enabled(self) -> bool:
+        return self._redis.enabled and bool(self._queue_name)
+
+    @property
+    def level(self) -> str:
+        return self._settings.redis_logs_level.upper()
+
+    @property
+    def stats(self) -> dict:
+        return dict(
+            shipped=self._shipped_count,
+            dropped=self._dropped_count,
+            failed=self._failed_count,
+            buffered=len(self._buffer),
+        )
+
+    def log(self, data: str):
+        with self._lock:
+            if not self._running:
+                return
+            if len(self._buffer) >= self._buffer_size:
+                self._buffer.popleft()
+                self._dropped_count += 1
+            self._buffer.append(data)
+
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self._worker,
+                    name="RedisLogShipper",
+                    daemon=True,
+                )
+                self._thread.start()
+            if len(self._buffer) >= self._batch_size:
+                self._lock.notify()
+
+    def flush(self):
+        """Ship all the buffered records."""
+        while self._ship_batch():
+            pass
+
+    def teardown(self):
+        """Stop the shipping thread and flush the remaining records."""
+        with self._lock:
+            self._running = False
+            self._lock.notify()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                if not self._running:
+                    return
+                if len(self._buffer) < self._batch_size:
+                    self._lock.wait(self._flush_interval)
+            self._ship_batch()
+
+    def _ship_batch(self) -> bool:
+        """Send up to one batch of records to Redis. Return True if a full batch was sent."""
+        with self._flush_lock:
+            with self._lock:
+                count = min(len(self._buffer), self._batch_size)
+                batch = [self._buffer.popleft() for _ in range(count)]
+            if not batch:
+                return False
+
+            try:
+                self._redis.push_many(self._queue_name, batch)
+            except Exception as ex:
+                self._failed_count += len(batch)
+                if not self._failing:
+                    # cannot log through the logger, as records would come back here
+                    print(f"Failed shipping log records to Redis: {ex!r}", file=sys.stderr)
+                    self._failing = True
+                # back off, records keep being buffered meanwhile
+                time.sleep(self._flush_interval)
+                return False
+
+            self._failing = False
+            self._shipped_count += len(batch)
+            return count == self._batch_size
@@ -1,30 +1,106 @@
-from typing import Optional
+from typing import Optional, List, Tuple, Dict
 
 import pydantic
 
 
+def _parse_dalle_api_backends(value: str) -> List[Tuple[str, float]]:
+    backends = list()
+    for backend in value.split(","):
+        url, _, weight = backend.strip().partition(" ")
+        weight = float(weight) if weight.strip() else 1.0
+        if weight <= 0:
+            raise ValueError(f"DALLE backend weight must be greater than 0 ({url})")
+        backends.append((url, weight))
+    return backends
+
+
+def _parse_log_sampling(value: str) -> Dict[str, float]:
+    rates = dict()
+    for event_rate in value.split(","):
+        event, _, rate = event_rate.strip().partition(" ")
+        if not event:
+            continue
+        if not rate.strip():
+            raise ValueError(f"Log sampling rate missing ({event})")
+        rate = float(rate)
+        if not 0 <= rate <= 1:
+            raise ValueError(f"Log sampling rate must be between 0 and 1 ({event})")
+        rates[event] = rate
+    return rates
+
+
 class Settings(pydantic.BaseSettings):
+    app_mode: str = pydantic.Field(default="bot", regex=r"^(bot|worker)$")
+
     telegram_bot_token: str
     telegram_bot_threads: int = 500
+    telegram_bot_generate_queue_size: int = 100
+    telegram_bot_instant_threads: int = 8
+    telegram_bot_instant_queue_size: int = 1000
+    telegram_bot_async: bool = False
     telegram_bot_delete_webhook: bool = False
+    telegram_bot_api_url: Optional[pydantic.AnyHttpUrl] = None
+    telegram_bot_webhook_url: Optional[pydantic.AnyHttpUrl] = None
+    telegram_bot_webhook_secret_token: Optional[str] = pydantic.Field(default=None, regex=r"^[A-Za-z0-9_-]{1,256}$")
+    telegram_bot_webhook_listen_host: str = "0.0.0.0"
+    telegram_bot_webhook_listen_port: int = 8080
+    telegram_bot_webhook_path: str = "/webhook"
+    telegram_bot_webhook_queue_size: int = 1000
+    telegram_bot_webhook_max_connections: int = 40
     telegram_bot_graceful_shutdown: bool = False
     telegram_bot_set_commands: bool = False
     telegram_bot_api_sessions_enabled: bool = True
     telegram_bot_api_sessions_ttl_seconds: float = 360
+    telegram_bot_api_max_connections: int = 50
     telegram_bot_ratelimit_retry: bool = True
     telegram_bot_ratelimit_retry_delay_seconds: float = 5
     telegram_bot_ratelimit_retry_timeout_seconds: float = 120
+    telegram_bot_outbound_governor: bool = False
+    telegram_bot_outbound_global_per_second: float = 30
+    telegram_bot_outbound_chat_per_second: float = 1
+    telegram_bot_outbound_group_per_minute: float = 20
 
     command_generate_action: str = "typing"
+    command_generate_action_senders: int = 8
+    command_generate_process_threads: int = 4
+    command_generate_upload_threads: int = 20
+    command_generate_cleanup_threads: int = 4
+    command_generate_stages_queue_size: int = 100
     command_generate_chat_concurrent_limit: int = 3
+    command_generate_chat_concurrent_lease_seconds: float = pydantic.Field(default=60, gt=0)
+    command_generate_chat_rate_limit_per_minute: float = 0
+    command_generate_chat_rate_limit_burst: int = 5
+    command_generate_global_rate_limit_per_minute: float = 0
+    command_generate_global_rate_limit_burst: int = 100
     command_generate_prompt_length_min: int = pydantic.Field(default=2, gt=1)
     command_generate_prompt_length_max: int = pydantic.Field(default=1000, gt=1)
 
     dalle_api_url: pydantic.AnyHttpUrl = "https://bf.dallemini.ai/generate"
+    dalle_api_backends_urls: Optional[str] = None
+    dalle_backend_eject_failures_threshold: int = 3
+    dalle_backend_probe_interval_seconds: float = 10
+    dalle_backend_probe_path: Optional[str] = None
     dalle_api_request_timeout_seconds: float = 3.5 * 60
     dalle_api_request_socks_proxy: Optional[pydantic.AnyUrl] = None
+    dalle_api_connect_timeout_seconds: float = 10
+    dalle_api_pool_size: int = 20
+    dalle_api_pool_idle_seconds: float = 60
     dalle_generation_timeout_seconds: float = 6 * 60
     dalle_generation_retry_delay_seconds: float = 5
+    dalle_generation_retry_max_delay_seconds: float = 60
+    dalle_circuit_breaker_failures_threshold: int = 10
+    dalle_circuit_breaker_reset_seconds: float = 30
+    dalle_generation_concurrent_limit: int = 0
+    dalle_generation_queue_update_seconds: float = 15
+    dalle_coalesce_requests: bool = True
+    dalle_cache_enabled: bool = True
+    dalle_cache_size: int = 50
+    dalle_cache_ttl_seconds: float = 60 * 60
+
+    images_postprocessing_mode: str = pydantic.Field(default="none", regex=r"(?i)^(none|collage|recompress)$")
+    images_postprocessing_processes: int = 2
+    images_jpeg_quality: int = pydantic.Field(default=85, ge=1, le=95)
+    images_max_size_bytes: Optional[int] = None
 
     redis_host: Optional[str] = None
     redis_port: int = 6379
@@ -32,16 +108,82 @@ class Settings(pydantic.BaseSettings):
     redis_username: Optional[str] = None
     redis_password: Optional[str] = None
     redis_logs_queue_name: Optional[str] = None
+    redis_logs_level: str = "DEBUG"
+    redis_logs_batch_size: int = 500
+    redis_logs_flush_interval_seconds: float = 1
+    redis_logs_buffer_size: int = 10000
+    redis_dalle_cache_prefix: Optional[str] = None
+    redis_ratelimit_prefix: Optional[str] = None
+    redis_journal_key: Optional[str] = None
+    redis_inline_index_key: Optional[str] = None
+    redis_prewarm_popularity_key: Optional[str] = None
+    redis_jobs_queue_name: Optional[str] = None
+    redis_jobs_results_queue_prefix: str = "dallemini-telegrambot/jobs-results"
+
+    journal_file_path: Optional[str] = None
+    journal_max_age_seconds: float = 60 * 60
+    journal_fsync_interval_seconds: float = 0.5
+    journal_compact_size_bytes: int = 10 * 1024 * 1024
+
+    inline_index_size: int = 10000
+    inline_query_results_limit: int = pydantic.Field(default=50, ge=1, le=50)
+    inline_query_cache_seconds: int = 300
+
+    prewarm_budget_per_hour: int = 0
+    prewarm_min_requests: float = 3
+    prewarm_interval_seconds: float = 60
+    prewarm_max_inflight: int = 0
+    prewarm_top_prompts: int = 20
+    prewarm_tracked_prompts: int = 10000
+    prewarm_cache_ttl_seconds: float = 12 * 60 * 60
+
+    jobs_frontend_id: Optional[str] = None
+    jobs_result_timeout_seconds: float = 15 * 60
+    jobs_worker_id: Optional[str] = None
+    jobs_worker_threads: int = 50
+    jobs_worker_delivery: bool = True
+    jobs_worker_heartbeat_seconds: float = 10
+    jobs_delivery_threads: int = 20
+    jobs_delivery_queue_size: int = 100
+
+    metrics_host: str = "0.0.0.0"
+    metrics_port: Optional[int] = None
 
     log_level: str = "INFO"
+    log_sampling: Optional[str] = None
+
+    @pydantic.validator("dalle_api_backends_urls")
+    def _validate_dalle_api_backends_urls(cls, value: Optional[str]) -> Optional[str]:
+        if value:
+            _parse_dalle_api_backends(value)
+        return value
+
+    @pydantic.validator("log_sampling")
+    def _validate_log_sampling(cls, value: Optional[str]) -> Optional[str]:
+        if value:
+            _parse_log_sampling(value)
+        return value
+
+    @pydantic.validator("prewarm_top_prompts")
+    def _validate_prewarm_top_prompts(cls, value: int, values: dict) -> int:
+        # prewarming more prompts than the cache can hold would evict the prewarmed results
+        if values.get("prewarm_budget_per_hour") and value > values.get("dalle_cache_size", value):
+            raise ValueError("PREWARM_TOP_PROMPTS must not be greater than DALLE_CACHE_SIZE")
+        return value
 
     @property
-    def dalle_generation_retries_limit(self) -> int:
-        return int(self.dalle_generation_timeout_seconds / self.dalle_generation_retry_delay_seconds)
+    def dalle_api_backends(self) -> List[Tuple[str, float]]:
+        """Return the DALLE API backends, as (url, weight), from DALLE_API_BACKENDS_URLS or DALLE_API_URL"""
+        if not self.dalle_api_backends_urls:
+            return [(str(self.dalle_api_url), 1.0)]
+        return _parse_dalle_api_backends(self.dalle_api_backends_urls)
 
     @property
-    def telegram_bot_ratelimit_retries_limit(self) -> int:
-        return int(self.telegram_bot_ratelimit_retry_timeout_seconds / self.telegram_bot_ratelimit_retry_delay_seconds)
+    def log_sampling_rates(self) -> Dict[str, float]:
+        """Return the sampling rates of high-volume log events, as {event: rate}, from LOG_SAMPLING"""
+        if not self.log_sampling:
+            return dict()
+        return _parse_log_sampling(self.log_sampling)
 
     @property
     def dalle_api_request_socks_proxy_for_requests_lib(self) -> Optional[dict]:
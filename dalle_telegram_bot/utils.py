@@ -1,12 +1,17 @@
 import shortuuid
 from telebot.apihelper import ApiTelegramException
 
-__all__ = ("get_uuid", "exception_is_bot_blocked_by_user")
+__all__ = ("get_uuid", "normalize_prompt", "exception_is_bot_blocked_by_user")
 
 
 def get_uuid() -> str:
     return shortuuid.uuid()
 
 
+def normalize_prompt(prompt: str) -> str:
+    """Return a normalized version of a prompt (lowercase, collapsed whitespaces), used for identifying equal prompts"""
+    return " ".join(prompt.lower().split())
+
+
 def exception_is_bot_blocked_by_user(ex: Exception) -> bool:
     return isinstance(ex, ApiTelegramException) and ex.description == "Forbidden: bot was blocked by the user"
@@ -0,0 +1,152 @@
+from threading import Thread, Event
+from typing import List, Optional
+
+from .entrypoint import BotBackend
+from .services.bot import Bot
+from .services.dalle import Dalle, DalleTemporarilyUnavailableException, GenerationsIndex
+from .services.jobs import GenerationJob, GenerationJobStatus
+from .logger import logger
+from .utils import get_uuid, exception_is_bot_blocked_by_user
+
+
+class WorkerBackend(BotBackend):
+    """DALLE generation worker, for the distributed mode (APP_MODE=worker).
+    Consumes generation jobs queued on Redis by the bot frontends, requests them to DALLE, and either delivers
+    the result to the user, or pushes it back to the frontend for delivery.
+    Jobs are claimed on a processing queue of the worker, so if it dies, the jobs are requeued by the other workers."""
+
+    dalle: Dalle
+    bot: Bot
+    worker_id: str
+    _worker_threads: List[Thread]
+    _heartbeat_thread: Optional[Thread]
+    _stop_event: Event
+
+    def setup(self):
+        super().setup()
+        self.worker_id = self.settings.jobs_worker_id or get_uuid()
+        self._worker_threads = list()
+        self._heartbeat_thread = None
+        self._stop_event = Event()
+
+    def _check_settings(self):
+        if not self.job_queue.enabled:
+            raise ValueError("Worker requires Redis and REDIS_JOBS_QUEUE_NAME to be configured")
+        if self.settings.telegram_bot_async:
+            raise ValueError("Worker does not support TELEGRAM_BOT_ASYNC")
+
+    def _prewarm_enabled(self) -> bool:
+        return self.settings.prewarm_budget_per_hour > 0 and self.dalle_cache.enabled
+
+    def _get_generations_index(self) -> Optional[GenerationsIndex]:
+        # generations delivered by workers are indexed by the bot frontends, from the job results
+        return None
+
+    def _get_bot_extra_kwargs(self) -> dict:
+        # the worker bot is only used for delivering results, never queues jobs
+        return dict()
+
+    def start(self):
+        logger.bind(threads=self.settings.jobs_worker_threads, worker_id=self.worker_id).info("Running worker...")
+        self.bot.start_delivery()
+        # jobs claimed by this worker on a previous run (with the same JOBS_WORKER_ID) were never completed
+        self.job_queue.requeue_claimed_jobs(self.worker_id)
+        self.job_queue.heartbeat(self.worker_id)
+        self._heartbeat_thread = Thread(
+            target=self._heartbeat_worker,
+            name="JobsWorkerHeartbeat",
+            daemon=True,
+        )
+        self._heartbeat_thread.start()
+
+        for i in range(self.settings.jobs_worker_threads):
+            thread = Thread(
+                target=self._worker,
+                name=f"JobsWorker-{i}",
+                daemon=True,
+            )
+            thread.start()
+            self._worker_threads.append(thread)
+        if self.prewarmer:
+            self.prewarmer.start()
+
+    def stop(self):
+        logger.info("Stopping worker (waiting for jobs in progress)...")
+        self._stop_event.set()
+        for thread in self._worker_threads:
+            thread.join()
+        if self._heartbeat_thread:
+            self._heartbeat_thread.join()
+        self._stop_prewarmer()
+        self.bot.stop_delivery()
+        self.dalle.close()
+        logger.bind(**self.dalle_cache.stats).info("DALLE cache stats")
+        logger.bind(backends=self.dalle.backends_stats).info("DALLE backends stats")
+        logger.info("Worker stopped!")
+
+    def _worker(self):
+        while not self._stop_event.is_set():
+            try:
+                claimed = self.job_queue.claim_job(self.worker_id, timeout=5)
+            except Exception as ex:
+                logger.opt(exception=ex).error("Failed fetching jobs")
+                self._stop_event.wait(5)
+                continue
+
+            if claimed:
+                job, data = claimed
+                self._process_job(job)
+                try:
+                    self.job_queue.complete_job(self.worker_id, data)
+                except Exception as ex:
+                    logger.opt(exception=ex).bind(job_id=job.job_id).error("Failed completing job")
+
+    def _heartbeat_worker(self):
+        """Refresh the heartbeat of the worker, and requeue the jobs claimed by dead workers"""
+        while not self._stop_event.wait(self.settings.jobs_worker_heartbeat_seconds):
+            try:
+                self.job_queue.heartbeat(self.worker_id)
+                self.job_queue.requeue_orphaned_jobs(self.worker_id)
+            except Exception as ex:
+                logger.opt(exception=ex).error("Failed refreshing worker heartbeat")
+
+    def _process_job(self, job: GenerationJob):
+        with logger.contextualize(request_id=job.request_id, job_id=job.job_id, chat_id=job.chat_id):
+            logger.info("Job started")
+            try:
+                job.response = self.dalle.generate(job.prompt)
+                job.status = GenerationJobStatus.GENERATED
+            except DalleTemporarilyUnavailableException:
+                job.status = GenerationJobStatus.FAILED
+            except Exception as ex:
+                logger.opt(exception=ex).error("Job generation failed")
+                job.status = GenerationJobStatus.FAILED
+
+            if job.status == GenerationJobStatus.GENERATED and self.settings.jobs_worker_delivery:
+                self._deliver_job(job)
+
+            try:
+                self.job_queue.push_result(job)
+                logger.bind(job_status=job.status).info("Job completed")
+            except Exception as ex:
+                logger.opt(exception=ex).error("Failed pushing job result")
+
+    def _deliver_job(self, job: GenerationJob):
+        """Send the generated images to the user. On success, the response is removed from the job,
+        so the frontend only gets the notification of completion. On failure, the frontend will retry delivering."""
+        try:
+            job.telegram_file_ids = self.bot.send_generated_images(
+                chat_id=job.chat_id,
+                reply_to_message_id=job.message_id,
+                prompt=job.prompt,
+                response=job.response,
+            )
+        except Exception as ex:
+            if exception_is_bot_blocked_by_user(ex):
+                logger.info("Job delivery: Bot blocked by the user")
+            else:
+                logger.opt(exception=ex).warning("Job delivery failed, returning result to the bot")
+                return
+
+        job.status = GenerationJobStatus.DELIVERED
+        job.response = None
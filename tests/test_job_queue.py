@@ -0,0 +1,112 @@
+import time
+
+import fakeredis
+import pytest
+
+from dalle_telegram_bot.settings import Settings
+from dalle_telegram_bot.services.redis import Redis
+from dalle_telegram_bot.services.jobs import JobQueue, GenerationJob, PendingJobs
+
+
+@pytest.fixture
+def settings() -> Settings:
+    return Settings(
+        _env_file=None,
+        telegram_bot_token="123456:test",
+        redis_jobs_queue_name="test/jobs",
+        jobs_worker_heartbeat_seconds=0.05,
+    )
+
+
+@pytest.fixture
+def job_queue(settings: Settings) -> JobQueue:
+    redis = Redis(settings)
+    redis._redis = fakeredis.FakeStrictRedis()
+    return JobQueue(settings=settings, redis=redis)
+
+
+def get_job(job_id: str = "job-1", **kwargs) -> GenerationJob:
+    return GenerationJob(
+        job_id=job_id,
+        request_id=None,
+        chat_id=1,
+        message_id=2,
+        generating_message_id=3,
+        prompt="a test prompt",
+        **kwargs,
+    )
+
+
+def test_claim_job(job_queue: JobQueue):
+    job_queue.push_job(get_job("job-1"))
+    job_queue.push_job(get_job("job-2"))
+
+    claimed_job, data = job_queue.claim_job("worker-1", timeout=0.1)
+    assert claimed_job.job_id == "job-1"
+    claimed_job, _ = job_queue.claim_job("worker-2", timeout=0.1)
+    assert claimed_job.job_id == "job-2"
+    assert job_queue.claim_job("worker-1", timeout=0.1) is None
+
+    # completed jobs are not requeued
+    job_queue.complete_job("worker-1", data)
+    assert job_queue.requeue_claimed_jobs("worker-1") == 0
+
+
+def test_requeue_jobs_of_dead_worker(job_queue: JobQueue):
+    job_queue.push_job(get_job("job-1"))
+    job_queue.heartbeat("worker-1")
+    job_queue.heartbeat("worker-2")
+    job_queue.claim_job("worker-1", timeout=0.1)
+
+    # worker-1 is alive
+    assert job_queue.requeue_orphaned_jobs("worker-2") == 0
+
+    # worker-1 stops refreshing its heartbeat, which expires
+    time.sleep(0.2)
+    job_queue.heartbeat("worker-2")
+    assert job_queue.requeue_orphaned_jobs("worker-2") == 1
+
+    claimed_job, _ = job_queue.claim_job("worker-2", timeout=0.1)
+    assert claimed_job.job_id == "job-1"
+    # the dead worker is forgotten
+    assert job_queue.requeue_orphaned_jobs("worker-2") == 0
+
+
+def test_requeue_claimed_jobs_on_restart(job_queue: JobQueue):
+    job_queue.push_job(get_job("job-1"))
+    job_queue.claim_job("worker-1", timeout=0.1)
+
+    assert job_queue.requeue_claimed_jobs("worker-1") == 1
+    claimed_job, _ = job_queue.claim_job("worker-1", timeout=0.1)
+    assert claimed_job.job_id == "job-1"
+
+
+def test_push_pop_result(job_queue: JobQueue):
+    results_queue_name = job_queue.get_results_queue_name("frontend-1")
+    job_queue.push_result(get_job("job-1", results_queue_name=results_queue_name))
+
+    assert job_queue.pop_result(results_queue_name, timeout=0.1).job_id == "job-1"
+    assert job_queue.pop_result(results_queue_name, timeout=0.1) is None
+
+
+def test_pending_job_result_received():
+    pending_jobs = PendingJobs(timeout=60)
+    job = get_job("job-1")
+    pending_jobs.add(job)
+
+    assert pending_jobs.pop(job)
+    assert not pending_jobs.pop(job)
+    assert pending_jobs.pop_expired() == []
+
+
+def test_pending_job_result_expired():
+    pending_jobs = PendingJobs(timeout=0.05)
+    job = get_job("job-1")
+    pending_jobs.add(job)
+    assert pending_jobs.pop_expired() == []
+
+    time.sleep(0.1)
+    assert [expired_job.job_id for expired_job in pending_jobs.pop_expired()] == ["job-1"]
+    assert len(pending_jobs) == 0
+    # a result received after expiring is not pending anymore
+    assert not pending_jobs.pop(job)